@@ -6,7 +6,14 @@ from tqdm import trange
 from time import sleep
 
 from ..simhash import *
-from ..stopwords import *
+from ..dedup_manager import *
+from ..hamming_index import *
+from ..minhash import *
+from ..url_manager import *
+#the word lists come from the mmapped lexicon file of lexicon_manager, so the workers don't parse the stopwords.py literal
+from ..lexicon_manager import warmup_lexicons, all_stopwords, flagged_words
+from ..langid_manager import lang_id
+from ..model_manager import preload
 from ..filtering import *
 from ..kenlm_manager import *
 from ..pdf_and_ocr import *
@@ -37,11 +44,12 @@ logger = logging.getLogger(__name__)
 
 """
     #each element in the bild2elements table has the form:
-    #     (position, relative_position, bild id, simhash_code, val, is_yt_dl_supported, flagged for nsfw, additional info such as coordinates if any)
+    #     (position, relative_position, bild id, hashcode, val, is_yt_dl_supported, flagged for nsfw, additional info such as coordinates if any)
     #the url, position is the unique id for each row. 
     #relative position is position/length of document. This will tell you if an image is in the header or footer of a page for example.
     #bild id is a name like ###img###1###. 
     #val is usually url but could also be other content potentially (such as a table's content, code, etc.)
+    #hashcode is a fingerprint of the canonical url for media and links, and the simhash code of val otherwise (see url_manager.bild_fingerprint_config).
     #coordinates is special for images (and video??) as these are boxes with labels
     
 """    
@@ -61,6 +69,7 @@ for y in global_config.values():
 
 import itertools
 import re
+from collections import Counter
 
 BILD_ELEMENT = re.compile('###\w+###\d+###')
 NAV = re.compile('###nav###\d+###([^▁]+)▁/nav###')
@@ -634,15 +643,35 @@ def extract_pdf(pdf_bytes, warc_stats, recno, url, store_path, ocr_threshold=0.7
     return (record, "", warc_stats)
 
 
+#languages written without spaces between words, so their text must be hashed and length filtered by character.
+CJK_LANGS = {'zh', 'zh-classical', 'zh-min-nan', 'zh-yue', 'ko', 'ja', 'th', 'jv'}
+
+#per language simhash/minhash parameters, as a dict of lang -> {"window_size": ..., "tokenization": ...}. 
+#a lang (or a key) that is missing uses the window_size and tokenization passed to the pipeline.
+lang_hashing_config = {lang: {"tokenization": "character"} for lang in CJK_LANGS}
+
+def get_lang_hashing_config(lang, window_size, tokenization, hashing_config=None):
+  """ the (window_size, tokenization) to hash a document in lang with. hashing_config defaults to lang_hashing_config. """
+  config = (lang_hashing_config if hashing_config is None else hashing_config).get(lang, {})
+  return config.get("window_size", window_size), config.get("tokenization", tokenization)
+
+
 def filter_and_tag_record(record, dup_span, dup_doc, idx, stopwords_scores_per_lang, perplexity_scores_per_lang, \
                  stopword_mean, stopword_stdev, perplexity_mean, perplexity_stdev,  simple_moving_avg_window, stopword_stdev_lower_bound, perplexity_stdev_upper_bound, \
                   window_size, tokenization,  special_char_max_cutoff=0.4, lang_id_min_cutoff=0.5, number_words_min_cutoff=30, \
                  text_span_num_words=50, min_img_height=75,  min_img_width=75, sentence_dedup_shingle_size=5, cleanup_dup_span_limit=1000000, \
-                 cleanup_dup_doc_limit=1000000, default_kenlm_wikipedia = "/content/drive/Shareddrives/LAION/kenlm_ccnet_wikipedia_models"):    
+                 cleanup_dup_doc_limit=1000000, default_kenlm_wikipedia = "/content/drive/Shareddrives/LAION/kenlm_ccnet_wikipedia_models", \
+                 dedup_engine="simhash", minhash_num_perm=128, minhash_window_size=5, exact_dup=None, \
+                 simhash_index=None, simhash_index_distance=3, hashing_config=None, fingerprint_config=None, seen_urls=None, minhash_index=None):    
     assert record is not None
     (record,  warc_stats) = record
     page_config = record['stats']
     text = record['text']
+    #exact duplicates (after whitespace normalization) are dropped before any of the more expensive dedup and filtering below.
+    #exact_dup is a store from dedup_manager.get_exact_dup_store, or None to skip this check.
+    if exact_dup is not None and is_exact_dup(exact_dup, text):
+      warc_stats["warc_exception_exact_duplicate_counts"] = warc_stats.get("warc_exception_exact_duplicate_counts", 0) + 1
+      return None, None, None
     text = " ".join(text.replace("。. ", "。 ").replace(". .", ".").replace(".. ", ". ").replace(" . . ", ". ").replace("?. ", "? ").replace("!. ", "! ").replace(",. ", ", ").replace(".”. ", ".” ").replace(".\" ", ".\" ").split())
     
     #According to the ccnet paper, we want to remove paragraph dups in order to do a better lang_id. 
@@ -687,11 +716,14 @@ def filter_and_tag_record(record, dup_span, dup_doc, idx, stopwords_scores_per_l
     record["text"] = text
 
     # now, create positional information in the bild2elements columns. uid is (page_url, position). we assume no overlaps for the same bild type. 
+    #the hashcode of each element is a cheap exact fingerprint of the canonical url for media and links, and a simhash for other types (see url_manager).
+    #seen_urls is a dup store of the fingerprints -> counts over all pages, so assets repeated across pages (CDN images, etc.) are flagged.
     len_text = len(text)
     bild_cnt = 0
     found_nsfw = -1
     for bild_element_type, aHash in bild2elements.items():
       id2 = []
+      seen_counts = []
       for key, val in aHash.items():
         position = text.find(key)
         if position >= 0:
@@ -701,11 +733,20 @@ def filter_and_tag_record(record, dup_span, dup_doc, idx, stopwords_scores_per_l
           found_nsfw= max(found_nsfw, flagged)
           if is_supported: 
             warc_stats["warc_supported_"+bild_element_type] = warc_stats.get("warc_supported_"+bild_element_type, 0) + 1 
+          hashcode = fingerprint_bild_element(bild_element_type, val, fingerprint_config)
+          if seen_urls is not None:
+            seen_counts.append(increment_dup_store(seen_urls, hashcode))
+            if seen_counts[-1] > 1: 
+              warc_stats["warc_seen_"+bild_element_type] = warc_stats.get("warc_seen_"+bild_element_type, 0) + 1
           if maps.get(key):
-            id2.append((position, position/len_text, key, hashing(val), val, is_supported, flagged, maps[key]))
+            id2.append((position, position/len_text, key, hashcode, val, is_supported, flagged, maps[key]))
           else:
-            id2.append((position, position/len_text, key, hashing(val), val, is_supported, flagged, ()))
+            id2.append((position, position/len_text, key, hashcode, val, is_supported, flagged, ()))
       record[bild_element_type] = id2
+      if seen_urls is not None:
+        record[bild_element_type+"_seen_counts"] = seen_counts
+    if seen_urls is not None:
+      cleanup_dup_store(seen_urls, cleanup_dup_span_limit)
     if bild_cnt < 1:
       warc_stats["warc_exception_no_bild_elements_counts"] += 1
       return None, None, None
@@ -733,25 +774,28 @@ def filter_and_tag_record(record, dup_span, dup_doc, idx, stopwords_scores_per_l
     
     #TODO: put in repeition filtering.
 
-    #special char filtering
-    unformatted_text2 = "".join(unformatted_text.split())
-    if not unformatted_text2:
+    if not unformatted_text.strip():
       warc_stats["warc_exception_no_content_counts"] += 1
       return None, None, None
-    
-    special_char_score = len([a for a in unformatted_text2 if a in special_characters_default])/len(unformatted_text2)
+    #special char filtering. the special chars don't depend on the lang, so we reject on them before the (slower) lang id,
+    #and pass the char counts on to compute_quality_signals.
+    char_counts = Counter(unformatted_text)
+    special_char_score = get_nonspace_special_char_score(unformatted_text, char_counts=char_counts)
     if special_char_score > special_char_max_cutoff: 
       #print ('*** special char ****', special_char_score)
       warc_stats["warc_exception_special_char_counts"] += 1
       return None, None, None
+
     #langid detection and filtering
     lang, lang_score_pred = lang_id(unformatted_text)
     if lang_score_pred < lang_id_min_cutoff: 
       #print ('***', lang, '***', lang_score_pred, '****', clean_text)
       warc_stats["warc_exception_no_lang_counts"] += 1
       return None, None, None
-    is_cjk = lang in {'zh', 'zh-classical', 'zh-min-nan', 'zh-yue', 'ko', 'ja', 'th', 'jv'}
+    is_cjk = lang in CJK_LANGS
 
+    #the stopword and other quality scores, computed in one pass over the text once we know the lang.
+    signals = compute_quality_signals(lang, unformatted_text, char_counts=char_counts)
 
     #min length filtering. we are filtering very short pages, unless it has some form of bild element.
     if is_cjk:
@@ -764,21 +808,19 @@ def filter_and_tag_record(record, dup_span, dup_doc, idx, stopwords_scores_per_l
         return None, None, None
 
     #stopwords ratio filtering
-    stopword_score = get_stopword_score(lang, unformatted_text)
+    stopword_score = signals.stopword_score
     stopwords_min_cutoff = stopword_mean = stopword_median = stopword_stdev = stopword_quantiles = None
-    stopwords_scores_per_lang[lang] = stopwords_scores = stopwords_scores_per_lang.get(lang,[])
-    stopwords_scores.append(stopword_score)
+    #stopwords_scores_per_lang has a filtering.RollingStats of the last simple_moving_avg_window scores of each lang
+    stopwords_scores = get_rolling_stats(stopwords_scores_per_lang, lang, simple_moving_avg_window).add(stopword_score)
     if len(stopwords_scores) < 2:
       stopwords_min_cutoff = stopword_score
     else:
-      if len(stopwords_scores) > simple_moving_avg_window:
-        stopwords_scores=stopwords_scores[-simple_moving_avg_window:]
-      stopword_stdev = statistics.stdev(stopwords_scores)
-      stopword_mean = statistics.mean (stopwords_scores)        
-      stopword_median = statistics.median (stopwords_scores)        
+      stopword_stdev = stopwords_scores.stdev()
+      stopword_mean = stopwords_scores.mean()
+      stopword_median = stopwords_scores.median()
       stopwords_min_cutoff = stopword_mean-(stopword_stdev*stopword_stdev_lower_bound)
     #if len(stopwords_scores) > 10: 
-    #  stopword_quantiles = statistics.quantiles(stopwords_scores, n=10)
+    #  stopword_quantiles = [stopwords_scores.quantile(q/10) for q in range(1, 10)]
     if stopword_score < stopwords_min_cutoff: 
       warc_stats["warc_exception_stopwords_cutoff_counts"] += 1
       warc_stats["warc_exception_stopwords_cutoff_counts_"+ lang]  = warc_stats.get("warc_exception_stopwords_cutoff_counts_"+ lang,0)+1       
@@ -792,19 +834,16 @@ def filter_and_tag_record(record, dup_span, dup_doc, idx, stopwords_scores_per_l
         kenlm_model = kenlm_model["wikipedia"]
     if kenlm_model:
         perplexity_score = kenlm_model.get_perplexity(unformatted_text)
-        perplexity_scores_per_lang[lang] = perplexity_scores = perplexity_scores_per_lang.get(lang,[])
-        perplexity_scores.append(perplexity_score)
+        perplexity_scores = get_rolling_stats(perplexity_scores_per_lang, lang, simple_moving_avg_window).add(perplexity_score)
         if len(perplexity_scores) < 2:
           perplexity_max_cutoff = perplexity_score
         else:
-          if len(perplexity_scores) > simple_moving_avg_window:
-             perplexity_scores = perplexity_scores[-simple_moving_avg_window:] 
-          perplexity_stdev = statistics.stdev(perplexity_scores)
-          perplexity_mean = statistics.mean (perplexity_scores)
-          perplexity_median = statistics.median (perplexity_scores)
+          perplexity_stdev = perplexity_scores.stdev()
+          perplexity_mean = perplexity_scores.mean()
+          perplexity_median = perplexity_scores.median()
           perplexity_max_cutoff = perplexity_mean+(perplexity_stdev*perplexity_stdev_upper_bound)
         #if len(perplexity_scores) > 10: 
-        #    perplexity_quantiles = statistics.quantiles(perplexity_scores, n=10)
+        #    perplexity_quantiles = [perplexity_scores.quantile(q/10) for q in range(1, 10)]
         if perplexity_score > perplexity_max_cutoff: 
           #print ('perplexity filtered', lang, perplexity_score, clean_text)
           warc_stats["warc_exception_perplexity_cutoff_counts"]  = warc_stats.get("warc_exception_perplexity_cutoff_counts",0)+1
@@ -835,13 +874,18 @@ def filter_and_tag_record(record, dup_span, dup_doc, idx, stopwords_scores_per_l
     record["perplexity_median"] = perplexity_median
     record["perplexity_max_cutoff"] = perplexity_max_cutoff
     record["special_char_score"] = special_char_score
+    record["flaggedword_score"] = signals.flaggedword_score
+    record["ngram_score"] = signals.ngram_score
+    record["word_count"] = signals.word_count
+    record["mean_word_len"] = signals.mean_word_len
+    record["digit_ratio"] = signals.digit_ratio
+    record["line_repetition_ratio"] = signals.line_repetition_ratio
 
     if record["nsfw"]:  warc_stats["warc_nsfw_counts"]  = warc_stats.get("warc_nsfw_counts",0) + 1
     #record["perplexity_quantiles"] = perplexity_quantiles
-    #some written languages do not use spaces, in which case the tokenization must be character based
-    #hack since we are over-riding the default tokenization. We can and should have different hashing parameters for each lang.
-    #NOTE: we can consider each lang having their own simhash space. we can limit the compute that way.
-    if is_cjk: tokenization = "character"
+    #each lang has its own hashing parameters, e.g., some written languages do not use spaces, in which case the tokenization must be character based.
+    #since the codes of different langs are not comparable, each lang also has its own simhash space in a PartitionedHammingIndex.
+    window_size, tokenization = get_lang_hashing_config(lang, window_size, tokenization, hashing_config)
 
     #NOTE: For hashing text, to find similarity, we remove the nav and meta bild elements. 
     #We could remove other elements too like FORM, but this is a balancing act. 
@@ -858,10 +902,41 @@ def filter_and_tag_record(record, dup_span, dup_doc, idx, stopwords_scores_per_l
                        " ".join(str(item) for item in iframe_links.values()) 
 
     text_to_hash = " ".join(hash_text.split())
-    simhash_code = hashing(text_to_hash, \
+    #dedup_engine picks the near dup fingerprint. simhash codes are clustered with simhash.index_clusters_*, 
+    #and minhash signatures with minhash.index_clusters_minhash.
+    if dedup_engine == "minhash":
+      signature = minhash(text_to_hash, \
+                       num_perm=minhash_num_perm, \
+                       window_size=minhash_window_size, \
+                       tokenization=tokenization)
+      record["minhash_signature"] = signature.tolist()
+      record["minhash_code"] = int(minhash_codes(signature)[0])
+      #minhash_index is a dict of lang -> minhash.MinHashLSH of the documents this process kept so far. like the simhash index,
+      #near duplicates of those are dropped, and everything else is added to the index. it lives in memory, so unlike the
+      #simhash index, near dups across processes and runs are only found offline, with minhash.index_clusters_minhash.
+      if minhash_index is not None:
+        lsh = minhash_index.get(lang)
+        if lsh is None: lsh = minhash_index[lang] = MinHashLSH(minhash_num_perm)
+        if len(lsh.query(signature)[0]):
+          warc_stats["warc_exception_near_duplicate_counts"] = warc_stats.get("warc_exception_near_duplicate_counts", 0) + 1
+          return None, None, None
+        lsh.insert(signature)
+    else:
+      simhash_code = hashing(text_to_hash, \
                        window_size=window_size, \
                        tokenization=tokenization)
-    record["simhash_code"] = simhash_code
+      record["simhash_code"] = simhash_code
+      #simhash_index is a hamming_index.SegmentedHammingIndex of the documents kept so far, including earlier crawls,
+      #or a PartitionedHammingIndex, where we only search (and add to) the partition of the document's lang.
+      #near duplicates of those are dropped, and everything else is added to the index.
+      if isinstance(simhash_index, PartitionedHammingIndex):
+        simhash_index = simhash_index.partition(lang)
+      if simhash_index is not None:
+        _, near_dup_ids, _ = simhash_index.query([simhash_code], max_distance=simhash_index_distance)
+        if len(near_dup_ids):
+          warc_stats["warc_exception_near_duplicate_counts"] = warc_stats.get("warc_exception_near_duplicate_counts", 0) + 1
+          return None, None, None
+        simhash_index.add([simhash_code])
     #record["text_to_hash"] = text_to_hash
 
 
@@ -875,7 +950,8 @@ def pipeline(dup_span, dup_doc, \
              stopword_mean=None, stopwords_stdev=None, perplexity_mean=None, perplexity_stdev= None, \
              simple_moving_avg_window=500,  stopword_stdev_lower_bound=2, perplexity_stdev_upper_bound=2, \
              special_char_max_cutoff=0.4, lang_id_min_cutoff=0.5, number_words_min_cutoff=30, 
-             do_render_html=True):
+             do_render_html=True, dedup_engine="simhash", exact_dup=None, simhash_index=None, hashing_config=None, \
+             fingerprint_config=None, seen_urls=None, minhash_index=None):
     if stopwords_scores_per_lang is None: stopwords_scores_per_lang ={}
     if perplexity_scores_per_lang is None: perplexity_scores_per_lang ={}
              
@@ -889,7 +965,6 @@ def pipeline(dup_span, dup_doc, \
     )
     st = time.time()
     with open(warcpath, "rb") as f:
-        stopwords_scores_per_lang, perplexity_scores_per_lang, = {}, {}
         stopword_mean, stopwords_stdev, perplexity_mean, perplexity_stdev  = None, None, None, None
         warc_stats = {"img_count": 0, "vid_count": 0, "aud_count": 0, "iframe_count": 0, "rights_links_count": 0, "code_count":0, "table_count": 0, "nav_count":0, "meta_count": 0, "image_coords_count": 0, "input_count": 0, 'text_count': 0, 'form_count': 0, 'address_count': 0, 'summary_count': 0 }
         
@@ -903,6 +978,8 @@ def pipeline(dup_span, dup_doc, \
         warc_stats["warc_exception_no_lang_counts"]  = 0
         warc_stats["warc_exception_no_bild_elements_counts"] = 0
         warc_stats["warc_exception_duplicate_counts"] = 0
+        warc_stats["warc_exception_exact_duplicate_counts"] = 0
+        warc_stats["warc_exception_near_duplicate_counts"] = 0
         warc_stats["warc_partial_duplicate_counts"] = 0
         warc_stats["warc_exception_no_content_counts"] = 0
         warc_stats["warc_exception_no_body_data_counts"] = 0
@@ -958,7 +1035,8 @@ def pipeline(dup_span, dup_doc, \
                                                                       stopwords_stdev, perplexity_mean, perplexity_stdev, simple_moving_avg_window, \
                                                                       stopword_stdev_lower_bound, perplexity_stdev_upper_bound, warc_stats, url, html_bytes, \
                                                                       special_char_max_cutoff=special_char_max_cutoff, lang_id_min_cutoff=lang_id_min_cutoff, number_words_min_cutoff=number_words_min_cutoff, \
-                                                                      window_size=window_size, tokenization=tokenization, default_kenlm_wikipedia=default_kenlm_wikipedia)
+                                                                      window_size=window_size, tokenization=tokenization, default_kenlm_wikipedia=default_kenlm_wikipedia, dedup_engine=dedup_engine, exact_dup=exact_dup, simhash_index=simhash_index, hashing_config=hashing_config, \
+                                                                      fingerprint_config=fingerprint_config, seen_urls=seen_urls, minhash_index=minhash_index)
                     if html_pack:
                       warc_stats["warc_html_hits"] += 1
                       warc_stats["warc_html_hits_"+html_pack["lang"]]  = warc_stats.get("warc_html_hits_"+html_pack["lang"],0) + 1
@@ -985,7 +1063,8 @@ def pipeline(dup_span, dup_doc, \
                                                                       stopwords_stdev, perplexity_mean, perplexity_stdev, simple_moving_avg_window, \
                                                                       stopword_stdev_lower_bound, perplexity_stdev_upper_bound, warc_stats, url, pdf_bytes, \
                                                                       special_char_max_cutoff=special_char_max_cutoff, lang_id_min_cutoff=lang_id_min_cutoff, number_words_min_cutoff=number_words_min_cutoff, \
-                                                                      window_size=window_size, tokenization=tokenization, default_kenlm_wikipedia=default_kenlm_wikipedia)
+                                                                      window_size=window_size, tokenization=tokenization, default_kenlm_wikipedia=default_kenlm_wikipedia, dedup_engine=dedup_engine, exact_dup=exact_dup, simhash_index=simhash_index, hashing_config=hashing_config, \
+                                                                      fingerprint_config=fingerprint_config, seen_urls=seen_urls, minhash_index=minhash_index)
                       
                     
             else:
@@ -998,7 +1077,10 @@ def pipeline(dup_span, dup_doc, \
 
 
 
-def pipelines_for_warc_files(warc_files, tokenization, window_size,  save_dir, default_kenlm_wikipedia, simple_moving_avg_window, stopword_stdev_lower_bound, perplexity_stdev_upper_bound, special_char_max_cutoff, lang_id_min_cutoff, number_words_min_cutoff, ):
+def pipelines_for_warc_files(warc_files, tokenization, window_size,  save_dir, default_kenlm_wikipedia, simple_moving_avg_window, stopword_stdev_lower_bound, perplexity_stdev_upper_bound, special_char_max_cutoff, lang_id_min_cutoff, number_words_min_cutoff, \
+                             dup_store_backend="dict", dup_store_dir="./dup_store", dup_store_memory_budget=256*1024**2, dedup_engine="simhash", \
+                             exact_dup_backend="bloom", simhash_index_dir=None, dup_span=None, dup_doc=None, hashing_config=None, \
+                             fingerprint_config=None, seen_urls=None, exact_dup=None):
   if len(warc_files) > 1:
     warc_record_store_path = "./warchouse/" + warc_files[0].split("/")[-1].replace(".warc", "").replace(".gz", "") + "_" + warc_files[-1].split("/")[-1].replace(".warc", "").replace(".gz", "") +"_records.jsonl"
   else:
@@ -1006,10 +1088,32 @@ def pipelines_for_warc_files(warc_files, tokenization, window_size,  save_dir, d
 
   with open(warc_record_store_path, "w", encoding="utf8") as warc_record_store:
     #TODO, save away in presistent storage and synch up every cycle the following data
-    dup_span = {}
-    dup_doc = {} 
-    stopwords_scores_per_lang={}
-    perplexity_scores_per_lang={}
+    #with dup_store_backend="mmap", the span and doc hashcodes are kept in dup_store_dir and reloaded when the job is restarted
+    dup_store_name = warc_record_store_path.split("/")[-1].replace(".jsonl", "")
+    #the "cms" (count-min sketch) backend is saved as a directory, "mmap" as a single .npy file. 
+    dup_store_ext = "" if dup_store_backend == "cms" else ".npy"
+    #dup_span and dup_doc are passed in when they are shared by all the processes (dup_store_backend="shared")
+    if dup_span is None:
+      dup_span = get_dup_store(dup_store_backend, path=f"{dup_store_dir}/{dup_store_name}_dup_span{dup_store_ext}", memory_budget=dup_store_memory_budget)
+    if dup_doc is None:
+      dup_doc = get_dup_store(dup_store_backend, path=f"{dup_store_dir}/{dup_store_name}_dup_doc{dup_store_ext}", memory_budget=dup_store_memory_budget)
+    if seen_urls is None:
+      seen_urls = get_dup_store(dup_store_backend, path=f"{dup_store_dir}/{dup_store_name}_seen_urls{dup_store_ext}", memory_budget=dup_store_memory_budget)
+    exact_dup_path = f"{dup_store_dir}/{dup_store_name}_exact_dup" + (".npy" if exact_dup_backend == "mmap" else "")
+    #exact_dup is passed in when it is shared by all the processes (exact_dup_backend="shared"). a shared store made here
+    #would be private to this process and never unlinked.
+    if exact_dup is None:
+      if exact_dup_backend == "shared": raise ValueError("pass the shared exact_dup store, e.g., from extract_all_warcs")
+      exact_dup = get_exact_dup_store(exact_dup_backend, path=exact_dup_path, memory_budget=dup_store_memory_budget)
+    #the simhash index is shared by all the processes and runs, so near dups across crawls are found with a lookup.
+    #it has a partition per lang, so lookups only search the documents in the same lang.
+    simhash_index = PartitionedHammingIndex(simhash_index_dir) if simhash_index_dir and dedup_engine == "simhash" else None
+    #with minhash, each process keeps a MinHashLSH per lang of the documents it kept.
+    minhash_index = {} if dedup_engine == "minhash" else None
+    #the moving average cutoff stats carry over from one warc file to the next, and across restarts.
+    cutoff_stats_path = f"{dup_store_dir}/{dup_store_name}_cutoff_stats"
+    stopwords_scores_per_lang=load_rolling_stats(f"{cutoff_stats_path}_stopwords.json")
+    perplexity_scores_per_lang=load_rolling_stats(f"{cutoff_stats_path}_perplexity.json")
     stopword_mean=None
     stopwords_stdev=None
     perplexity_mean=None
@@ -1021,15 +1125,30 @@ def pipelines_for_warc_files(warc_files, tokenization, window_size,  save_dir, d
                             stopwords_scores_per_lang=stopwords_scores_per_lang, perplexity_scores_per_lang=perplexity_scores_per_lang, \
                             stopword_mean=stopword_mean, stopwords_stdev=stopwords_stdev, perplexity_mean=perplexity_mean, perplexity_stdev=perplexity_stdev, \
                             simple_moving_avg_window=simple_moving_avg_window,  stopword_stdev_lower_bound=stopword_stdev_lower_bound, perplexity_stdev_upper_bound=perplexity_stdev_upper_bound,\
-                            special_char_max_cutoff=special_char_max_cutoff, lang_id_min_cutoff=lang_id_min_cutoff, number_words_min_cutoff=number_words_min_cutoff, )
+                            special_char_max_cutoff=special_char_max_cutoff, lang_id_min_cutoff=lang_id_min_cutoff, number_words_min_cutoff=number_words_min_cutoff, \
+                            dedup_engine=dedup_engine, exact_dup=exact_dup, simhash_index=simhash_index, hashing_config=hashing_config, \
+                            fingerprint_config=fingerprint_config, seen_urls=seen_urls, minhash_index=minhash_index)
+      os.makedirs(dup_store_dir, exist_ok=True)
+      save_rolling_stats(stopwords_scores_per_lang, f"{cutoff_stats_path}_stopwords.json")
+      save_rolling_stats(perplexity_scores_per_lang, f"{cutoff_stats_path}_perplexity.json")
+      for dup_store in (dup_span, dup_doc, seen_urls, exact_dup):
+        if hasattr(dup_store, "flush"): dup_store.flush()
+      if isinstance(exact_dup, ScalableBloomFilter): exact_dup.save(exact_dup_path)
+      #the simhash index flushes every segment_size codes on its own, so we only pick up the segments of the other processes here
+      if simhash_index is not None:
+        simhash_index.refresh()
       os.system(f"rm {warc_file}") 
       #os.system(f"mv ./warchouse/*/ {save_dir}")
+    if simhash_index is not None:
+      simhash_index.flush()
 
 
 def extract_all_warcs(num_process = 6, simple_moving_avg_window=500, stopword_stdev_lower_bound=2, \
                       perplexity_stdev_upper_bound=2, special_char_max_cutoff=0.4, lang_id_min_cutoff=0.5, number_words_min_cutoff=30, 
                       save_dir="/content/drive/Shareddrives/LAION/CC-MAIN-2022-40/", dir="/content/drive/Shareddrives/LAION/CC-MAIN-2022-40/", \
-                      tokenization= "character", window_size=24, default_kenlm_wikipedia = "/content/drive/Shareddrives/LAION/kenlm_ccnet_wikipedia_models"):
+                      tokenization= "character", window_size=24, default_kenlm_wikipedia = "/content/drive/Shareddrives/LAION/kenlm_ccnet_wikipedia_models", \
+                      dup_store_backend="dict", dup_store_dir="./dup_store", dup_store_memory_budget=256*1024**2, dedup_engine="simhash", \
+                      exact_dup_backend="bloom", simhash_index_dir=None, hashing_config=None, fingerprint_config=None):
   #instead of downloading the kenlm models from FB research, we could save them away on a network drive
   #and copy them over to use with get_kenlm_models_from_savedir
   get_kenlm_models_from_savedir()
@@ -1037,11 +1156,26 @@ def extract_all_warcs(num_process = 6, simple_moving_avg_window=500, stopword_st
   files = glob.glob(f"{dir}*.gz")
   files.sort()
   batch_size = int(len(files)/num_process)
+  #build the stopword and flagged word lexicons of every lang once, so the processes share them instead of each building them
+  warmup_lexicons()
+  #likewise load the mt5 tokenizer and the fasttext lang id model before forking, so the processes share their pages
+  preload(["mt5_tokenizer", "fasttext_langid"])
+  if dup_store_backend == "shared":
+    #one dup_span and dup_doc in shared memory for all the processes, so dups across their warc files are found too
+    dup_span = get_dup_store("shared", memory_budget=dup_store_memory_budget)
+    dup_doc = get_dup_store("shared", memory_budget=dup_store_memory_budget)
+    seen_urls = get_dup_store("shared", memory_budget=dup_store_memory_budget)
+  else:
+    dup_span = dup_doc = seen_urls = None
+  exact_dup = get_exact_dup_store("shared", memory_budget=dup_store_memory_budget) if exact_dup_backend == "shared" else None
   plist=[]
   for rng in range(0, len(files), batch_size):
     max_rng = min(len(files), rng+batch_size)
     #print (len(files[rng:max_rng]))
-    p = Process(target=pipelines_for_warc_files, args=(files[rng:max_rng], tokenization, window_size, save_dir+"/warchouse", default_kenlm_wikipedia, simple_moving_avg_window, stopword_stdev_lower_bound, perplexity_stdev_upper_bound, special_char_max_cutoff, lang_id_min_cutoff, number_words_min_cutoff))
+    p = Process(target=pipelines_for_warc_files, args=(files[rng:max_rng], tokenization, window_size, save_dir+"/warchouse", default_kenlm_wikipedia, simple_moving_avg_window, stopword_stdev_lower_bound, perplexity_stdev_upper_bound, special_char_max_cutoff, lang_id_min_cutoff, number_words_min_cutoff, \
+                                                             dup_store_backend, dup_store_dir, dup_store_memory_budget, dedup_engine, \
+                                                             exact_dup_backend, simhash_index_dir, dup_span, dup_doc, hashing_config, \
+                                                             fingerprint_config, seen_urls, exact_dup))
     plist.append(p)
     p.start()
   
@@ -1060,6 +1194,12 @@ def extract_all_warcs(num_process = 6, simple_moving_avg_window=500, stopword_st
     prev_len = len(files2)
   for p in plist:
     p.join()
+  if dup_store_backend == "shared":
+    dup_span.unlink()
+    dup_doc.unlink()
+    seen_urls.unlink()
+  if exact_dup is not None:
+    exact_dup.unlink()
 
 #TODO: aggregate all *.jsonl file into one big jsonl at end of processing
     
@@ -44,11 +44,9 @@ import langid
 from .utils import *
 from .searcher_indexer import *
 from ..char_manager import junk, special_char
-from ..stopwords import stopwords as all_stopwords
 from ..langid_manager import *
-from ..banned_words import banned_words
-from ..flagged_words import flagged_words
 from ..cjk import lang_is_cjk
+from ..lexicon_manager import get_lexicon, MaxWordLens, all_stopwords
 
 if torch.cuda.is_available():
   device = 'cuda'
@@ -69,9 +67,10 @@ except:
     pass
 
 
-_lang_2_max_stopword_len = dict([(lang, max(s.count(" ")+1 if not lang_is_cjk(lang) else len(s) for s in arr)) for lang, arr in all_stopwords.items()])
-_lang_2_max_bannedword_len = dict([(lang, max(s.count(" ")+1 if not lang_is_cjk(lang) else len(s) for s in arr)) for lang, arr in banned_words.items()])
-_lang_2_max_flaggedword_len = dict([(lang, max(s.count(" ")+1 if not lang_is_cjk(lang) else len(s) for s in arr)) for lang, arr in flagged_words.items()])
+#the word lists and their max lens come from the shared lexicon registry, see lexicon_manager.warmup_lexicons
+_lang_2_max_stopword_len = MaxWordLens("stopwords")
+_lang_2_max_bannedword_len = MaxWordLens("banned_words")
+_lang_2_max_flaggedword_len = MaxWordLens("flagged_words")
 
 def extract_junk_ratio(self, data, infield, outfield):
     s = data[infield]
@@ -134,14 +133,9 @@ def extract_flagged_words_ratio(self, data, infield, outfield, ):
           lang_groups = self.lang_groups
         else:
           lang_groups=[]  
-        if hasattr(self, '_bannedwords'):
-          _bannedwords = self._bannedwords
-        else:
-          _bannedwords = self._bannedwords = set(list(itertools.chain(*[list(banned_words.get(lang, [])) for lang in list(lang_groups)+['en']])))
-        if hasattr(self, '_flaggedwords'):
-          _flaggedwords = self._flaggedwords 
-        else:
-          _flaggedwords = self._flaggedwords = set(list(itertools.chain(*[list(flagged_words.get(lang, [])) for lang in list(lang_groups)+['en']])))
+        #the english words merged with the words of each lang in lang_groups, cached in the lexicon registry
+        _bannedwords = get_lexicon("banned_words", "en", merge=tuple(lang_groups))
+        _flaggedwords = get_lexicon("flagged_words", "en", merge=tuple(lang_groups))
         if hasattr(self, 'src_lang'):
           src_lang = self.src_lang
         else:
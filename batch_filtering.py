@@ -0,0 +1,249 @@
+#@title Batch Filtering Code
+"""
+Copyright, 2021-2022 Ontocord, LLC, All rights reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Columnar versions of the filtering.py scorers, for re-filtering a JSONL/Parquet dump with new cutoffs.
+# Each batch_*_score takes a batch of texts (a pyarrow string array or a list of str) and their langs (an array or list
+# of lang codes, or one lang for the whole batch), and returns a NumPy column with the same score as the filtering.py
+# function would give each row. The texts are lowercased, split and matched with Arrow compute kernels, and the
+# per row counts are reduced with NumPy. Greedy longest word matching is sequential within a row, so we find the longest
+# match at every token with is_in over the joined k-grams, and then resolve which matches the greedy scan keeps with a
+# few vectorized passes (see _greedy_visited). CJK rows, and rows Arrow lowercases differently than Python, are scored
+# one at a time with the filtering.py functions.
+
+import numpy as np
+from .filtering import get_ngram_score, get_special_char_score, get_stopword_score, get_flaggedword_score, \
+                       lang_2_max_stopword_len, lang_2_max_flaggedword_len, all_stopwords
+from .lexicon_manager import get_lexicon
+from .char_manager import junk
+from .cjk import lang_is_cjk
+
+try:
+  import pyarrow as pa
+  import pyarrow.compute as pc
+except:
+  pa = pc = None
+
+_lower_fallback_regex = None
+
+
+def _to_arrow(texts):
+  if isinstance(texts, pa.ChunkedArray): texts = texts.combine_chunks()
+  if not isinstance(texts, pa.Array): texts = pa.array(texts, type=pa.large_string())
+  return texts
+
+
+def _char_class(chars):
+  """ an RE2 character class matching any of chars. """
+  return "[" + "".join(f"\\x{{{ord(ch):x}}}" for ch in sorted(set(chars))) + "]"
+
+
+def _get_lower_fallback_regex():
+  """ a regex of the chars that utf8_lower lowercases differently than str.lower, e.g., a final sigma, or chars of
+  a newer unicode version than python's. Rows with these are lowercased in python. """
+  global _lower_fallback_regex
+  if _lower_fallback_regex is None:
+    codepoints = np.arange(0x110000, dtype=np.uint32)
+    codepoints = codepoints[(codepoints < 0xD800) | (codepoints >= 0xE000)]
+    chars = codepoints.astype("<u4").tobytes().decode("utf-32-le")
+    lowered = pc.utf8_lower(pa.array(list(chars))).to_pylist()
+    _lower_fallback_regex = _char_class([ch for ch, low in zip(chars, lowered) if low != ch.lower()] + ["Σ"])
+  return _lower_fallback_regex
+
+
+def _lower(texts):
+  """ the same as [text.lower() for text in texts], with Arrow's utf8_lower for every row where they agree. """
+  lowered = pc.utf8_lower(texts)
+  fallback = np.flatnonzero(np.asarray(pc.match_substring_regex(texts, _get_lower_fallback_regex()).fill_null(False)))
+  if len(fallback):
+    values = lowered.to_pylist()
+    for i, text in zip(fallback.tolist(), texts.take(pa.array(fallback)).to_pylist()):
+      values[i] = text.lower()
+    lowered = pa.array(values, type=texts.type)
+  return lowered
+
+
+def _split(texts):
+  """ (flat tokens, row of each token, position of each token in its row, number of tokens of each row) for text.split() of each row """
+  tokens = pc.utf8_split_whitespace(texts)
+  flat = tokens.flatten()
+  rows = np.asarray(pc.list_parent_indices(tokens))
+  # unlike str.split(), utf8_split_whitespace gives an empty token for leading and trailing whitespace
+  nonempty = np.asarray(pc.binary_length(flat)) > 0
+  if not nonempty.all():
+    flat, rows = flat.filter(pa.array(nonempty)), rows[nonempty]
+  lengths = np.bincount(rows, minlength=len(texts))
+  positions = np.arange(len(flat)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+  return flat, rows, positions, lengths
+
+
+def _batch_by_lang(texts, langs, fn, row_fn):
+  """
+  score each group of rows with the same lang. fn(lang, texts) scores the non CJK rows of a lang as a batch,
+  and row_fn(lang, text) scores the CJK rows one at a time.
+  """
+  n = len(texts)
+  if pa is None:
+    langs = [langs]*n if isinstance(langs, str) else list(langs)
+    return np.array([row_fn(lang, text) for lang, text in zip(langs, texts)], dtype=np.float64)
+  texts = _to_arrow(texts)
+  ret = np.zeros(n, dtype=np.float64)
+  if isinstance(langs, str):
+    groups = [(langs, None)]
+  else:
+    langs = np.asarray(langs.to_pylist() if hasattr(langs, "to_pylist") else langs, dtype=object).astype(str)
+    uniq, inverse = np.unique(langs, return_inverse=True)
+    groups = [(lang, np.flatnonzero(inverse == i)) for i, lang in enumerate(uniq.tolist())]
+  for lang, idx in groups:
+    batch = texts if idx is None else texts.take(pa.array(idx))
+    if lang_is_cjk(lang):
+      scores = np.array([row_fn(lang, text) for text in batch.to_pylist()], dtype=np.float64)
+    else:
+      scores = fn(lang, batch)
+    if idx is None:
+      ret[:] = scores
+    else:
+      ret[idx] = scores
+  return ret
+
+
+def batch_special_char_score(texts, langs="en", special_characters_default=None):
+  """ get_special_char_score of each text. """
+  if special_characters_default is None: special_characters_default = junk
+  if pa is None:
+    return np.array([get_special_char_score(None, text, special_characters_default) for text in texts], dtype=np.float64)
+  texts = _to_arrow(texts)
+  counts = np.asarray(pc.count_substring_regex(texts, _char_class(special_characters_default)).fill_null(0), dtype=np.float64)
+  lengths = np.asarray(pc.utf8_length(texts).fill_null(0), dtype=np.float64)
+  return np.where(lengths > 0, counts/np.maximum(lengths, 1), 1.0)
+
+
+def _batch_ngram_score(lang, texts, window_size=3):
+  flat, rows, positions, lengths = _split(texts)
+  ids = np.asarray(pc.dictionary_encode(flat).indices, dtype=np.int64)
+  # get_ngram's windows start at 0 ... len(tokens) - window_size - 1
+  starts = np.flatnonzero(positions + window_size < lengths[rows])
+  ret = np.zeros(len(texts), dtype=np.float64)
+  if not len(starts): return ret
+  # sort the (row, token ids...) of every window, so that equal ngrams of a row are runs
+  id_bits, row_bits = int(ids.max()).bit_length(), len(texts).bit_length()
+  if window_size*id_bits + row_bits <= 63:
+    # pack the window into one int64, which sorts much faster than a lexsort of the columns
+    packed = rows[starts].astype(np.int64)
+    for k in range(window_size):
+      packed = (packed << id_bits) | ids[starts + k]
+    packed.sort()
+    new_run = np.ones(len(packed), dtype=bool)
+    new_run[1:] = packed[1:] != packed[:-1]
+    run_rows = packed[new_run] >> (window_size*id_bits)
+  else:
+    keys = [ids[starts + k] for k in range(window_size)]
+    order = np.lexsort(keys[::-1] + [rows[starts]])
+    keys = [rows[starts][order]] + [key[order] for key in keys]
+    new_run = np.ones(len(order), dtype=bool)
+    new_run[1:] = np.any([key[1:] != key[:-1] for key in keys], axis=0)
+    run_rows = keys[0][new_run]
+  run_starts = np.flatnonzero(new_run)
+  run_lengths = np.diff(np.append(run_starts, len(new_run)))
+  max_counts = np.zeros(len(texts), dtype=np.int64)
+  np.maximum.at(max_counts, run_rows, run_lengths)
+  num_spaces = np.asarray(pc.count_substring(texts, " ").fill_null(0), dtype=np.float64)
+  return max_counts/(num_spaces+1)
+
+
+def batch_ngram_score(texts, langs="en", window_size=3):
+  """ get_ngram_score of each text. """
+  return _batch_by_lang(texts, langs, lambda lang, batch: _batch_ngram_score(lang, batch, window_size), \
+                        lambda lang, text: get_ngram_score(lang, text, window_size))
+
+
+def _longest_matches(flat, rows, positions, lengths, lexicon, max_word_len):
+  """ the number of tokens of the longest word of lexicon that starts at each token, or 0. """
+  longest = np.zeros(len(flat), dtype=np.int64)
+  words_by_len = {}
+  for word in lexicon.words:
+    words_by_len.setdefault(word.count(" ")+1, []).append(word)
+  for k in range(1, max_word_len+1):
+    if k not in words_by_len or len(flat) < k: continue
+    kgrams = flat.slice(0, len(flat)-k+1)
+    if k > 1:
+      kgrams = pc.binary_join_element_wise(*[flat.slice(j, len(flat)-k+1) for j in range(k)], pa.scalar(" ", type=flat.type))
+    found = np.asarray(pc.is_in(kgrams, value_set=pa.array(words_by_len[k], type=flat.type)).fill_null(False))
+    found &= positions[:len(found)] + k <= lengths[rows[:len(found)]]
+    longest[:len(found)][found] = k
+  return longest
+
+
+def _greedy_visited(longest, max_iter=32):
+  """
+  the tokens the greedy scan of count_word_matches visits, i.e., that are not inside an earlier visited match.
+  a token is visited iff no visited token before it starts a multi token match that covers it. we start with every token
+  visited, and alternately drop the covered tokens and add back the uncovered ones until nothing changes. each pass
+  fixes at least the next token of every row, and in practice it takes a couple of passes.
+  returns (visited, converged). if it did not converge after max_iter passes, the rows with changes need the sequential scan.
+  """
+  n = len(longest)
+  visited = np.ones(n, dtype=bool)
+  multi = longest >= 2
+  for _ in range(max_iter):
+    starts = np.flatnonzero(visited & multi)
+    coverage = np.bincount(starts+1, minlength=n+1) - np.bincount(starts+longest[starts], minlength=n+1)
+    new_visited = np.cumsum(coverage[:n]) <= 0
+    if np.array_equal(new_visited, visited): return visited, np.ones(n, dtype=bool)
+    changed = new_visited != visited
+    visited = new_visited
+  return visited, ~changed
+
+
+def _batch_word_score(lang, texts, name, max_word_len):
+  lowered = _lower(texts)
+  flat, rows, positions, lengths = _split(lowered)
+  lexicon = get_lexicon(name, lang)
+  longest = _longest_matches(flat, rows, positions, lengths, lexicon, max_word_len)
+  visited, converged = _greedy_visited(longest)
+  matches = np.bincount(rows, weights=visited & (longest > 0), minlength=len(texts))
+  totals = np.bincount(rows, weights=visited, minlength=len(texts))
+  for row in np.unique(rows[~converged]).tolist():
+    matches[row], totals[row] = lexicon.count_matches(lowered[row].as_py().split(), max_word_len)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    return np.where(totals > 0, matches/np.maximum(totals, 1), np.nan)
+
+
+def batch_stopword_score(texts, langs="en", max_word_len=3, cjk_scale=1.5):
+  """ get_stopword_score of each text. empty texts, where get_stopword_score divides by zero, are nan. """
+  def score(lang, batch):
+    if not all_stopwords.get(lang): return np.ones(len(batch), dtype=np.float64)
+    return _batch_word_score(lang, batch, "stopwords", lang_2_max_stopword_len.get(lang, max_word_len))
+  return _batch_by_lang(texts, langs, score, lambda lang, text: _row_or_nan(get_stopword_score, lang, text, max_word_len, cjk_scale))
+
+
+def batch_flaggedword_score(texts, langs="en", max_word_len=3, cjk_scale=1.5):
+  """ get_flaggedword_score of each text. empty texts, where get_flaggedword_score divides by zero, are nan. """
+  def score(lang, batch):
+    if not get_lexicon("flagged_words", lang): return np.zeros(len(batch), dtype=np.float64)
+    return _batch_word_score(lang, batch, "flagged_words", lang_2_max_flaggedword_len.get(lang, max_word_len))
+  return _batch_by_lang(texts, langs, score, lambda lang, text: _row_or_nan(get_flaggedword_score, lang, text, max_word_len, cjk_scale))
+
+
+def _row_or_nan(fn, lang, text, max_word_len, cjk_scale):
+  try:
+    return fn(lang, text, max_word_len, cjk_scale)
+  except ZeroDivisionError:
+    return np.nan
+
+
+def batch_quality_scores(texts, langs="en"):
+  """ the special char, ngram, stopword and flagged word score columns of a batch of texts, as a dict of NumPy arrays. """
+  if pa is not None: texts = _to_arrow(texts)
+  return {"special_char_score": batch_special_char_score(texts, langs), "ngram_score": batch_ngram_score(texts, langs), \
+          "stopword_score": batch_stopword_score(texts, langs), "flaggedword_score": batch_flaggedword_score(texts, langs)}
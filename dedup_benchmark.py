@@ -0,0 +1,286 @@
+#@title Dedup Benchmark Code
+"""
+Copyright, 2021-2022 Ontocord, LLC, All rights reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Throughput, memory and accuracy benchmarks for the dedup code in simhash.py and minhash.py.
+# The corpora are synthetic, with near duplicates injected at known distances, so we know the true clusters:
+#  - synthetic_corpus: documents, where each near duplicate of a base document has edit_distance words replaced.
+#  - synthetic_codes: simhash codes, where each near duplicate of a base code has bit_flips bits flipped.
+#    This lets us benchmark clustering at the 1M and 10M scale without hashing that many documents.
+# run_benchmarks writes the results as json, e.g., to compare between releases.
+
+import os, sys, json, time, random, platform
+import numpy as np
+from .simhash import hashing, hashing_batch, find_all, find_clusters_union_find, index_clusters_python, index_clusters_sharded, \
+  incremental_span_and_document_neardedup
+from .minhash import minhash_batch, MinHashLSH
+from .dedup_manager import get_dup_store, cleanup_dup_store, increment_dup_store
+
+try:
+  import resource
+except:
+  resource = None
+
+
+def peak_rss_mb():
+  """ peak resident set size of this process so far, in MB. None if it can't be measured on this platform. """
+  if resource is None: return None
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # kilobytes on linux, bytes on mac
+  return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def random_words(num_words=20000, rnd=random):
+  return ["".join(rnd.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rnd.randint(2, 9))) for _ in range(num_words)]
+
+
+def synthetic_corpus(num_base_docs, dups_per_doc=2, doc_len=200, edit_distances=(0, 1, 2, 4, 8, 16), seed=0):
+  """
+  Random documents of doc_len words, each with dups_per_doc near duplicates where a random edit_distance
+  (chosen from edit_distances) of the words were replaced.
+  Returns (docs, labels, edits) where labels[i] is the base document of doc i and edits[i] the number of words replaced (-1 for a base doc).
+  """
+  rnd = random.Random(seed)
+  words = random_words(rnd=rnd)
+  docs, labels, edits = [], [], []
+  for label in range(num_base_docs):
+    base = [rnd.choice(words) for _ in range(doc_len)]
+    docs.append(" ".join(base))
+    labels.append(label)
+    edits.append(-1)
+    for _ in range(dups_per_doc):
+      edit = rnd.choice(edit_distances)
+      doc = list(base)
+      for i in rnd.sample(range(doc_len), min(edit, doc_len)):
+        doc[i] = rnd.choice(words)
+      docs.append(" ".join(doc))
+      labels.append(label)
+      edits.append(edit)
+  return docs, np.array(labels), np.array(edits)
+
+
+def synthetic_codes(num_codes, dup_rate=0.2, bit_flips=(0, 1, 2, 3), seed=0):
+  """
+  num_codes random 64 bit codes, where dup_rate of them are near duplicates of a base code with a random number of
+  bits (chosen from bit_flips) flipped.
+  Returns (codes, labels, flips) where labels[i] is the index of the base code of code i and flips[i] is the number of bits flipped (-1 for a base code).
+  """
+  rnd = np.random.default_rng(seed)
+  num_dups = int(num_codes * dup_rate)
+  num_base = num_codes - num_dups
+  codes = rnd.integers(0, 2**63, size=num_codes, dtype=np.int64).astype(np.uint64)
+  labels = np.arange(num_codes)
+  flips = np.full(num_codes, -1)
+  labels[num_base:] = rnd.integers(0, num_base, size=num_dups)
+  flips[num_base:] = rnd.choice(bit_flips, size=num_dups)
+  codes[num_base:] = codes[labels[num_base:]]
+  for k in set(bit_flips):
+    idx = np.flatnonzero(flips == k)
+    if not k or not len(idx): continue
+    # k distinct bit positions per code, from the first k of a random permutation
+    bits = np.argsort(rnd.random((len(idx), 64)), axis=1)[:, :k].astype(np.uint64)
+    codes[idx] ^= np.bitwise_or.reduce(np.uint64(1) << bits, axis=1)
+  return codes, labels, flips
+
+
+def pair_precision_recall(labels, pred_labels):
+  """ pairwise precision and recall of the predicted cluster of each doc against its true cluster, without enumerating pairs. """
+  labels, pred_labels = np.asarray(labels), np.asarray(pred_labels)
+  def num_pairs(*keys):
+    _, counts = np.unique(np.stack(keys, axis=1), axis=0, return_counts=True)
+    return int((counts * (counts - 1) // 2).sum())
+  tp = num_pairs(labels, pred_labels)
+  return tp / max(1, num_pairs(pred_labels)), tp / max(1, num_pairs(labels))
+
+
+def recall_by_distance(labels, pred_labels, distances):
+  """ for each distance, the fraction of near duplicates put in the same cluster as their base. """
+  labels, pred_labels, distances = np.asarray(labels), np.asarray(pred_labels), np.asarray(distances)
+  base_pred = np.empty(labels.max() + 1, dtype=pred_labels.dtype)
+  is_base = distances < 0
+  base_pred[labels[is_base]] = pred_labels[is_base]
+  return {int(d): float((pred_labels[distances == d] == base_pred[labels[distances == d]]).mean()) for d in np.unique(distances[~is_base])}
+
+
+def _labels_from_clusters(codes, nodes, node2cluster):
+  """ the cluster of each code from find_clusters_union_find. Unclustered codes are labeled by their code, so exact duplicates are together. """
+  node_idx = np.searchsorted(nodes, codes)
+  pred = node2cluster[node_idx].astype(np.int64)
+  singletons = pred < 0
+  pred[singletons] = -1 - node_idx[singletons]
+  return pred
+
+
+def _labels_from_hash2cluster(codes, hash2cluster):
+  """ the cluster of each code from the hash2cluster dict of index_clusters_python. Unclustered codes are labeled by their code. """
+  cluster_ids = [hash2cluster.get(code, -1) for code in codes.tolist()]
+  _, pred = np.unique(np.array([code if cluster_id == -1 else cluster_id for code, cluster_id in zip(codes.tolist(), cluster_ids)], dtype=np.uint64), return_inverse=True)
+  # cluster ids are the smallest code of the cluster, so they can't collide with the code of an unclustered code
+  return pred.astype(np.int64)
+
+
+def _result(num, secs, rss_before, **kwargs):
+  ret = {"num": num, "secs": secs, "per_sec": num / max(secs, 1e-9), "peak_rss_mb": peak_rss_mb()}
+  if rss_before is not None and ret["peak_rss_mb"] is not None:
+    ret["peak_rss_growth_mb"] = ret["peak_rss_mb"] - rss_before
+  ret.update(kwargs)
+  return ret
+
+
+def benchmark_hashing(docs, window_size=24, tokenization="character", batch_size=1000):
+  """ docs/sec of hashing() and hashing_batch(). """
+  ret = {}
+  rss = peak_rss_mb()
+  st = time.time()
+  codes = [hashing(doc, window_size=window_size, tokenization=tokenization) for doc in docs]
+  ret["hashing"] = _result(len(docs), time.time() - st, rss)
+  rss = peak_rss_mb()
+  st = time.time()
+  codes2 = []
+  for rng in range(0, len(docs), batch_size):
+    codes2.extend(hashing_batch(docs[rng:rng+batch_size], window_size=window_size, tokenization=tokenization))
+  ret["hashing_batch"] = _result(len(docs), time.time() - st, rss, same_as_hashing=list(codes2) == list(codes))
+  return ret, np.array(codes, dtype=np.uint64)
+
+
+def benchmark_clustering(codes, labels, distances, num_blocks=6, hamming_distance=3, engines=("union_find_numpy", "union_find_simhash", "sharded", "index_clusters_python")):
+  """ docs/sec, peak rss and precision/recall of each clustering engine on codes with known labels.
+  An engine that fails, e.g., union_find_simhash without the simhash extension, gets its error instead, so the other engines still run. """
+  ret = {}
+  for engine in engines:
+    rss = peak_rss_mb()
+    st = time.time()
+    try:
+      if engine.startswith("union_find_"):
+        nodes, node2cluster, _, _, _ = find_clusters_union_find(codes, find_all(codes, num_blocks, hamming_distance, engine=engine[len("union_find_"):]))
+        pred = _labels_from_clusters(codes, nodes, node2cluster)
+      elif engine == "sharded":
+        nodes, node2cluster, _, _, _ = index_clusters_sharded(codes, num_blocks, hamming_distance)
+        pred = _labels_from_clusters(codes, nodes, node2cluster)
+      elif engine == "index_clusters_python":
+        hash2cluster, _ = index_clusters_python(codes.tolist(), num_blocks, hamming_distance)
+        pred = _labels_from_hash2cluster(codes, hash2cluster)
+      else:
+        raise Exception(f"Unrecognized engine {engine}")
+    except Exception as e:
+      ret[engine] = {"error": f"{type(e).__name__}: {e}", "secs": time.time() - st}
+      continue
+    secs = time.time() - st
+    precision, recall = pair_precision_recall(labels, pred)
+    ret[engine] = _result(len(codes), secs, rss, precision=precision, recall=recall, recall_by_distance=recall_by_distance(labels, pred, distances))
+  return ret
+
+
+def benchmark_minhash(docs, labels, edits, num_perm=128, num_bands=32, threshold=0.5, window_size=5):
+  """ docs/sec, peak rss and precision/recall of minhash + LSH clustering on docs with known labels. """
+  rss = peak_rss_mb()
+  st = time.time()
+  signatures = minhash_batch(docs, num_perm=num_perm, window_size=window_size)
+  _, pairs = MinHashLSH(num_perm, num_bands, threshold).insert(signatures)
+  nodes, node2cluster, _, _, _ = find_clusters_union_find(np.arange(len(docs)), pairs)
+  secs = time.time() - st
+  pred = _labels_from_clusters(np.arange(len(docs)), nodes, node2cluster)
+  precision, recall = pair_precision_recall(labels, pred)
+  return _result(len(docs), secs, rss, precision=precision, recall=recall, recall_by_distance=recall_by_distance(labels, pred, edits))
+
+
+def benchmark_span_dedup(docs, boilerplate_sentences=20, sentences_per_doc=20, shingle_size=5, seed=0):
+  """
+  docs/sec of incremental_span_and_document_neardedup over docs made of the sentences of docs,
+  with runs of shared boilerplate sentences (cross document dups) and repeated sentences (within document dups) mixed in.
+  """
+  rnd = random.Random(seed)
+  words = " ".join(docs).split()
+  def sentence(): return " ".join(rnd.choice(words) for _ in range(rnd.randint(4, 16))) + "."
+  boilerplate = [sentence() for _ in range(boilerplate_sentences)]
+  span_docs = []
+  for doc in docs:
+    doc = doc.split()
+    sents = [" ".join(doc[i:i+12]) + "." for i in range(0, min(len(doc), 12*sentences_per_doc), 12)]
+    start = rnd.randint(0, boilerplate_sentences - shingle_size)
+    sents[rnd.randint(0, len(sents)):0] = boilerplate[start:start + rnd.randint(shingle_size, 2*shingle_size)]
+    if rnd.random() < 0.2: sents.extend(sents[:shingle_size+1])
+    span_docs.append(" ".join(sents))
+  dup_span, dup_doc = {}, {}
+  doc_is_dup = [0, 0, 0]
+  rss = peak_rss_mb()
+  st = time.time()
+  for doc in span_docs:
+    doc_is_dup[incremental_span_and_document_neardedup(dup_span, dup_doc, doc, shingle_size=shingle_size)[0]] += 1
+  return _result(len(span_docs), time.time() - st, rss, no_dups=doc_is_dup[0], partial_dups=doc_is_dup[1], full_dups=doc_is_dup[2], \
+                 chars=sum(len(doc) for doc in span_docs))
+
+
+def benchmark_dup_store_cleanup(backend="mmap", num_docs=2000, keys_per_doc=200, limit=10000, memory_budget=12*2**16, seed=0):
+  """
+  docs/sec of cleanup_dup_store after every document, as incremental_span_and_document_neardedup does, on a store
+  filling up with new keys, and the number of table slots rebuilt per new key. With the high water mark of cleanup, a
+  rebuild of the table happens once per a constant fraction of its capacity of new keys, so the slots rebuilt per key are
+  bounded by a constant (amortized_o1), instead of growing with the table when every cleanup past the limit rebuilds.
+  """
+  rnd = np.random.default_rng(seed)
+  dup_store = get_dup_store(backend, memory_budget=memory_budget)
+  tables = dup_store.stripes if backend == "shared" else [dup_store]
+  rebuilt = [0]
+  for table in tables:
+    def _rebuild(keys, counts, table=table, rebuild=table._rebuild):
+      rebuilt[0] += table.capacity
+      rebuild(keys, counts)
+    table._rebuild = _rebuild
+  rss = peak_rss_mb()
+  st = time.time()
+  cleanup_secs = 0.0
+  for _ in range(num_docs):
+    for key in rnd.integers(0, 2**63, size=keys_per_doc, dtype=np.int64).tolist():
+      increment_dup_store(dup_store, key)
+    cst = time.time()
+    cleanup_dup_store(dup_store, limit)
+    cleanup_secs += time.time() - cst
+  secs = time.time() - st
+  max_load, evict_to = tables[0].max_load, tables[0].evict_to
+  slots_per_key = rebuilt[0] / (num_docs * keys_per_doc)
+  ret = _result(num_docs, secs, rss, cleanup_secs_per_doc=cleanup_secs / num_docs, rebuilt_slots_per_key=slots_per_key, \
+                amortized_o1=slots_per_key <= 2 / (max_load * (1 - evict_to)), size=len(dup_store))
+  if backend == "shared": dup_store.unlink()
+  return ret
+
+
+def run_benchmarks(scales=(10000, 1000000, 10000000), max_text_docs=100000, output="dedup_benchmark.json", \
+                   engines=("union_find_numpy", "union_find_simhash", "sharded", "index_clusters_python"), \
+                   num_blocks=6, hamming_distance=3, window_size=24, seed=0, verbose=True):
+  """
+  Run the dedup benchmarks at each scale (number of docs) and write the results to output as json.
+  Hashing, minhash and span dedup run on min(scale, max_text_docs) synthetic documents, since they are linear in the number of docs.
+  Clustering runs on scale synthetic codes, and on the codes of the hashed documents.
+  peak_rss_mb is the peak of the whole process so far, so the growth is only meaningful for the stage that set a new peak.
+  """
+  results = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version(), "numpy": np.__version__, \
+             "platform": platform.platform(), "cpu_count": os.cpu_count(), "params": {"num_blocks": num_blocks, \
+             "hamming_distance": hamming_distance, "window_size": window_size, "max_text_docs": max_text_docs}, "scales": {}}
+  for scale in scales:
+    ret = results["scales"][str(scale)] = {}
+    num_text_docs = min(scale, max_text_docs)
+    docs, labels, edits = synthetic_corpus(max(1, num_text_docs // 3), seed=seed)
+    ret["hashing"], codes = benchmark_hashing(docs, window_size=window_size)
+    ret["clustering_docs"] = benchmark_clustering(codes, labels, edits, num_blocks, hamming_distance, engines=engines)
+    ret["minhash"] = benchmark_minhash(docs, labels, edits)
+    ret["span_dedup"] = benchmark_span_dedup(docs, seed=seed)
+    ret["dup_store_cleanup"] = {backend: benchmark_dup_store_cleanup(backend, seed=seed) for backend in ("mmap", "shared")}
+    del docs
+    codes, labels, flips = synthetic_codes(scale, seed=seed)
+    ret["clustering_codes"] = benchmark_clustering(codes, labels, flips, num_blocks, hamming_distance, engines=engines)
+    if verbose: print (scale, json.dumps(ret, indent=1))
+    if output:
+      with open(output, "w") as f:
+        json.dump(results, f, indent=1)
+  return results
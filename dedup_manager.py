@@ -0,0 +1,647 @@
+#@title Dedup Store Code
+"""
+Copyright, 2021-2022 Ontocord, LLC, All rights reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Stores for the hashcode -> count tables (dup_span, dup_doc) used by incremental_span_and_document_neardedup.
+# A dup store is anything that acts like a dict of int hashcode -> int count. A plain dict is the default backend.
+# Other backends can add a cleanup(limit) method, which is called instead of the dict pruning rule,
+# and an increment(key, by) method for stores that are updated by several processes at once.
+
+import os, json, math
+import hashlib
+import heapq
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from collections.abc import MutableMapping
+
+UINT64_MASK = 0xFFFFFFFFFFFFFFFF
+UINT32_MAX = 0xFFFFFFFF
+DUP_STORE_SLOT = np.dtype([("key", "<u8"), ("count", "<u4")])
+
+
+def cleanup_dup_store(dup_store, limit):
+  """ prune a dup store once it has more than limit keys.
+  dicts drop every hashcode seen only once, other backends decide for themselves via cleanup(limit). """
+  if hasattr(dup_store, "cleanup"):
+    dup_store.cleanup(limit)
+  elif len(dup_store) > limit:
+    for key, val in list(dup_store.items()):
+      if val <= 1: del dup_store[key]
+
+
+def increment_dup_store(dup_store, key, by=1):
+  """ dup_store[key] += by, starting from 0 for a new key. returns the new count.
+  the update is atomic for stores shared between processes (see SharedDupStore). """
+  if hasattr(dup_store, "increment"):
+    return dup_store.increment(key, by)
+  count = dup_store.get(key, 0) + by
+  dup_store[key] = count
+  return count
+
+
+def get_dup_store(backend="dict", path=None, memory_budget=256*1024**2, **kwargs):
+  """ factory for the dup_span/dup_doc backends. backend is one of "dict", "mmap", "cms" or "shared".
+  for "cms", path is a directory (see CountMinSketch). "shared" ignores path (see SharedDupStore). """
+  if backend == "dict":
+    return {}
+  elif backend == "mmap":
+    return MmapDupStore(path, memory_budget=memory_budget, **kwargs)
+  elif backend == "cms":
+    return CountMinSketch(path, memory_budget=memory_budget, **kwargs)
+  elif backend == "shared":
+    return SharedDupStore(memory_budget=memory_budget, **kwargs)
+  raise Exception(f"Unrecognized dup store backend {backend}")
+
+
+class MmapDupStore(MutableMapping):
+    """
+    An open addressing (linear probing) hash table of uint64 hashcode -> uint32 count stored in a memory mapped .npy file.
+    A slot with count 0 is empty, so any uint64 can be a key.
+    path: the .npy file to keep the table in. If it exists, the table (and thus the dedup state) is reloaded.
+      If None, the table lives in anonymous memory and is not persisted.
+    memory_budget: bytes to use for the table. The number of slots is the largest power of 2 that fits (12 bytes per slot).
+    max_load: fraction of slots that may be used before we evict.
+    evict_to: fraction of slots to keep after an eviction. We evict the lowest counts first,
+      i.e., the hashcodes seen once, then twice, and so on until we are at evict_to.
+    table, size: an existing DUP_STORE_SLOT array (with a power of 2 length) and a 1 element int64 array with its number
+      of keys, to use instead of path, e.g., views into shared memory (see SharedDupStore).
+    """
+    def __init__(self, path=None, memory_budget=256*1024**2, max_load=0.7, evict_to=0.5, table=None, size=None):
+        self.path = path
+        self.max_load = max_load
+        self.evict_to = evict_to
+        if table is not None:
+          self.table = table
+        elif path is not None and os.path.exists(path):
+          self.table = np.load(path, mmap_mode="r+")
+          assert self.table.dtype == DUP_STORE_SLOT, f"{path} is not a dup store"
+        else:
+          capacity = 1 << max(4, int(np.log2(max(16, memory_budget // DUP_STORE_SLOT.itemsize))))
+          if path is not None:
+            if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.table = np.lib.format.open_memmap(path, mode="w+", dtype=DUP_STORE_SLOT, shape=(capacity,))
+          else:
+            self.table = np.zeros(capacity, dtype=DUP_STORE_SLOT)
+        self.capacity = len(self.table)
+        self.mask = self.capacity - 1
+        self.shift = 64 - int(np.log2(self.capacity))
+        self.keys = self.table["key"]
+        self.counts = self.table["count"]
+        if size is None:
+          self._size = np.zeros(1, dtype=np.int64)
+          self.size = int(np.count_nonzero(self.counts))
+        else:
+          self._size = size
+
+    @property
+    def size(self):
+        return int(self._size[0])
+
+    @size.setter
+    def size(self, val):
+        self._size[0] = val
+
+    def _home(self, key):
+        # fibonacci hashing, since the simhash codes are not uniform in the low bits
+        return ((key * 0x9E3779B97F4A7C15) & UINT64_MASK) >> self.shift
+
+    def _find(self, key):
+        """ returns the slot of key, or the empty slot where key would go. """
+        keys, counts, mask = self.keys, self.counts, self.mask
+        i = self._home(key)
+        while counts[i] and keys[i] != key:
+          i = (i + 1) & mask
+        return i
+
+    def __contains__(self, key):
+        return bool(self.counts[self._find(key & UINT64_MASK)])
+
+    def __getitem__(self, key):
+        i = self._find(key & UINT64_MASK)
+        if not self.counts[i]: raise KeyError(key)
+        return int(self.counts[i])
+
+    def get(self, key, default=None):
+        i = self._find(key & UINT64_MASK)
+        return int(self.counts[i]) if self.counts[i] else default
+
+    def __setitem__(self, key, val):
+        if val <= 0:
+          if key in self: del self[key]
+          return
+        key = key & UINT64_MASK
+        i = self._find(key)
+        if not self.counts[i]:
+          if self.size + 1 > self.max_load * self.capacity:
+            self.evict()
+            i = self._find(key)
+          self.size += 1
+          self.keys[i] = key
+        self.counts[i] = min(val, UINT32_MAX)
+
+    def __delitem__(self, key):
+        keys, counts, mask = self.keys, self.counts, self.mask
+        i = self._find(key & UINT64_MASK)
+        if not counts[i]: raise KeyError(key)
+        # backward shift deletion, so we don't need tombstones
+        j = i
+        while True:
+          counts[i] = 0
+          while True:
+            j = (j + 1) & mask
+            if not counts[j]:
+              self.size -= 1
+              return
+            home = self._home(int(keys[j]))
+            # move j back into the hole at i unless j's home lies cyclically in (i, j]
+            if (i <= j and (home <= i or home > j)) or (i > j and home <= i and home > j):
+              break
+          keys[i], counts[i] = keys[j], counts[j]
+          i = j
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for i in np.flatnonzero(self.counts).tolist():
+          yield int(self.keys[i])
+
+    def items(self):
+        idx = np.flatnonzero(self.counts)
+        return list(zip(self.keys[idx].tolist(), self.counts[idx].tolist()))
+
+    def high_water_mark(self, limit):
+        """ the number of keys above which cleanup(limit) evicts. the table is sized by memory_budget, so a limit below
+        max_load of the capacity doesn't shrink it. """
+        return max(limit, int(self.max_load * self.capacity))
+
+    def cleanup(self, limit):
+        """ evict once there are more keys than the high water mark, down to evict_to of it, so that a cleanup after every
+        document only rebuilds the table once per (1-evict_to) * high water mark new keys. """
+        high_water = self.high_water_mark(limit)
+        if self.size > high_water:
+          self.evict(target=int(self.evict_to * high_water))
+
+    def evict(self, target=None):
+        """ drop the least seen hashcodes until at most target are left, then rebuild the table. """
+        if target is None: target = int(self.evict_to * self.capacity)
+        idx = np.flatnonzero(self.counts)
+        keys, counts = self.keys[idx].copy(), self.counts[idx].copy()
+        if len(keys) > target:
+          # keep the target highest counts. ties at the cutoff count are broken at random: breaking them by slot order
+          # would keep the keys of one end of the table, which then probes through a few long runs.
+          shuffle = np.random.default_rng(self.size).permutation(len(keys))
+          keys, counts = keys[shuffle], counts[shuffle]
+          keep = np.argpartition(counts, len(keys) - target, kind="introselect")[len(keys) - target:]
+          keys, counts = keys[keep], counts[keep]
+        self._rebuild(keys, counts)
+
+    def _rebuild(self, keys, counts):
+        self.counts[:] = 0
+        self.size = 0
+        if not len(keys): return
+        homes = ((keys * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(self.shift)).astype(np.int64)
+        order = np.argsort(homes, kind="stable")
+        keys, counts, homes = keys[order], counts[order], homes[order]
+        # with linear probing, the i-th key in home order lands at i + max_{j<=i}(home_j - j).
+        # we run over the keys twice so the run that wraps past the end of the table pushes on the start of the table.
+        n = len(keys)
+        homes2 = np.concatenate([homes, homes + self.capacity])
+        idx = np.arange(2*n)
+        pos = (idx + np.maximum.accumulate(homes2 - idx))[n:] % self.capacity
+        if len(np.unique(pos)) == n:
+          self.keys[pos] = keys
+          self.counts[pos] = counts
+          self.size = n
+        else:
+          for key, count in zip(keys.tolist(), counts.tolist()):
+            self[key] = count
+
+    def flush(self):
+        if isinstance(self.table, np.memmap):
+          self.table.flush()
+
+    def close(self):
+        self.flush()
+        self.table = self.keys = self.counts = None
+
+
+
+class SharedDupStore(MutableMapping):
+    """
+    A dup store in multiprocessing.shared_memory, so that all the worker processes of a job read and update one
+    hashcode -> count table, and a span or document seen by one worker is a dup in all the others.
+    The table is split into num_stripes MmapDupStore sub tables, each guarded by its own multiprocessing.Lock.
+    A key always goes to the same stripe (picked with a different hash than the slot within the stripe), and probing never
+    leaves a stripe, so an update only locks 1/num_stripes of the table and workers rarely wait on each other.
+    Use increment (or dedup_manager.increment_dup_store) instead of store[key] += 1, which is not atomic across processes.
+    Create the store in the parent process and pass it to the workers as a Process arg (the locks can only be shared
+    when a process is started). The parent calls unlink() when all the workers are done.
+    memory_budget, max_load, evict_to: see MmapDupStore. max_load and evict_to apply to each stripe.
+    """
+    def __init__(self, memory_budget=256*1024**2, num_stripes=64, max_load=0.7, evict_to=0.5):
+        capacity = 1 << max(4, int(np.log2(max(16, memory_budget // DUP_STORE_SLOT.itemsize))))
+        num_stripes = 1 << int(np.log2(max(1, min(num_stripes, capacity // 16))))
+        self.num_stripes = num_stripes
+        self.stripe_capacity = capacity // num_stripes
+        self.max_load = max_load
+        self.evict_to = evict_to
+        self.locks = [multiprocessing.Lock() for _ in range(num_stripes)]
+        self.shm = shared_memory.SharedMemory(create=True, size=8*num_stripes + DUP_STORE_SLOT.itemsize*capacity)
+        self._attach()
+        self.sizes[:] = 0
+        self.table["count"] = 0
+
+    def _attach(self):
+        self.stripe_shift = 64 - int(np.log2(self.num_stripes))
+        self.sizes = np.ndarray((self.num_stripes,), dtype=np.int64, buffer=self.shm.buf)
+        self.table = np.ndarray((self.num_stripes*self.stripe_capacity,), dtype=DUP_STORE_SLOT, buffer=self.shm.buf, offset=8*self.num_stripes)
+        self.stripes = [MmapDupStore(max_load=self.max_load, evict_to=self.evict_to, \
+                                     table=self.table[s*self.stripe_capacity:(s+1)*self.stripe_capacity], size=self.sizes[s:s+1]) \
+                        for s in range(self.num_stripes)]
+
+    def __getstate__(self):
+        return {"name": self.shm.name, "num_stripes": self.num_stripes, "stripe_capacity": self.stripe_capacity, \
+                "max_load": self.max_load, "evict_to": self.evict_to, "locks": self.locks}
+
+    def __setstate__(self, state):
+        self.__dict__.update({k: v for k, v in state.items() if k != "name"})
+        self.shm = shared_memory.SharedMemory(name=state["name"])
+        self._attach()
+
+    def _stripe(self, key):
+        s = ((key * 0xC2B2AE3D27D4EB4F) & UINT64_MASK) >> self.stripe_shift if self.num_stripes > 1 else 0
+        return self.locks[s], self.stripes[s]
+
+    def __contains__(self, key):
+        lock, stripe = self._stripe(key & UINT64_MASK)
+        with lock:
+          return key in stripe
+
+    def __getitem__(self, key):
+        lock, stripe = self._stripe(key & UINT64_MASK)
+        with lock:
+          return stripe[key]
+
+    def get(self, key, default=None):
+        lock, stripe = self._stripe(key & UINT64_MASK)
+        with lock:
+          return stripe.get(key, default)
+
+    def __setitem__(self, key, val):
+        lock, stripe = self._stripe(key & UINT64_MASK)
+        with lock:
+          stripe[key] = val
+
+    def __delitem__(self, key):
+        lock, stripe = self._stripe(key & UINT64_MASK)
+        with lock:
+          del stripe[key]
+
+    def increment(self, key, by=1):
+        """ atomic store[key] += by, starting from 0 for a new key. returns the new count. """
+        lock, stripe = self._stripe(key & UINT64_MASK)
+        with lock:
+          count = stripe.get(key, 0) + by
+          stripe[key] = count
+          return count
+
+    def __len__(self):
+        return int(self.sizes.sum())
+
+    def __iter__(self):
+        for key, _ in self.items():
+          yield key
+
+    def items(self):
+        ret = []
+        for lock, stripe in zip(self.locks, self.stripes):
+          with lock:
+            ret.extend(stripe.items())
+        return ret
+
+    def cleanup(self, limit):
+        """ cleanup(limit // num_stripes) of each stripe that is over its high water mark (see MmapDupStore.cleanup).
+        the sizes are checked without locking, so a cleanup that has nothing to evict doesn't wait on the other workers. """
+        stripe_limit = limit // self.num_stripes
+        for lock, stripe in zip(self.locks, self.stripes):
+          if stripe.size > stripe.high_water_mark(stripe_limit):
+            with lock:
+              stripe.cleanup(stripe_limit)
+
+    def close(self):
+        """ detach this process from the shared memory. the table stays alive for the other processes. """
+        if self.shm is None: return
+        self.stripes = self.table = self.sizes = None
+        self.shm.close()
+        self.shm = None
+
+    def unlink(self):
+        """ free the shared memory. call once, from the process that created the store, after the workers are done. """
+        shm = self.shm
+        self.close()
+        if shm is not None: shm.unlink()
+
+
+# odd multipliers for the multiply-shift hash of each row of a CountMinSketch
+_CMS_ROW_MULTIPLIERS = [0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93,
+                        0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53, 0x94D049BB133111EB, 0xBF58476D1CE4E5B9]
+
+
+class CountMinSketch:
+    """
+    A fixed size, approximate hashcode -> count store (Cormode and Muthukrishnan, 2005) for dup_span, 
+    so the memory per worker does not grow with the size of the crawl.
+    The counts are a (depth, width) uint32 array. Each row maps a key to one counter with a multiply-shift hash. 
+    We use conservative update: setting key to val raises only the counters of key that are below val.
+    The count of a key is the min of its counters, which is never lower than the true count.
+    
+    Error: with n distinct keys, a key that was never added is reported as seen (in the sketch, with a count >= 1) 
+      with probability about (1 - exp(-n/width))^depth, e.g., 2^24 counters per row, 4 rows, 10M distinct shingles 
+      gives ~0.8%. More generally, a count is over estimated by more than e*N/width with probability at most exp(-depth), 
+      where N is the sum of all counts.
+    heavy_hitters: the number of keys with the highest counts that are also kept in an exact dict, 
+      so the most common shingles (boilerplate) have exact counts. 
+    path: a directory to save the sketch to on flush(). If it already has a sketch, it is reloaded.
+    memory_budget: bytes to use for the counters if width is not given. width is rounded down to a power of 2.
+    Sketches with the same width and depth, e.g., from different worker processes, can be combined with merge().
+    """
+    def __init__(self, path=None, memory_budget=256*1024**2, width=None, depth=4, heavy_hitters=10000):
+        assert 1 <= depth <= len(_CMS_ROW_MULTIPLIERS), f"depth must be between 1 and {len(_CMS_ROW_MULTIPLIERS)}"
+        self.path = path
+        self.heavy_hitters = heavy_hitters
+        if path is not None and os.path.exists(os.path.join(path, "config.json")):
+          with open(os.path.join(path, "config.json")) as f:
+            config = json.load(f)
+          width, depth, self.heavy_hitters = config["width"], config["depth"], config["heavy_hitters"]
+          self.size, self.total = config["size"], config["total"]
+          self.table = np.load(os.path.join(path, "table.npy"))
+          heavy = np.load(os.path.join(path, "heavy.npy"))
+          self.heavy = dict(zip(heavy["key"].tolist(), heavy["count"].tolist()))
+        else:
+          if width is None: width = max(16, memory_budget // (4 * depth))
+          width = 1 << int(np.log2(width))
+          self.table = np.zeros((depth, width), dtype=np.uint32)
+          self.heavy = {}
+          self.size = 0
+          self.total = 0
+        self.width, self.depth = width, depth
+        self.shift = 64 - int(np.log2(width))
+        self.multipliers = _CMS_ROW_MULTIPLIERS[:depth]
+        self._heavy_heap = [(count, key) for key, count in self.heavy.items()]
+        heapq.heapify(self._heavy_heap)
+
+    def _positions(self, key):
+        shift = self.shift
+        return [((key * m) & UINT64_MASK) >> shift for m in self.multipliers]
+
+    def positions(self, keys):
+        """ (depth, len(keys)) array of the counter of each key in each row. """
+        keys = np.asarray(keys, dtype=np.uint64)
+        return np.stack([(keys * np.uint64(m)) >> np.uint64(self.shift) for m in self.multipliers]).astype(np.int64)
+
+    def estimate(self, key):
+        """ the count of key. 0 if it was (certainly) never added. """
+        key = key & UINT64_MASK
+        count = self.heavy.get(key)
+        if count is not None: return count
+        table = self.table
+        return int(min(table[r, p] for r, p in enumerate(self._positions(key))))
+
+    def estimate_batch(self, keys):
+        """ the sketch estimate of each key in an array of keys. Does not look at the heavy hitters. """
+        return self.table[np.arange(self.depth)[:, None], self.positions(keys)].min(axis=0)
+
+    def __contains__(self, key):
+        return self.estimate(key) > 0
+
+    def __getitem__(self, key):
+        count = self.estimate(key)
+        if not count: raise KeyError(key)
+        return count
+
+    def get(self, key, default=None):
+        count = self.estimate(key)
+        return count if count else default
+
+    def __setitem__(self, key, val):
+        key = key & UINT64_MASK
+        val = min(int(val), UINT32_MAX)
+        table = self.table
+        est = UINT32_MAX
+        for r, p in enumerate(self._positions(key)):
+          c = int(table[r, p])
+          if c < val: table[r, p] = val
+          if c < est: est = c
+        if not est: self.size += 1
+        if val > est: self.total += val - est
+        self._update_heavy(key, val)
+
+    def __delitem__(self, key):
+        # counters are shared between keys, so we can only forget the exact count
+        self.heavy.pop(key & UINT64_MASK, None)
+
+    def __len__(self):
+        """ the approximate number of distinct keys added. """
+        return self.size
+
+    def _update_heavy(self, key, val):
+        heavy = self.heavy
+        if key in heavy or len(heavy) < self.heavy_hitters:
+          heavy[key] = val
+        else:
+          # drop stale heap entries, whose key was evicted or has a newer count
+          heap = self._heavy_heap
+          while heap and heavy.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+          if not heap or val <= heap[0][0]: return
+          del heavy[heapq.heappop(heap)[1]]
+          heavy[key] = val
+        heapq.heappush(self._heavy_heap, (val, key))
+        if len(self._heavy_heap) > 4 * max(16, self.heavy_hitters):
+          self._heavy_heap = [(count, key) for key, count in heavy.items()]
+          heapq.heapify(self._heavy_heap)
+
+    def top(self, k=None):
+        """ the heavy hitters as a list of (key, count), highest count first. """
+        return sorted(self.heavy.items(), key=lambda a: a[1], reverse=True)[:k]
+
+    def items(self):
+        # the sketch does not keep its keys, so only the heavy hitters can be listed
+        return list(self.heavy.items())
+
+    def cleanup(self, limit):
+        # the memory is fixed, so there is nothing to prune
+        pass
+
+    def merge(self, other):
+        """ add the counts of another sketch of the same width and depth to this one. 
+        The heavy hitters of both are combined. A key that is a heavy hitter in only one sketch gets 
+        the other sketch's estimate of its count added, and the top heavy_hitters keys are kept. """
+        assert self.table.shape == other.table.shape, "can only merge sketches with the same width and depth"
+        keys = list(set(self.heavy) | set(other.heavy))
+        if keys:
+          karr = np.array(keys, dtype=np.uint64)
+          mine, theirs = self.estimate_batch(karr).tolist(), other.estimate_batch(karr).tolist()
+          counts = [min(UINT32_MAX, self.heavy.get(key, a) + other.heavy.get(key, b)) for key, a, b in zip(keys, mine, theirs)]
+        np.minimum(self.table.astype(np.uint64) + other.table, UINT32_MAX, out=self.table, casting="unsafe")
+        self.size += other.size
+        self.total += other.total
+        self.heavy = {}
+        if keys:
+          self.heavy = dict(sorted(zip(keys, counts), key=lambda a: a[1], reverse=True)[:self.heavy_hitters])
+        self._heavy_heap = [(count, key) for key, count in self.heavy.items()]
+        heapq.heapify(self._heavy_heap)
+        return self
+
+    def save(self, path):
+        """ save the sketch as .npy files in the directory path. """
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "config.json"), "w") as f:
+          json.dump({"width": self.width, "depth": self.depth, "heavy_hitters": self.heavy_hitters, "size": self.size, "total": self.total}, f)
+        np.save(os.path.join(path, "table.npy"), self.table)
+        heavy = np.zeros(len(self.heavy), dtype=DUP_STORE_SLOT)
+        heavy["key"] = list(self.heavy.keys())
+        heavy["count"] = list(self.heavy.values())
+        np.save(os.path.join(path, "heavy.npy"), heavy)
+
+    @classmethod
+    def load(cls, path):
+        return cls(path)
+
+    def flush(self):
+        if self.path is not None:
+          self.save(self.path)
+
+    def close(self):
+        self.flush()
+
+
+def content_digest(text):
+  """ 128 bit md5 digest of the whitespace normalized text, for exact duplicate detection. """
+  return hashlib.md5(" ".join(text.split()).encode("utf8", errors="ignore")).digest()
+
+
+def is_exact_dup(exact_dup_store, text):
+  """
+  Returns True if the whitespace normalized text was seen before, and records it as seen.
+  exact_dup_store is a (Scalable)BloomFilter, which uses the whole 128 bit digest, 
+  or any dup store (dict, MmapDupStore, SharedDupStore), which is keyed by the first 64 bits of the digest.
+  The check and the update are one atomic increment, so two processes sharing a SharedDupStore can't both see a text as new.
+  """
+  digest = content_digest(text)
+  if hasattr(exact_dup_store, "add"):
+    return exact_dup_store.add(digest)
+  return increment_dup_store(exact_dup_store, int.from_bytes(digest[:8], "big")) > 1
+
+
+def get_exact_dup_store(backend="bloom", path=None, memory_budget=256*1024**2, initial_capacity=1000000, error_rate=0.001):
+  """ factory for the exact duplicate stores. backend is one of "bloom" (a ScalableBloomFilter, reloaded from the path dir if it exists), 
+  "dict", "mmap", "shared" (see get_dup_store) or None for no exact dedup. A "shared" store must be created before
+  forking the processes that share it, and unlinked by its creator. """
+  if backend is None:
+    return None
+  elif backend == "bloom":
+    if path is not None and os.path.exists(os.path.join(path, "config.json")):
+      return ScalableBloomFilter.load(path)
+    return ScalableBloomFilter(initial_capacity, error_rate)
+  return get_dup_store(backend, path=path, memory_budget=memory_budget)
+
+
+class BloomFilter:
+    """
+    A bloom filter over 128 bit digests (bytes), with its bits in a NumPy uint8 array.
+    The num_hashes bit positions are derived from the two 64 bit halves of the digest (Kirsch and Mitzenmacher), 
+    so adding and checking costs no extra hashing.
+    capacity: the number of items for which the false positive rate is error_rate.
+    """
+    def __init__(self, capacity=1000000, error_rate=0.001, bits=None, num_hashes=None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        num_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_bits = (num_bits + 7) // 8 * 8
+        self.num_hashes = num_hashes or max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = np.zeros(self.num_bits // 8, dtype=np.uint8) if bits is None else bits
+        self.count = 0
+
+    def _positions(self, digest):
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, digest):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(digest))
+
+    def add(self, digest):
+        """ add a digest. returns True if it was (probably) already in the filter. """
+        bits = self.bits
+        found = True
+        for p in self._positions(digest):
+          mask = 1 << (p & 7)
+          if not bits[p >> 3] & mask:
+            found = False
+            bits[p >> 3] |= mask
+        if not found: self.count += 1
+        return found
+
+
+class ScalableBloomFilter:
+    """
+    A bloom filter that grows as items are added (Almeida et al., Scalable Bloom Filters, 2007).
+    When the current filter reaches its capacity, a new filter with growth times the capacity and 
+    error_ratio times the error rate is added, so the overall false positive rate stays under error_rate.
+    """
+    def __init__(self, initial_capacity=1000000, error_rate=0.001, growth=2, error_ratio=0.5):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.error_ratio = error_ratio
+        self.filters = []
+
+    def __len__(self):
+        return sum(f.count for f in self.filters)
+
+    def __contains__(self, digest):
+        return any(digest in f for f in self.filters)
+
+    def add(self, digest):
+        """ add a digest. returns True if it was (probably) already seen. """
+        if digest in self:
+          return True
+        if not self.filters or self.filters[-1].count >= self.filters[-1].capacity:
+          n = len(self.filters)
+          self.filters.append(BloomFilter(self.initial_capacity * self.growth ** n, self.error_rate * (1 - self.error_ratio) * self.error_ratio ** n))
+        self.filters[-1].add(digest)
+        return False
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        config = {"initial_capacity": self.initial_capacity, "error_rate": self.error_rate, "growth": self.growth, "error_ratio": self.error_ratio, \
+                  "filters": [{"capacity": f.capacity, "error_rate": f.error_rate, "num_hashes": f.num_hashes, "count": f.count} for f in self.filters]}
+        with open(os.path.join(path, "config.json"), "w") as f:
+          json.dump(config, f)
+        for i, f in enumerate(self.filters):
+          np.save(os.path.join(path, f"bits_{i}.npy"), f.bits)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "config.json")) as f:
+          config = json.load(f)
+        ret = cls(config["initial_capacity"], config["error_rate"], config["growth"], config["error_ratio"])
+        for i, c in enumerate(config["filters"]):
+          f = BloomFilter(c["capacity"], c["error_rate"], bits=np.load(os.path.join(path, f"bits_{i}.npy")), num_hashes=c["num_hashes"])
+          f.count = c["count"]
+          ret.filters.append(f)
+        return ret
@@ -14,28 +14,73 @@ limitations under the License.
 
 #adapted from https://github.com/piisa/muliwai/blob/main/preprocess_manager.py, and
 
-from .stopwords import all_stopwords
-from .flagged_words import flagged_words
+from .lexicon_manager import get_lexicon, get_word_lang_index, MaxWordLens, all_stopwords, flagged_words
 from .char_manager import *
 from .cjk import *
 
+import os, json, math
+import bisect
 from collections import Counter
+import numpy as np
 def get_ngram(text, window_size=3, lang="en"):
   if lang_is_cjk(lang):
     tokens = text
     ret= ["".join(tokens[i : i + window_size])   for i in range(len(tokens) - window_size)]
   else:
     tokens = text.split()
-  ret= [" ".join(tokens[i : i + window_size])   for i in range(len(tokens) - window_size)]
+    ret= [" ".join(tokens[i : i + window_size])   for i in range(len(tokens) - window_size)]
   return Counter(ret)
 
+
+#below this many windows, a Counter of tuples is faster than numpy
+ngram_numpy_min_windows = 512
+
+def get_ngram_counts(tokens, window_size=3):
+  """
+  the counts of the distinct ngrams of tokens (a list of str, or a str of CJK chars), over the same windows as get_ngram,
+  as an int64 array in no particular order. Long inputs are mapped to token ids (the codepoints of a str), and the ids of each
+  window are packed into one int64 key, which numpy sorts and counts in one pass.
+  """
+  num_windows = len(tokens)-window_size
+  if num_windows <= 0: return np.zeros(0, dtype=np.int64)
+  if num_windows < ngram_numpy_min_windows:
+    ngrams = Counter(zip(*[tokens[k:len(tokens)-1] for k in range(window_size)]))
+    return np.fromiter(ngrams.values(), dtype=np.int64, count=len(ngrams))
+  if isinstance(tokens, str):
+    ids = np.frombuffer(tokens.encode("utf-32-le", errors="surrogatepass"), dtype=np.uint32).astype(np.int64)
+  else:
+    vocab = dict(zip(dict.fromkeys(tokens), range(len(tokens))))
+    ids = np.fromiter(map(vocab.__getitem__, tokens), dtype=np.int64, count=len(tokens))
+  bits = max(int(ids.max()).bit_length(), 1)
+  if bits*window_size <= 63:
+    keys = ids[:num_windows].copy()
+    for k in range(1, window_size):
+      keys = (keys << bits) | ids[k:k+num_windows]
+    keys.sort()
+    run_starts = np.ones(num_windows+1, dtype=bool)
+    np.not_equal(keys[1:], keys[:-1], out=run_starts[1:-1])
+    return np.diff(np.flatnonzero(run_starts))
+  windows = np.stack([ids[k:k+num_windows] for k in range(window_size)], axis=1)
+  return np.unique(windows, axis=0, return_counts=True)[1]
+
+
+def get_ngram_scores(lang, text, window_size=3, top_k=1):
+  """ the top_k ngram repetition fractions of text (the counts of its most common ngrams divided by the number of words), in descending order. """
+  counts = get_ngram_counts(text if lang_is_cjk(lang) else text.split(), window_size)
+  if len(counts) > top_k:
+    counts = np.partition(counts, len(counts)-top_k)[len(counts)-top_k:]
+  return np.sort(counts)[::-1]/(text.count(" ")+1)
+
+
 def get_ngram_score(lang, text, window_size=3):
-  aHash = get_ngram(text, window_size, lang)
-  text_len = text.count(" ")+1
-  for key in list(aHash.keys()):
-    aHash[key] = aHash[key]/text_len
-  if not aHash: return 0.0
-  return aHash.most_common(1)[0][1]
+  scores = get_ngram_scores(lang, text, window_size)
+  if not len(scores): return 0.0
+  return float(scores[0])
+
+
+def high_ngram(text, lang="en", ngram_score_cutoff=0.8, window_size=3):
+  """ whether text repeats an ngram too often, e.g., a degenerate translation that loops. """
+  return get_ngram_score(lang, text, window_size) >= ngram_score_cutoff
   
 def get_special_char_score (lang, text, special_characters_default=None):
   global junk
@@ -45,95 +90,295 @@ def get_special_char_score (lang, text, special_characters_default=None):
   return len([a for a in text if a in special_characters_default])/len(text)
 
 
-lang_2_max_stopword_len = dict([(lang, max(s.count(" ")+1 if not lang_is_cjk(lang) else len(s) for s in arr)) for lang, arr in all_stopwords.items()])
+def get_nonspace_special_char_score(text, char_counts=None, special_characters_default=None):
+  """ the fraction of special chars among the non whitespace chars of text, the same as 
+  QualitySignals.nonspace_special_char_score. It doesn't depend on the lang, so it can be used to reject a text before 
+  the lang id. char_counts: Counter(text), if already counted; pass it on to compute_quality_signals too. """
+  if special_characters_default is None: special_characters_default = junk
+  if char_counts is None: char_counts = Counter(text)
+  nonspace_special_cnt = sum(cnt for ch, cnt in char_counts.items() if ch in special_characters_default and not ch.isspace())
+  char_count = len(text) - sum(cnt for ch, cnt in char_counts.items() if ch.isspace())
+  return nonspace_special_cnt/char_count if char_count else 1
+
+
+#the stopword and flagged word scores count greedy longest matches of the word lists, starting at each token
+#(each char for CJK) that is not part of an earlier match. The matching walks the trie of the lang's lexicon from
+#lexicon_manager, which is built once and shared by all the scorers.
+lang_2_max_stopword_len = MaxWordLens("stopwords")
 
 def get_stopword_score(lang, text, max_word_len=3, cjk_scale=1.5):
     is_cjk = lang_is_cjk(lang)
-    stopwords =  all_stopwords.get(lang, {})
-    if not stopwords: return 1
+    if not all_stopwords.get(lang): return 1
+    stopwords = get_lexicon("stopwords", lang)
     text = text.lower().strip()
     if is_cjk: 
-      s_arr = list("".join(text.split())) 
+      s_arr = "".join(text.split())
     else: 
       s_arr = text.split()
     word_len = lang_2_max_stopword_len.get(lang, max_word_len)
-    len_s = len(s_arr)
-    stop_cnt = 0
-    total_cnt = 0
-    for i in range(len_s):
-      if s_arr[i] is None: continue
-      for j in range(min(len_s, i+word_len), i, -1):
-        word = "".join(s_arr[i:j]) if is_cjk else " ".join(s_arr[i:j])
-        if word in stopwords:
-          stop_cnt += 1
-          s_arr[i] = "".join(s_arr[i:j]) if is_cjk else " ".join(s_arr[i:j]) 
-          for k in range(i+1, j):
-            s_arr[k] = None
-          break
-      total_cnt += 1
+    stop_cnt, total_cnt = stopwords.count_matches(s_arr, word_len)
     stopword_score =  (stop_cnt/total_cnt) 
     if is_cjk: stopword_score = stopword_score*cjk_scale
     return (stopword_score)
 
 
+def iter_stopword_scores(text, langs=None, max_word_len=3, cjk_scale=1.5):
+  """
+  yields (lang, get_stopword_score(lang, text)) for each of langs (default every lang of all_stopwords), lowercasing and
+  splitting text only once, e.g., to guess the lang of a text from its stopwords.
+  """
+  text = text.lower().strip()
+  tokens = text.split()
+  chars = "".join(tokens)
+  for lang in (all_stopwords if langs is None else langs):
+    if not all_stopwords.get(lang):
+      yield lang, 1
+      continue
+    is_cjk = lang_is_cjk(lang)
+    stop_cnt, total_cnt = get_lexicon("stopwords", lang).count_matches(chars if is_cjk else tokens, lang_2_max_stopword_len.get(lang, max_word_len))
+    stopword_score =  (stop_cnt/total_cnt)
+    if is_cjk: stopword_score = stopword_score*cjk_scale
+    yield lang, stopword_score
+
+
+def first_stopword_lang(text, min_score=0.2, max_word_len=3, cjk_scale=1.5):
+  """
+  the first lang of all_stopwords whose get_stopword_score of text is above min_score, and its score, or (None, None).
+  The same as scanning iter_stopword_scores(text), but a lang is only scored if the upper bound of its score from one pass
+  over the WordLangIndex of the stopwords is above min_score, which rules out most langs.
+  """
+  lowered = text.lower().strip()
+  tokens = lowered.split()
+  if not tokens:
+    #every score divides by zero, as in get_stopword_score
+    langs = None
+  else:
+    index = get_word_lang_index("stopwords")
+    bounds = index.upper_bounds(tokens, "".join(tokens))
+    bounds[index.is_cjk] *= cjk_scale
+    langs = [index.langs[i] for i in np.flatnonzero((bounds > min_score) | index.is_empty).tolist()]
+  for lang, stopword_score in iter_stopword_scores(text, langs, max_word_len, cjk_scale):
+    if stopword_score > min_score:
+      return lang, stopword_score
+  return None, None
+
+
     
-lang_2_max_flaggedword_len = dict([(lang, max(s.count(" ")+1 if not lang_is_cjk(lang) else len(s) for s in arr)) for lang, arr in flagged_words.items()])
+lang_2_max_flaggedword_len = MaxWordLens("flagged_words")
 
 def get_flaggedword_score(lang, text, max_word_len=3, cjk_scale=1.5):
     is_cjk = lang_is_cjk(lang)
-    flaggedwords =  flagged_words.get(lang, set())
-    en_flaggedwords = flagged_words["en"]
-    flaggedwords = flaggedwords.union (en_flaggedwords)
+    #the words of lang and the english words, which are flagged in every lang
+    flaggedwords = get_lexicon("flagged_words", lang)
     if not flaggedwords: return 0
     text = text.lower().strip()
     if is_cjk: 
-      s_arr = list("".join(text.split())) 
+      s_arr = "".join(text.split())
     else: 
       s_arr = text.split()
     word_len = lang_2_max_flaggedword_len.get(lang, max_word_len)
-    len_s = len(s_arr)
-    flag_cnt = 0
-    total_cnt = 0
-    for i in range(len_s):
-      if s_arr[i] is None: continue
-      for j in range(min(len_s, i+word_len), i, -1):
-        word = "".join(s_arr[i:j]) if is_cjk else " ".join(s_arr[i:j])
-        if word in flaggedwords:
-          flag_cnt += 1
-          s_arr[i] = "".join(s_arr[i:j]) if is_cjk else " ".join(s_arr[i:j]) 
-          for k in range(i+1, j):
-            s_arr[k] = None
-          break
-      total_cnt += 1
+    flag_cnt, total_cnt = flaggedwords.count_matches(s_arr, word_len)
     flaggedword_score =  (flag_cnt/total_cnt) 
     if is_cjk: flaggedword_score = flaggedword_score*cjk_scale
     return (flaggedword_score)
 
 
+class QualitySignals:
+    """
+    The quality scores of a document from compute_quality_signals. 
+    ngram_score, special_char_score, stopword_score, flaggedword_score: the same as get_ngram_score, get_special_char_score, 
+      get_stopword_score and get_flaggedword_score, except that the stopword and flagged word scores are 0 for an empty text.
+    nonspace_special_char_score: the fraction of special chars among the non whitespace chars.
+    word_count: number of whitespace separated words. char_count: number of non whitespace chars.
+    mean_word_len: char_count/word_count. digit_ratio: fraction of the chars that are digits.
+    line_repetition_ratio: fraction of the non empty lines that repeat an earlier line.
+    """
+    __slots__ = ("lang", "ngram_score", "special_char_score", "nonspace_special_char_score", "stopword_score", "flaggedword_score", \
+                 "word_count", "char_count", "mean_word_len", "digit_ratio", "line_repetition_ratio")
+
+    def __init__(self, **kwargs):
+        for key in self.__slots__:
+          setattr(self, key, kwargs.get(key))
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __repr__(self):
+        return f"QualitySignals({self.to_dict()})"
+
+
+def compute_quality_signals(lang, text, ngram_window_size=3, max_word_len=3, cjk_scale=1.5, special_characters_default=None, \
+                            char_counts=None):
+  """
+  All the quality scores of text in lang (see QualitySignals) from one lowercasing, one split and one count of the chars,
+  instead of each get_*_score function tokenizing the text again.
+  char_counts: Counter(text), if the caller already counted the chars, e.g., for get_nonspace_special_char_score.
+  """
+  if special_characters_default is None: special_characters_default = junk
+  is_cjk = lang_is_cjk(lang)
+  if char_counts is None: char_counts = Counter(text)
+  len_text = len(text)
+  special_cnt = sum(cnt for ch, cnt in char_counts.items() if ch in special_characters_default)
+  space_special_cnt = sum(cnt for ch, cnt in char_counts.items() if ch in special_characters_default and ch.isspace())
+  space_cnt = sum(cnt for ch, cnt in char_counts.items() if ch.isspace())
+  digit_cnt = sum(cnt for ch, cnt in char_counts.items() if ch.isdigit())
+  tokens = text.split()
+  char_count = len_text - space_cnt
+
+  ngram_counts = get_ngram_counts(text if is_cjk else tokens, ngram_window_size)
+  ngram_score = int(ngram_counts.max())/(char_counts[" "]+1) if len(ngram_counts) else 0.0
+
+  lowered = text.lower().strip()
+  s_arr = "".join(lowered.split()) if is_cjk else lowered.split()
+  if not all_stopwords.get(lang):
+    stopword_score = 1
+  else:
+    stop_cnt, total_cnt = get_lexicon("stopwords", lang).count_matches(s_arr, lang_2_max_stopword_len.get(lang, max_word_len))
+    stopword_score = stop_cnt/total_cnt if total_cnt else 0
+    if is_cjk: stopword_score = stopword_score*cjk_scale
+  flaggedwords = get_lexicon("flagged_words", lang)
+  if not flaggedwords:
+    flaggedword_score = 0
+  else:
+    flag_cnt, total_cnt = flaggedwords.count_matches(s_arr, lang_2_max_flaggedword_len.get(lang, max_word_len))
+    flaggedword_score = flag_cnt/total_cnt if total_cnt else 0
+    if is_cjk: flaggedword_score = flaggedword_score*cjk_scale
+
+  lines = [line for line in (line.strip() for line in text.split("\n")) if line]
+  return QualitySignals(lang=lang, ngram_score=ngram_score, \
+                        special_char_score=special_cnt/len_text if len_text else 1, \
+                        nonspace_special_char_score=(special_cnt-space_special_cnt)/char_count if char_count else 1, \
+                        stopword_score=stopword_score, flaggedword_score=flaggedword_score, \
+                        word_count=len(tokens), char_count=char_count, mean_word_len=char_count/len(tokens) if tokens else 0.0, \
+                        digit_ratio=digit_cnt/len_text if len_text else 0.0, \
+                        line_repetition_ratio=1.0-len(set(lines))/len(lines) if lines else 0.0)
+
+
+class RollingStats:
+    """
+    mean, stdev, median and quantiles of the last window scores, e.g., the stopword or perplexity scores of a lang,
+    for the moving average cutoffs. Adding a score doesn't recompute the stats over the window:
+    the scores are kept in a ring buffer and a sorted copy of the window (the median and quantiles are exact), and the 
+    mean and variance are updated incrementally with Welford's method. Keeping the sorted copy costs a binary search and an
+    O(window) memmove of the list per score, which is cheap for the default window of 500.
+    Use to_dict/from_dict (or save_rolling_stats/load_rolling_stats) to keep the state across restarts.
+    """
+    def __init__(self, window=500):
+        self.window = window
+        self.values = []
+        self.sorted_values = []
+        self.pos = 0
+        self.count = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def __len__(self):
+        return len(self.values)
+
+    def _recompute(self):
+        # every window adds, so the rounding errors of the incremental updates don't build up
+        n = len(self.values)
+        self._mean = math.fsum(self.values)/n if n else 0.0
+        self._m2 = math.fsum((x - self._mean)**2 for x in self.values)
+
+    def add(self, x):
+        x = float(x)
+        self.count += 1
+        if len(self.values) < self.window:
+          self.values.append(x)
+          n = len(self.values)
+          delta = x - self._mean
+          self._mean += delta/n
+          self._m2 += delta*(x - self._mean)
+        else:
+          old = self.values[self.pos]
+          self.values[self.pos] = x
+          self.pos = (self.pos + 1) % self.window
+          del self.sorted_values[bisect.bisect_left(self.sorted_values, old)]
+          new_mean = self._mean + (x - old)/self.window
+          self._m2 += (x - old)*(x - new_mean + old - self._mean)
+          self._mean = new_mean
+        bisect.insort(self.sorted_values, x)
+        if self.count % max(1, self.window) == 0: self._recompute()
+        return self
+
+    def mean(self):
+        return self._mean if self.values else None
+
+    def stdev(self):
+        """ the sample standard deviation, as statistics.stdev """
+        n = len(self.values)
+        if n < 2: return None
+        if n <= 64:
+          # small windows are cheap to sum exactly, and the incremental updates lose the most precision there
+          mean = math.fsum(self.values)/n
+          return math.sqrt(math.fsum((x - mean)**2 for x in self.values)/(n - 1))
+        return math.sqrt(max(0.0, self._m2)/(n - 1))
+
+    def median(self):
+        n = len(self.sorted_values)
+        if not n: return None
+        if n % 2: return self.sorted_values[n//2]
+        return (self.sorted_values[n//2 - 1] + self.sorted_values[n//2])/2
+
+    def quantile(self, q):
+        """ the q quantile (0 <= q <= 1) of the window, linearly interpolated between the closest ranks. """
+        n = len(self.sorted_values)
+        if not n: return None
+        pos = q*(n - 1)
+        lo = int(pos)
+        hi = min(lo + 1, n - 1)
+        return self.sorted_values[lo] + (self.sorted_values[hi] - self.sorted_values[lo])*(pos - lo)
+
+    def to_dict(self):
+        """ the scores of the window, oldest first, which is all we need to rebuild the stats. """
+        return {"window": self.window, "count": self.count, "values": self.values[self.pos:] + self.values[:self.pos]}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls(data["window"])
+        for x in data["values"]: stats.add(x)
+        stats.count = data["count"]
+        return stats
+
+
+def get_rolling_stats(stats_per_lang, lang, window=500):
+  """ the RollingStats of lang in stats_per_lang, created if needed. """
+  stats = stats_per_lang.get(lang)
+  if stats is None:
+    stats = stats_per_lang[lang] = RollingStats(window)
+  return stats
+
+
+def save_rolling_stats(stats_per_lang, path):
+  with open(path, "w", encoding="utf8") as f:
+    json.dump({lang: stats.to_dict() for lang, stats in stats_per_lang.items()}, f)
+
+
+def load_rolling_stats(path):
+  """ the stats_per_lang saved with save_rolling_stats, or {} if path does not exist. """
+  if not os.path.exists(path): return {}
+  with open(path, encoding="utf8") as f:
+    return {lang: RollingStats.from_dict(data) for lang, data in json.load(f).items()}
+
+
 def get_score_moving_avg(lang, text, scores_per_lang=None, _stdev_lower_bound=2, _stdev_upper_bound=2, simple_moving_avg_window=500, fn=None, fn_args={}, use_mean_for_cutoff=True):
+    """ score text with fn (default get_stopword_score), and add it to the RollingStats of lang in scores_per_lang. 
+    returns the cutoffs and stats of the last simple_moving_avg_window scores, and scores_per_lang. """
     if fn is None: fn = get_stopword_score
     if scores_per_lang is None: scores_per_lang = {}
     _max_cutoff = 10e9
-    _min_cutoff = -10e9
-    _stdev = _mean = _median = 0
     _score = fn(lang, text, **fn_args)
-    _min_cutoff = _mean = _median = _stdev = _quantiles = None
-    scores_per_lang[lang] = _scores = _scores_per_lang.get(lang,[])
-    _scores.append(_score)
+    _min_cutoff = _mean = _median = _stdev = None
+    _scores = get_rolling_stats(scores_per_lang, lang, simple_moving_avg_window).add(_score)
     if len(_scores) >= 2:
-      if len(_scores) > simple_moving_avg_window:
-         _scores_per_lang[lang] = _scores =_scores[-simple_moving_avg_window:]
-      _stdev = statistics.stdev(_scores)
-      _mean = statistics.mean (_scores)        
-      _median = statistics.median (_scores) 
+      _stdev = _scores.stdev()
+      _mean = _scores.mean()
+      _median = _scores.median()
       if use_mean_for_cutoff:
         _min_cutoff = _mean-(_stdev*_stdev_lower_bound)
         _max_cutoff = _mean+(_stdev*_stdev_upper_bound)
       else:
         _min_cutoff = _median-(_stdev*_stdev_lower_bound)
         _max_cutoff = _median+(_stdev*_stdev_upper_bound)
-    return _min_cutoff, _max_cutoff, _stdev, _mean, _median, scores_per_lang 
-
-
-
-  
+    return _min_cutoff, _max_cutoff, _stdev, _mean, _median, scores_per_lang
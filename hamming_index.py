@@ -0,0 +1,545 @@
+#@title Hamming Index Code
+"""
+Copyright, 2021-2022 Ontocord, LLC, All rights reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Pure NumPy hamming distance search over 64 bit simhash codes, using the block permuted sorted tables from
+# Manku et al., Detecting Near-Duplicates for Web Crawling, WWW 2007. This is the same scheme simhash.find_all uses.
+# The 64 bits are split into num_blocks blocks. If two codes differ in at most hamming_distance bits,
+# then at least num_blocks - hamming_distance of the blocks are identical. So we keep one sorted table per choice of
+# num_blocks - hamming_distance blocks, with those blocks permuted to the top bits, and every match shares a
+# prefix in at least one table. Prefix ranges are found with np.searchsorted, and candidates are checked with a popcount.
+# SegmentedHammingIndex keeps a growing index on disk as a directory of such indexes, for dedup across runs and crawls.
+# PartitionedHammingIndex keeps one of those per partition (e.g., language), so lookups only search codes of the same language.
+
+import os, json, time, shutil
+import itertools
+import numpy as np
+try:
+  import fcntl
+except:
+  fcntl = None
+
+_popcount_table = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def popcount64(arr):
+  """ number of set bits of each uint64 """
+  arr = np.ascontiguousarray(arr, dtype=np.uint64)
+  if hasattr(np, "bitwise_count"):
+    return np.bitwise_count(arr)
+  return _popcount_table[arr.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+
+def _block_widths(num_blocks):
+  return [64 // num_blocks + (1 if i < 64 % num_blocks else 0) for i in range(num_blocks)]
+
+
+class HammingIndex:
+    """
+    An index of uint64 simhash codes that finds every indexed code within hamming_distance bits of a query.
+    num_blocks: the number of blocks the 64 bits are split into. Must be greater than hamming_distance.
+      There are C(num_blocks, hamming_distance) tables. More blocks means more tables (memory), but longer
+      prefixes and thus fewer candidates to check per query.
+    hamming_distance: the max distance the index can answer queries for.
+    Codes are numbered by insertion order. query() returns these ids.
+    """
+    def __init__(self, num_blocks=6, hamming_distance=3):
+        assert 0 <= hamming_distance < num_blocks <= 64, "num_blocks must be greater than hamming_distance"
+        self.num_blocks = num_blocks
+        self.hamming_distance = hamming_distance
+        widths = _block_widths(num_blocks)
+        # (offset from the lsb, width) of each block, with block 0 being the most significant
+        offsets = [64 - sum(widths[:i+1]) for i in range(num_blocks)]
+        self.blocks = list(zip(offsets, widths))
+        self.permutations = []
+        self.prefix_masks = []
+        for prefix_blocks in itertools.combinations(range(num_blocks), num_blocks - hamming_distance):
+          order = list(prefix_blocks) + [b for b in range(num_blocks) if b not in prefix_blocks]
+          prefix_width = sum(widths[b] for b in prefix_blocks)
+          self.permutations.append(order)
+          self.prefix_masks.append(np.uint64(((1 << prefix_width) - 1) << (64 - prefix_width)) if prefix_width else np.uint64(0))
+        self.codes = np.zeros(0, dtype=np.uint64)
+        self.keys = [np.zeros(0, dtype=np.uint64) for _ in self.permutations]
+        self.ids = [np.zeros(0, dtype=np.int64) for _ in self.permutations]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def permute(self, codes, table):
+        """ move the prefix blocks of a table to the top bits. """
+        codes = np.asarray(codes, dtype=np.uint64)
+        ret = np.zeros(len(codes), dtype=np.uint64)
+        dest = 64
+        for b in self.permutations[table]:
+          offset, width = self.blocks[b]
+          dest -= width
+          ret |= ((codes >> np.uint64(offset)) & np.uint64((1 << width) - 1)) << np.uint64(dest)
+        return ret
+
+    def build(self, codes):
+        """ (re)build the index from an array of codes. """
+        self.codes = np.asarray(codes, dtype=np.uint64).copy()
+        for t in range(len(self.permutations)):
+          keys = self.permute(self.codes, t)
+          order = np.argsort(keys, kind="stable")
+          self.keys[t] = keys[order]
+          self.ids[t] = order.astype(np.int64)
+        return self
+
+    def insert(self, codes):
+        """ add codes to the index, merging them into the sorted tables. returns their ids. """
+        codes = np.asarray(codes, dtype=np.uint64)
+        new_ids = np.arange(len(self.codes), len(self.codes) + len(codes), dtype=np.int64)
+        self.codes = np.concatenate([self.codes, codes])
+        for t in range(len(self.permutations)):
+          keys = self.permute(codes, t)
+          order = np.argsort(keys, kind="stable")
+          keys = keys[order]
+          positions = np.searchsorted(self.keys[t], keys, side="right")
+          self.keys[t] = np.insert(self.keys[t], positions, keys)
+          self.ids[t] = np.insert(self.ids[t], positions, new_ids[order])
+        return new_ids
+
+    def query(self, codes, max_distance=None, batch_size=100000):
+        """
+        Find all indexed codes within max_distance (default hamming_distance) of each query code.
+        Returns (query_idx, ids, distances) arrays, one entry per (query, indexed code) match.
+        """
+        if max_distance is None: max_distance = self.hamming_distance
+        assert max_distance <= self.hamming_distance, "the index can only answer up to hamming_distance"
+        codes = np.asarray(codes, dtype=np.uint64)
+        all_qidx, all_ids, all_dists = [], [], []
+        for rng in range(0, len(codes), batch_size):
+          qcodes = codes[rng:rng+batch_size]
+          qidx, ids, dists = [], [], []
+          for t in range(len(self.permutations)):
+            if not len(self.keys[t]): continue
+            qkeys = self.permute(qcodes, t)
+            lo = np.searchsorted(self.keys[t], qkeys & self.prefix_masks[t], side="left")
+            hi = np.searchsorted(self.keys[t], qkeys | ~self.prefix_masks[t], side="right")
+            counts = hi - lo
+            total = int(counts.sum())
+            if not total: continue
+            # expand each [lo, hi) range into candidate positions
+            q = np.repeat(np.arange(len(qcodes)), counts)
+            pos = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+            cand = self.ids[t][pos]
+            d = popcount64(self.codes[cand] ^ qcodes[q])
+            keep = d <= max_distance
+            qidx.append(q[keep])
+            ids.append(cand[keep])
+            dists.append(d[keep])
+          if not qidx: continue
+          qidx, ids, dists = np.concatenate(qidx), np.concatenate(ids), np.concatenate(dists)
+          if not len(qidx): continue
+          # a match may be found through several tables
+          order = np.lexsort((ids, qidx))
+          qidx, ids, dists = qidx[order], ids[order], dists[order]
+          first = np.concatenate([[True], (qidx[1:] != qidx[:-1]) | (ids[1:] != ids[:-1])])
+          all_qidx.append(qidx[first] + rng)
+          all_ids.append(ids[first])
+          all_dists.append(dists[first])
+        if not all_qidx:
+          return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+        return np.concatenate(all_qidx), np.concatenate(all_ids), np.concatenate(all_dists).astype(np.uint8)
+
+    def find_all(self, max_distance=None):
+        """ all pairs of distinct indexed codes within max_distance, as an (n, 2) array of codes with a < b. """
+        if max_distance is None: max_distance = self.hamming_distance
+        pairs = []
+        for t in range(len(self.permutations)):
+          pairs.append(prefix_group_pairs(self.keys[t], self.codes[self.ids[t]], self.prefix_masks[t], max_distance))
+        return unique_pairs(np.concatenate(pairs))
+
+    def save(self, path):
+        """ save the index as .npy files in the directory path. """
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "config.json"), "w") as f:
+          json.dump({"num_blocks": self.num_blocks, "hamming_distance": self.hamming_distance, "num_tables": len(self.permutations)}, f)
+        np.save(os.path.join(path, "codes.npy"), self.codes)
+        for t in range(len(self.permutations)):
+          np.save(os.path.join(path, f"keys_{t}.npy"), self.keys[t])
+          np.save(os.path.join(path, f"ids_{t}.npy"), self.ids[t])
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """ load an index saved with save(). With mmap_mode="r", the tables are memory mapped and shared between processes. """
+        with open(os.path.join(path, "config.json")) as f:
+          config = json.load(f)
+        index = cls(config["num_blocks"], config["hamming_distance"])
+        index.codes = np.load(os.path.join(path, "codes.npy"), mmap_mode=mmap_mode)
+        index.keys = [np.load(os.path.join(path, f"keys_{t}.npy"), mmap_mode=mmap_mode) for t in range(len(index.permutations))]
+        index.ids = [np.load(os.path.join(path, f"ids_{t}.npy"), mmap_mode=mmap_mode) for t in range(len(index.permutations))]
+        return index
+
+
+def prefix_group_pairs(keys, codes, prefix_mask, max_distance):
+  """
+  Given permuted keys sorted ascending and their original codes, return all (code, code) pairs that share a
+  prefix and are within max_distance.
+  We compare each key with the key d positions after it, for d = 1, 2, ..., for as long as any run of equal prefixes is
+  longer than d. So the work is the number of candidate pairs, done as a few vectorized passes.
+  """
+  prefixes = keys & prefix_mask
+  ret = []
+  active = np.arange(len(keys) - 1)
+  d = 1
+  while len(active):
+    active = active[active + d < len(keys)]
+    active = active[prefixes[active] == prefixes[active + d]]
+    if not len(active): break
+    a, b = codes[active], codes[active + d]
+    keep = popcount64(a ^ b) <= max_distance
+    ret.append(np.stack([a[keep], b[keep]], axis=1))
+    d += 1
+  if not ret: return np.zeros((0, 2), dtype=np.uint64)
+  return np.concatenate(ret)
+
+
+def unique_pairs(pairs):
+  """ sort each (a, b) so a < b, drop exact duplicate codes (a == b) and repeated pairs. """
+  pairs = np.sort(pairs.reshape(-1, 2), axis=1)
+  pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+  if not len(pairs): return pairs
+  order = np.lexsort((pairs[:, 1], pairs[:, 0]))
+  pairs = pairs[order]
+  first = np.concatenate([[True], (pairs[1:, 0] != pairs[:-1, 0]) | (pairs[1:, 1] != pairs[:-1, 1])])
+  return pairs[first]
+
+
+def find_all_numpy(hashes, num_blocks, hamming_distance):
+  """ drop in replacement for simhash.find_all, returning an (n, 2) uint64 array of matching hash pairs. """
+  hashes = np.asarray(hashes, dtype=np.uint64)
+  return HammingIndex(num_blocks, hamming_distance).build(hashes).find_all()
+
+
+class SegmentedHammingIndex:
+    """
+    A persistent, append only HammingIndex, e.g., of the simhash codes of every crawl so far, so near duplicates of
+    earlier crawls can be found with a query instead of reclustering.
+    The index is a directory with a config.json and one subdirectory per segment. Each segment is a saved HammingIndex,
+    which is memory mapped, so many processes can share the tables read only through the page cache.
+    add() buffers codes in memory (they can be queried right away), and flushes them as a new segment every segment_size codes.
+    Segments are written to a temp directory and renamed when complete, so several processes can add to the same index,
+    and refresh() picks up the segments other processes wrote.
+    Segments are merged size tiered: a flushed segment is tier 0, and once merge_factor segments of the same tier are next
+    to each other, they are merged into one segment of the next tier. So there are at most about
+    merge_factor * log_merge_factor(len / segment_size) segments to query. A merged segment lists the segments it replaces,
+    which are ignored from the moment it is renamed into place, and keeps their codes in order, so ids don't change and
+    other processes can keep adding and querying during a merge. Merges take a file lock, so only one process merges at a time.
+    The buffer is indexed the same way in memory, in HammingIndexes of buffer_size codes merged merge_factor at a time,
+    so only the last (at most buffer_size) buffered codes are compared one by one.
+    ids: codes are numbered by segment (in the order the segments were written) and then by insertion order. 
+      compact() renumbers them, and should only be run when no other process is using the index.
+    segment_size: the number of buffered codes at which add() flushes.
+    """
+    def __init__(self, path, num_blocks=6, hamming_distance=3, segment_size=1000000, mmap_mode="r", read_only=False, \
+                 merge_factor=4, buffer_size=8192):
+        self.path = path
+        self.segment_size = segment_size
+        self.mmap_mode = mmap_mode
+        self.read_only = read_only
+        self.merge_factor = max(2, merge_factor)
+        self.buffer_size = buffer_size
+        config_path = os.path.join(path, "config.json")
+        if os.path.exists(config_path):
+          with open(config_path) as f:
+            config = json.load(f)
+          num_blocks, hamming_distance = config["num_blocks"], config["hamming_distance"]
+        elif read_only:
+          raise FileNotFoundError(f"no index at {path}")
+        else:
+          os.makedirs(path, exist_ok=True)
+          tmp_path = f"{config_path}.{os.getpid()}"
+          with open(tmp_path, "w") as f:
+            json.dump({"num_blocks": num_blocks, "hamming_distance": hamming_distance}, f)
+          os.replace(tmp_path, config_path)
+        self.num_blocks = num_blocks
+        self.hamming_distance = hamming_distance
+        self.segment_names = []
+        self.segments = []
+        self.tiers = []
+        self._merge_info = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.pending = []
+        self.num_pending = 0
+        # (tier, HammingIndex) of the first num_indexed_pending buffered codes, in order
+        self.pending_indexes = []
+        self.num_indexed_pending = 0
+        self.refresh()
+
+    def __len__(self):
+        return int(self.offsets[-1]) + self.num_pending
+
+    def _segment_merge_info(self, name):
+        """ (tier, names of the segments it replaces) of segment name. """
+        if name not in self._merge_info:
+          merged_path = os.path.join(self.path, name, "merged.json")
+          if os.path.exists(merged_path):
+            with open(merged_path) as f:
+              merged = json.load(f)
+            self._merge_info[name] = (merged["tier"], merged["replaces"])
+          else:
+            self._merge_info[name] = (0, [])
+        return self._merge_info[name]
+
+    def _live_segment_names(self):
+        names = sorted(name for name in os.listdir(self.path) if name.startswith("seg_"))
+        replaced = set(itertools.chain.from_iterable(self._segment_merge_info(name)[1] for name in names))
+        return [name for name in names if name not in replaced]
+
+    def refresh(self):
+        """ load any segments written or merged since the index was opened, e.g., by other processes. """
+        for attempt in range(10):
+          names = self._live_segment_names()
+          if names == self.segment_names: return
+          loaded = dict(zip(self.segment_names, self.segments))
+          try:
+            segments = [loaded[name] if name in loaded else HammingIndex.load(os.path.join(self.path, name), mmap_mode=self.mmap_mode) \
+                        for name in names]
+          except FileNotFoundError:
+            # a segment was merged away and deleted while we listed them, so list them again
+            continue
+          break
+        else:
+          raise RuntimeError(f"the segments of {self.path} kept changing during refresh")
+        self.segments = segments
+        self.segment_names = names
+        self.tiers = [self._segment_merge_info(name)[0] for name in names]
+        self.offsets = np.concatenate([[0], np.cumsum([len(segment) for segment in self.segments])]).astype(np.int64)
+
+    def add(self, codes):
+        """ add codes to the index. returns their ids. """
+        assert not self.read_only, "the index is read only"
+        codes = np.atleast_1d(np.asarray(codes, dtype=np.uint64))
+        start = len(self)
+        self.pending.append(codes)
+        self.num_pending += len(codes)
+        if self.num_pending >= self.segment_size:
+          self.flush()
+        elif self.num_pending - self.num_indexed_pending >= self.buffer_size:
+          self._index_pending()
+        return np.arange(start, start + len(codes), dtype=np.int64)
+
+    def _pending_codes(self):
+        if len(self.pending) > 1: self.pending = [np.concatenate(self.pending)]
+        return self.pending[0] if self.pending else np.zeros(0, dtype=np.uint64)
+
+    def _index_pending(self):
+        """ index the buffered codes that are not indexed yet, and merge the in memory indexes size tiered. """
+        codes = self._pending_codes()[self.num_indexed_pending:]
+        self.pending_indexes.append((0, HammingIndex(self.num_blocks, self.hamming_distance).build(codes)))
+        self.num_indexed_pending = self.num_pending
+        k = self.merge_factor
+        while len(self.pending_indexes) >= k and len(set(tier for tier, _ in self.pending_indexes[-k:])) == 1:
+          tier = self.pending_indexes[-1][0]
+          merged = np.concatenate([index.codes for _, index in self.pending_indexes[-k:]])
+          self.pending_indexes[-k:] = [(tier + 1, HammingIndex(self.num_blocks, self.hamming_distance).build(merged))]
+
+    def _write_pending(self):
+        """ write the buffered codes as a new segment. """
+        codes = self._pending_codes()
+        name = f"seg_{time.time_ns():020d}_{os.getpid()}"
+        tmp_path = os.path.join(self.path, f"tmp_{name}")
+        HammingIndex(self.num_blocks, self.hamming_distance).build(codes).save(tmp_path)
+        os.rename(tmp_path, os.path.join(self.path, name))
+        self.pending, self.num_pending = [], 0
+        self.pending_indexes, self.num_indexed_pending = [], 0
+
+    def flush(self):
+        """ write the buffered codes as a new segment, and merge the segments. """
+        if not self.num_pending: return
+        self._write_pending()
+        self.merge()
+
+    def _mergeable_run(self):
+        """ the index of the first of merge_factor neighboring segments of the same tier, or None. """
+        k = self.merge_factor
+        for i in range(len(self.tiers) - k + 1):
+          if len(set(self.tiers[i:i+k])) == 1: return i
+        return None
+
+    def merge(self):
+        """ merge merge_factor neighboring segments of the same tier into one of the next tier, until there are none. 
+        Does nothing if another process is merging. """
+        if self.read_only: return
+        lock_file = open(os.path.join(self.path, "merge.lock"), "a")
+        try:
+          if fcntl is not None:
+            try:
+              fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+              # another process is merging
+              return self.refresh()
+          while True:
+            self.refresh()
+            i = self._mergeable_run()
+            if i is None: break
+            names = self.segment_names[i:i+self.merge_factor]
+            tier = self.tiers[i] + 1
+            # the merged segment sorts right where its first segment was, so the ids don't change
+            name = f"{names[0].split('.')[0]}.{tier}"
+            tmp_path = os.path.join(self.path, f"tmp_{name}_{os.getpid()}")
+            if os.path.exists(tmp_path): shutil.rmtree(tmp_path)
+            codes = np.concatenate([np.asarray(segment.codes) for segment in self.segments[i:i+self.merge_factor]])
+            HammingIndex(self.num_blocks, self.hamming_distance).build(codes).save(tmp_path)
+            # also list what the merged segments replaced, in case a crash left any of those behind
+            replaces = names + list(itertools.chain.from_iterable(self._segment_merge_info(name2)[1] for name2 in names))
+            with open(os.path.join(tmp_path, "merged.json"), "w") as f:
+              json.dump({"tier": tier, "replaces": replaces}, f)
+            os.rename(tmp_path, os.path.join(self.path, name))
+            for name2 in replaces:
+              shutil.rmtree(os.path.join(self.path, name2), ignore_errors=True)
+        finally:
+          lock_file.close()
+        self.refresh()
+
+    def get_codes(self, ids):
+        """ the codes with the given ids. """
+        ids = np.atleast_1d(np.asarray(ids, dtype=np.int64))
+        ret = np.zeros(len(ids), dtype=np.uint64)
+        seg = np.searchsorted(self.offsets, ids, side="right") - 1
+        for s in np.unique(seg).tolist():
+          mask = seg == s
+          if s < len(self.segments):
+            ret[mask] = self.segments[s].codes[ids[mask] - self.offsets[s]]
+          else:
+            ret[mask] = self._pending_codes()[ids[mask] - self.offsets[-1]]
+        return ret
+
+    def query(self, codes, max_distance=None, batch_size=100000):
+        """
+        Find all indexed codes (including the buffered ones) within max_distance (default hamming_distance) of each query code.
+        Returns (query_idx, ids, distances) arrays, one entry per (query, indexed code) match.
+        """
+        if max_distance is None: max_distance = self.hamming_distance
+        codes = np.atleast_1d(np.asarray(codes, dtype=np.uint64))
+        all_qidx, all_ids, all_dists = [], [], []
+        offset = int(self.offsets[-1])
+        indexes = list(zip(self.offsets.tolist(), self.segments))
+        for _, index in self.pending_indexes:
+          indexes.append((offset, index))
+          offset += len(index)
+        for offset, index in indexes:
+          qidx, ids, dists = index.query(codes, max_distance=max_distance, batch_size=batch_size)
+          all_qidx.append(qidx)
+          all_ids.append(ids + offset)
+          all_dists.append(dists)
+        pending = self._pending_codes()[self.num_indexed_pending:]
+        if len(pending):
+          # the rest of the buffer is at most buffer_size codes, so we just compare against all of them
+          for rng in range(0, len(codes), max(1, batch_size // max(1, len(pending)))):
+            qcodes = codes[rng:rng+max(1, batch_size // max(1, len(pending)))]
+            d = popcount64((qcodes[:, None] ^ pending[None, :]).ravel()).reshape(len(qcodes), len(pending))
+            qidx, ids = np.nonzero(d <= max_distance)
+            all_qidx.append(qidx + rng)
+            all_ids.append(ids + offset)
+            all_dists.append(d[qidx, ids].astype(np.uint8))
+        if not all_qidx:
+          return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+        return np.concatenate(all_qidx).astype(np.int64), np.concatenate(all_ids).astype(np.int64), np.concatenate(all_dists)
+
+    def compact(self):
+        """ merge all the segments (and the buffer) into one segment. Only run this when no other process is using the index. """
+        assert not self.read_only, "the index is read only"
+        # every segment directory, also ones a merge replaced but a crash left behind
+        old_names = [name for name in os.listdir(self.path) if name.startswith("seg_")]
+        codes = np.concatenate([np.asarray(segment.codes) for segment in self.segments] + [self._pending_codes()])
+        if len(codes):
+          self.pending, self.num_pending = [codes], len(codes)
+          self._write_pending()
+        for name in old_names:
+          shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+        self.refresh()
+
+
+class PartitionedHammingIndex:
+    """
+    A SegmentedHammingIndex per partition, e.g., per language with record["lang"] as the partition, so each language
+    has its own simhash space. Lookups only search the partition of the query, which keeps the candidate sets small,
+    and a partition can be flushed, compacted and clustered on its own (see simhash.index_clusters_by_partition).
+    The index is a directory with one SegmentedHammingIndex subdirectory per partition, created on first use.
+    Each partition flushes, merges (size tiered, with its own lock) and buffers on its own, so a partition with few codes
+    isn't merged with, or held back by, the big ones.
+    Other args: see SegmentedHammingIndex.
+    """
+    def __init__(self, path, num_blocks=6, hamming_distance=3, segment_size=1000000, mmap_mode="r", read_only=False, \
+                 merge_factor=4, buffer_size=8192):
+        self.path = path
+        self.num_blocks = num_blocks
+        self.hamming_distance = hamming_distance
+        self.segment_size = segment_size
+        self.mmap_mode = mmap_mode
+        self.read_only = read_only
+        self.merge_factor = merge_factor
+        self.buffer_size = buffer_size
+        self.partitions = {}
+        if not read_only: os.makedirs(path, exist_ok=True)
+        self.refresh()
+
+    def _dir_name(self, key):
+        return "".join(ch if ch.isalnum() or ch in "-_" else "_" for ch in str(key))
+
+    def keys(self):
+        return list(self.partitions.keys())
+
+    def __len__(self):
+        return sum(len(partition) for partition in self.partitions.values())
+
+    def partition(self, key):
+        """ the SegmentedHammingIndex of partition key, created if needed. """
+        name = self._dir_name(key)
+        if name not in self.partitions:
+          self.partitions[name] = SegmentedHammingIndex(os.path.join(self.path, name), self.num_blocks, self.hamming_distance, \
+                                                        self.segment_size, self.mmap_mode, self.read_only, \
+                                                        merge_factor=self.merge_factor, buffer_size=self.buffer_size)
+        return self.partitions[name]
+
+    def refresh(self):
+        """ load the partitions and segments written since the index was opened, e.g., by other processes. """
+        if os.path.isdir(self.path):
+          for name in sorted(os.listdir(self.path)):
+            if name not in self.partitions and os.path.exists(os.path.join(self.path, name, "config.json")):
+              self.partition(name)
+        for partition in self.partitions.values():
+          partition.refresh()
+
+    def add(self, key, codes):
+        """ add codes to partition key. returns their ids within the partition. """
+        return self.partition(key).add(codes)
+
+    def query(self, key, codes, max_distance=None, batch_size=100000):
+        """ SegmentedHammingIndex.query of partition key. A partition that does not exist yet has no matches. """
+        if self._dir_name(key) not in self.partitions and not os.path.exists(os.path.join(self.path, self._dir_name(key), "config.json")):
+          return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+        return self.partition(key).query(codes, max_distance=max_distance, batch_size=batch_size)
+
+    def flush(self, key=None):
+        """ write the buffered codes of partition key, or of all partitions if key is None. """
+        for partition in ([self.partition(key)] if key is not None else self.partitions.values()):
+          partition.flush()
+
+    def merge(self, key=None):
+        """ SegmentedHammingIndex.merge of partition key, or of all partitions if key is None. """
+        for partition in ([self.partition(key)] if key is not None else self.partitions.values()):
+          partition.merge()
+
+    def compact(self, key=None):
+        """ compact partition key, or all partitions if key is None. Only run this when no other process is using the index. """
+        for partition in ([self.partition(key)] if key is not None else self.partitions.values()):
+          partition.compact()
+
+    def get_codes(self, key, ids=None):
+        """ the codes with the given ids in partition key, or all its codes if ids is None. """
+        partition = self.partition(key)
+        if ids is None: ids = np.arange(len(partition), dtype=np.int64)
+        return partition.get_codes(ids)
@@ -29,18 +29,25 @@ from .cjk import *
 import tempfile, os, gzip
 from .char_manager import *
 
-try:
-  import transformers
-except:
-  os.system("pip install transformers sentencepiece")
-
-from transformers import AutoTokenizer
-try:
-  if mt5_tokenizer is None: pass
-except:
-  mt5_tokenizer = AutoTokenizer.from_pretrained("google/mt5-small")
+from .model_manager import register_model, get_model
+
+def _load_mt5_tokenizer():
+  try:
+    import transformers
+  except:
+    os.system("pip install transformers sentencepiece")
+  from transformers import AutoTokenizer
+  return AutoTokenizer.from_pretrained("google/mt5-small")
+
+#the tokenizer is loaded on first use. see model_manager.preload to load it before forking workers.
+register_model("mt5_tokenizer", _load_mt5_tokenizer)
 mt5_underscore = "▁"
 
+#served lazily, so mt5_tokenizer is not exported by "from .kenlm_manager import *". use get_model("mt5_tokenizer") or kenlm_manager.mt5_tokenizer.
+def __getattr__(name):
+  if name == "mt5_tokenizer": return get_model("mt5_tokenizer")
+  raise AttributeError(f"module {__name__} has no attribute {name}")
+
 
 ## cache the models in main memory so we don't have to load them over and over
 kenlm_models = {
@@ -131,8 +138,7 @@ public_figure_kenlm_cutoff_map = {
 
 
 def train_kenlm_model(model_name, data_files,  parse_file=None, min_num_tokens=5, do_collapse_values=True, lmplz_loc = "./riverbed/bin/lmplz", build_binary_loc = "./riverbed/bin/build_binary", tokenizer=None, do_lowercase=True, ngram_score=0.8, special_char_score=0.28, flaggedword_score=0.08, remove_accents=False):
-  global mt5_tokenizer
-  if tokenizer is None: tokenizer = mt5_tokenizer
+  if tokenizer is None: tokenizer = get_model("mt5_tokenizer")
   if lmplz_loc != "./riverbed/bin/lmplz" and not os.path.exists("./lmplz"):
         os.system(f"cp {lmplz_loc} ./lmplz")
         lmplz = "./lmplz"
@@ -157,14 +163,9 @@ def train_kenlm_model(model_name, data_files,  parse_file=None, min_num_tokens=5
         line = line.decode().strip()
         lang = cjk_detect(line)
         if not lang: lang = "en"
-        score = get_ngram_score(lang, line)
-        if score >= ngram_score:
-          continue
-        score = get_special_char_score(lang, line)
-        if score >= special_char_score:
-          continue
-        score = get_flaggedword_score(lang, line)
-        if score >= flaggedword_score:
+        signals = compute_quality_signals(lang, line)
+        if signals.ngram_score >= ngram_score or signals.special_char_score >= special_char_score or \
+           signals.flaggedword_score >= flaggedword_score:
           continue
         line = KenlmModel.normalize(
             line,
@@ -371,7 +372,7 @@ class KenlmModel:
           self.model = kenlm.Model(model_path)
         elif "riverbed" in model_name:
           self.model = kenlm.Model(os.path.join(self.model_name, f"arpa.bin"))
-          tokenizer = mt5_tokenizer
+          tokenizer = get_model("mt5_tokenizer")
         else:
           self.model = kenlm.Model(os.path.join(self.model_name, f"{language}.arpa.bin"))
         if tokenizer is None:
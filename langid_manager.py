@@ -14,19 +14,24 @@ limitations under the License.
 
 #https://github.com/piisa/muliwai/blob/7ccf36d016fa66a9b1ed00b0ce8b89d01a57dfc9/langid_manager.py which are under Apache 2.0
 
-from .stopwords import all_stopwords
+from .lexicon_manager import all_stopwords
 from .char_manager import *
 from .filtering import *
 from .cjk import *
+from .model_manager import register_model, get_model
 
 import fasttext, langid
-import os
+import os, time, random
+import numpy as np
 
-try:
-  if fasttext_model is None: assert False
-except:
-  fasttext_model = os.path.abspath(os.path.dirname(__file__))  +"/bin/lid.176.ftz"
-  lang_model = fasttext.load_model(fasttext_model)
+fasttext_model = os.path.abspath(os.path.dirname(__file__))  +"/bin/lid.176.ftz"
+#the fasttext model is loaded on first use. see model_manager.preload to load it before forking workers.
+register_model("fasttext_langid", lambda: fasttext.load_model(fasttext_model))
+
+#served lazily, so lang_model is not exported by "from .langid_manager import *". use get_model("fasttext_langid") or langid_manager.lang_model.
+def __getattr__(name):
+  if name == "lang_model": return get_model("fasttext_langid")
+  raise AttributeError(f"module {__name__} has no attribute {name}")
 
             
 import re
@@ -38,94 +43,172 @@ emoji_pattern = re.compile("["
         u"\U0001F1E0-\U0001F1FF"  # flags (iOS)
                            "]+", flags=re.UNICODE)
 
+# (langs, group): a lang of langs is confused by langid with the langs of group. The first rule with a lang wins.
+lang_group_rules = [
+    ({'ig', 'sn', 'ny', 'st', 'zu', 'xh', 'rw', 'sw', 'yo', 'so'}, {'ig', 'sn', 'ny', 'st', 'zu', 'xh', 'rw', 'sw', 'yo', 'so'}),
+    ({'mr', 'ne', 'hi', }, {'mr', 'ne', 'hi', }),
+    ({'fr', 'br'}, {'fr','la', 'br' }),
+    ({'pt', }, {'pt','la', 'gl' }),
+    ({'eo', 'es', 'oc', 'ca', 'eu', 'an', 'gl' }, {'eo', 'es', 'oc', 'ca', 'eu', 'an', 'gl', 'la' }),
+    ({'arz', 'ar', 'fa', 'ur', 'az', 'azb', 'ckb', 'ps' }, {'arz', 'ar', 'fa', 'ur', 'az', 'azb', 'ckb', 'ps' }),
+    ({'id', 'ms', }, {'id', 'ms',}),
+    ({'as', 'bn', 'bpy'}, {'as', 'bn', 'bpy'}),
+    ({'af', 'nl', }, {'af', 'nl',}),
+    ({'bo', 'dz', }, {'bo', 'dz',}),
+    ({'bs', 'hr', }, {'bs', 'hr',}),
+    ({'bxr', 'mn', }, {'bxr', 'mn',}),
+    ({'ceb', 'tl', }, {'ceb', 'tl',}),
+    ({'cs', 'sk', }, {'cs', 'sk',}),
+    ({'da', 'no', }, {'da', 'no',}),
+    ({'eml', 'wa', }, {'eml', 'wa',}),
+    ({'de', 'lb', 'pl', 'dsb'}, {'de', 'lb', 'pl', 'dsb'}),
+    ({'id', 'jv', 'ms', 'tl',}, {'id', 'jv', 'ms', 'tl', }),
+    ({'av', 'ru', 'bg', 'ba', 'kk', 'ky', 'uk', 'be', 'ce', 'cv'}, {'av', 'ru', 'bg', 'ba', 'kk', 'ky', 'uk', 'be', 'ce', 'cv'}),
+]
+lang_groups_table = {}
+for langs, group in lang_group_rules:
+  for lang in langs:
+    lang_groups_table.setdefault(lang, frozenset(group))
+
+# the langs that are in the group of some other lang. for any other lang, the langid label can only change the score when the score is ambiguous.
+langs_in_other_groups = frozenset(lang for src_lang, group in lang_groups_table.items() for lang in group if lang != src_lang)
+
 def get_lang_groups(src_lang):
     """ we use langid because it's pretty fast but it has difficulties in low resource languages
     langid can sometimes mistake languages that are in the same group. that is ok for our purpose as
     we mainly use the langid check to confirm the labels from other models. """
-    lang_groups={src_lang}
-    if src_lang in {'ig', 'sn', 'ny', 'st', 'zu', 'xh', 'rw', 'sw', 'yo', 'so'}:
-      lang_groups = {'ig', 'sn', 'ny', 'st', 'zu', 'xh', 'rw', 'sw', 'yo', 'so'}
-    elif src_lang in {'mr', 'ne', 'hi', }:
-      lang_groups = {'mr', 'ne', 'hi', }
-    elif src_lang in {'fr', 'br'}:
-      lang_groups = {'fr','la', 'br' }
-    elif src_lang in {'pt', }:
-      lang_groups = {'pt','la', 'gl' }
-    elif src_lang in {'eo', 'es', 'oc', 'ca', 'eu', 'an', 'gl' }:
-      lang_groups = {'eo', 'es', 'oc', 'ca', 'eu', 'an', 'gl', 'la' }
-    elif src_lang in {'arz', 'ar', 'fa', 'ur', 'az', 'azb', 'ckb', 'ps' }:
-      lang_groups = {'arz', 'ar', 'fa', 'ur', 'az', 'azb', 'ckb', 'ps' }
-    elif src_lang in {'id', 'ms', }:
-      lang_groups = {'id', 'ms',}
-    elif src_lang in {'as', 'bn', 'bpy'}:
-      lang_groups = {'as', 'bn', 'bpy'}
-    elif src_lang in {'af', 'nl', }:
-      lang_groups = {'af', 'nl',}
-    elif src_lang in {'bo', 'dz', }:
-      lang_groups = {'bo', 'dz',}
-    elif src_lang in {'bs', 'hr', }:
-      lang_groups = {'bs', 'hr',}
-    elif src_lang in {'bxr', 'mn', }:
-      lang_groups = {'bxr', 'mn',}
-    elif src_lang in {'ceb', 'tl', }:
-      lang_groups = {'ceb', 'tl',}
-    elif src_lang in {'cs', 'sk', }:
-      lang_groups = {'cs', 'sk',}
-    elif src_lang in {'da', 'no', }:
-      lang_groups = {'da', 'no',}
-    elif src_lang in {'eml', 'wa', }:
-      lang_groups = {'eml', 'wa',}
-    elif src_lang in {'de', 'lb', 'pl', 'dsb'}:
-      lang_groups = {'de', 'lb', 'pl', 'dsb'}
-    elif src_lang in {'id', 'jv', 'ms', 'tl',}:
-      lang_groups = {'id', 'jv', 'ms', 'tl', }
-    elif src_lang in {'av', 'ru', 'bg', 'ba', 'kk', 'ky', 'uk', 'be', 'ce', 'cv'}:
-      lang_groups = {'av', 'ru', 'bg', 'ba', 'kk', 'ky', 'uk', 'be', 'ce', 'cv'}
-    return lang_groups
+    return set(lang_groups_table.get(src_lang, (src_lang,)))
 
-#TODO: add resiliparse lang detect?
-def lang_id(document, cleanup_emoji=False, len_cutoff=1000):
-  global lang_model
+def _clean_lang_id_document(document, cleanup_emoji=False, len_cutoff=1000):
   document = document.lower().replace("\n", " ")
   if len_cutoff and len(document) > len_cutoff: document = document[:len_cutoff]
   if cleanup_emoji:
     document = emoji_pattern.sub(r'', document).strip()
-  if not document:
+  return document
+
+def _is_ambiguous(score_pred):
+  return score_pred > 0.3 and score_pred < 0.5
+
+def _langid_boost(lang, score_pred, lang2):
+  """ whether the langid label lang2 confirms the fasttext label lang, which boosts its score. """
+  return (lang2 != lang or _is_ambiguous(score_pred)) and lang in get_lang_groups(lang2)
+
+def _guess_low_confidence_lang(document, lang, score_pred):
+  """ the last rules of lang_id, for a score_pred below 0.5 """
+  #let's see if we can guess the lang based on our stopword list (to match low resource langs)
+  lang2, stopword_score = first_stopword_lang(document, 0.2)
+  if lang2 is not None:
+    score_pred = 0.3 + stopword_score
+    lang = lang2
+  if score_pred < 0.5:  
+    #let's see if we can guess the lang based on cjk character code
+    lang2 = lang_is_cjk(document)
+    if lang2 and lang2 == lang:
+      score_pred += 0.3    
+      lang = lang2
+    elif lang2 and lang2 != lang:
+      lang = lang2
+      score_pred = 1.0 - score_pred
+  return lang, score_pred
+
+#TODO: add resiliparse lang detect?
+def lang_id(document, cleanup_emoji=False, len_cutoff=1000):
+  lang_model = get_model("fasttext_langid")
+  document = _clean_lang_id_document(document, cleanup_emoji, len_cutoff)
+  if not document.strip():
     return None, 0.0
   pred = lang_model.predict(document)
   lang = pred[0][0].replace("__label__", "")
   score_pred = pred[1][0]
   lang2 = langid.classify(document)
   lang2 = lang2[0]
-  lang_group = get_lang_groups(lang2)
-  if lang2 != lang or (score_pred > 0.3 and score_pred < 0.5):
-    if lang not in lang_group:
-      pass
-      #print (lang, lang2, score_pred)
-    else:
-      score_pred = score_pred*1.5
+  if _langid_boost(lang, score_pred, lang2):
+    score_pred = score_pred*1.5
   #let's see if we can give more confidence that this document is a lang
-  if (score_pred > 0.3 and score_pred < 0.5):
+  if _is_ambiguous(score_pred):
     stopword_score = get_stopword_score(lang, document)
     if stopword_score > 0.2:
       score_pred = score_pred*1.5
-  lang2 = None
   if score_pred < 0.5:
-    #let's see if we can guess the lang based on our stopword list (to match low resource langs)
-    for lang2 in all_stopwords:
-       stopword_score = get_stopword_score(lang2, document)
-       if stopword_score > 0.2:
-         score_pred = 0.3 + stopword_score
-         lang = lang2
-         break
-  if score_pred < 0.5:  
-    #let's see if we can guess the lang based on cjk character code
-    lang2 = lang_is_cjk(document)
-    if lang2 and lang2 == lang:
-      score_pred += 0.3    
-      lang = lang2
-    elif lang2 and lang2 != lang:
-      lang = lang2
-      score_pred = 1.0 - score_pred
-      
+    lang, score_pred = _guess_low_confidence_lang(document, lang, score_pred)
   return lang, score_pred
+
+
+def lang_id_batch(documents, cleanup_emoji=False, len_cutoff=1000):
+  """
+  [lang_id(document) for document in documents], with one fasttext predict call for all the documents.
+  langid.classify, which is much slower than fasttext, only runs on the documents where its label can change the score:
+  where the fasttext score is ambiguous, or the fasttext lang is in the lang group of another lang.
+  """
+  lang_model = get_model("fasttext_langid")
+  documents = [_clean_lang_id_document(document, cleanup_emoji, len_cutoff) for document in documents]
+  ret = [(None, 0.0)]*len(documents)
+  # whitespace only documents have no words to score, like empty ones
+  idx = [i for i, document in enumerate(documents) if document.strip()]
+  if not idx: return ret
+  labels, probs = lang_model.predict([documents[i] for i in idx])
+  langs = [label[0].replace("__label__", "") for label in labels]
+  scores = np.array([prob[0] for prob in probs], dtype=np.float64)
+  ambiguous = (scores > 0.3) & (scores < 0.5)
+  needs_langid = ambiguous | np.isin(np.array(langs, dtype=object), list(langs_in_other_groups))
+  boost = np.zeros(len(idx), dtype=bool)
+  for j in np.flatnonzero(needs_langid).tolist():
+    boost[j] = _langid_boost(langs[j], scores[j], langid.classify(documents[idx[j]])[0])
+  scores = np.where(boost, scores*1.5, scores)
+  for j in np.flatnonzero((scores > 0.3) & (scores < 0.5)).tolist():
+    if get_stopword_score(langs[j], documents[idx[j]]) > 0.2:
+      scores[j] = scores[j]*1.5
+  for j, (i, lang, score_pred) in enumerate(zip(idx, langs, scores.tolist())):
+    ret[i] = _guess_low_confidence_lang(documents[i], lang, score_pred) if score_pred < 0.5 else (lang, score_pred)
+  return ret
+
+
+# a rough share of the langs of common crawl documents. the rest of the documents are in the other stopword langs.
+cc_lang_mix = {"en": 0.45, "ru": 0.06, "de": 0.05, "zh": 0.05, "ja": 0.05, "es": 0.04, "fr": 0.04, "it": 0.02, "pt": 0.02, \
+               "pl": 0.02, "nl": 0.02, "vi": 0.01, "id": 0.01, "ar": 0.01, "tr": 0.01, "fa": 0.01, "ko": 0.01}
+cc_boilerplate = ["home", "|", "login", "sign up", "©", "2021", "privacy policy", "cookies", "http://www.example.com/index.php?id=12", "»", "menu"]
+
+def cc_like_documents(num_docs=2000, seed=0):
+  """
+  synthetic documents in a common crawl like mix of langs and lengths: stopwords and made up words of the lang,
+  with some navigation boilerplate, and some short or mixed lang documents, which are the ambiguous ones.
+  """
+  rnd = random.Random(seed)
+  other_langs = [lang for lang in all_stopwords if lang not in cc_lang_mix]
+  rest = 1.0 - sum(cc_lang_mix.values())
+  langs = list(cc_lang_mix) + other_langs
+  weights = list(cc_lang_mix.values()) + [rest/len(other_langs)]*len(other_langs)
+  vocab = {}
+  docs = []
+  for lang in rnd.choices(langs, weights, k=num_docs):
+    if lang not in vocab:
+      stopwords = sorted(all_stopwords[lang])
+      chars = sorted(set("".join(stopwords)))
+      vocab[lang] = (stopwords, chars)
+    stopwords, chars = vocab[lang]
+    num_words = max(1, int(rnd.lognormvariate(3.5, 1.2)))
+    words = [rnd.choice(stopwords) if rnd.random() < 0.6 else "".join(rnd.choices(chars, k=rnd.randint(2, 9))) for _ in range(num_words)]
+    if rnd.random() < 0.2:
+      words = rnd.choices(cc_boilerplate, k=rnd.randint(3, 12)) + words
+    if rnd.random() < 0.1:
+      words += rnd.choices(sorted(all_stopwords[rnd.choice(langs)]), k=rnd.randint(1, 10))
+    docs.append(("" if lang_is_cjk(lang) else " ").join(words))
+  return docs
+
+
+def benchmark_lang_id(documents=None, batch_size=1000, cleanup_emoji=False):
+  """ docs/sec of lang_id and lang_id_batch on documents (default cc_like_documents() and some empty and whitespace only
+  documents), and whether their labels and scores are the same. """
+  if documents is None: documents = ["", " ", "\n\t \n"] + cc_like_documents()
+  ret = {}
+  st = time.time()
+  labels = [lang_id(document, cleanup_emoji) for document in documents]
+  secs = time.time() - st
+  ret["lang_id"] = {"num": len(documents), "secs": secs, "per_sec": len(documents)/max(secs, 1e-9)}
+  st = time.time()
+  labels2 = []
+  for rng in range(0, len(documents), batch_size):
+    labels2.extend(lang_id_batch(documents[rng:rng+batch_size], cleanup_emoji))
+  secs = time.time() - st
+  ret["lang_id_batch"] = {"num": len(documents), "secs": secs, "per_sec": len(documents)/max(secs, 1e-9), "same_as_lang_id": labels2 == labels}
+  return ret
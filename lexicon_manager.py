@@ -0,0 +1,224 @@
+#@title Lexicon Manager Code
+"""
+Copyright, 2021-2022 Ontocord, LLC, All rights reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# One registry of the per lang word lists (stopwords, flagged words, banned words) and the structures built from them,
+# shared by every scorer (filtering.py, kenlm_manager.py, langid_manager.py and the WIP extractors).
+# A Lexicon is built on first use and cached: the frozen merged word set, a trie of the words for greedy longest match
+# scoring, and the max word length. Call warmup_lexicons() before forking worker processes, so the lexicons are built once
+# and the workers share them copy-on-write instead of each building their own.
+# The word lists themselves are loaded lazily from the binary lexicon file of lexicon_store, so a process only
+# builds the sets of the langs it uses. Import all_stopwords, flagged_words and banned_words from here.
+
+import gc
+import numpy as np
+from collections import Counter
+from collections.abc import Mapping
+from .lexicon_store import load_word_list
+from .cjk import lang_is_cjk
+
+all_stopwords = load_word_list("stopwords")
+flagged_words = load_word_list("flagged_words")
+banned_words = load_word_list("banned_words")
+word_lists = {"stopwords": all_stopwords, "flagged_words": flagged_words, "banned_words": banned_words}
+
+# the langs whose words are merged into the lexicon of every lang of a word list. e.g., english flagged words are flagged in every lang.
+lexicon_merges = {"flagged_words": ("en",), "banned_words": ("en",)}
+
+_TRIE_END = None
+_lexicons = {}
+
+
+def build_word_trie(words, is_cjk=False):
+  """ a trie of dicts over the space separated tokens (or the chars for CJK) of words. A node with the key None ends a word. """
+  trie = {}
+  for word in words:
+    node = trie
+    for token in (word if is_cjk else word.split(" ")):
+      node = node.setdefault(token, {})
+    node[_TRIE_END] = True
+  return trie
+
+
+def count_word_matches(trie, s_arr, max_word_len):
+  """
+  returns (number of matches, number of tokens and matches) when greedily matching the longest word of at most max_word_len tokens
+  at each position of s_arr, and skipping the tokens of each match.
+  """
+  len_s = len(s_arr)
+  get = trie.get
+  i = match_cnt = total_cnt = 0
+  while i < len_s:
+    total_cnt += 1
+    # most tokens don't start a word, so check the first token before setting up the walk
+    node = get(s_arr[i])
+    if node is None or max_word_len < 1:
+      i += 1
+      continue
+    limit = min(len_s, i+max_word_len)
+    j = i+1
+    match_end = j if _TRIE_END in node else 0
+    while j < limit:
+      node = node.get(s_arr[j])
+      if node is None: break
+      j += 1
+      if _TRIE_END in node: match_end = j
+    if match_end:
+      match_cnt += 1
+      i = match_end
+    else:
+      i += 1
+  return match_cnt, total_cnt
+
+
+def max_word_len(words, is_cjk=False):
+  """ the number of tokens (chars for CJK) of the longest word. """
+  return max(len(s) if is_cjk else s.count(" ")+1 for s in words)
+
+
+class Lexicon:
+    """
+    The words of word list name for lang, merged with the words of the merge langs, as a frozenset and a trie.
+    is_cjk: whether words are matched by char instead of by space separated token.
+    max_word_len: the longest word of lang itself (without the merge langs), which is how deep the scorers match,
+      or None if the word list has no lang.
+    """
+    __slots__ = ("name", "lang", "merge", "is_cjk", "words", "trie", "max_word_len")
+
+    def __init__(self, name, lang, merge=()):
+        lists = word_lists[name]
+        self.name = name
+        self.lang = lang
+        self.merge = tuple(merge)
+        self.is_cjk = lang_is_cjk(lang)
+        words = set(lists.get(lang, ()))
+        for lang2 in self.merge:
+          words.update(lists.get(lang2, ()))
+        self.words = frozenset(words)
+        self.trie = build_word_trie(self.words, self.is_cjk)
+        self.max_word_len = max_word_len(lists[lang], self.is_cjk) if lists.get(lang) else None
+
+    def __contains__(self, word):
+        return word in self.words
+
+    def __len__(self):
+        return len(self.words)
+
+    def count_matches(self, s_arr, max_word_len):
+        """ see count_word_matches """
+        return count_word_matches(self.trie, s_arr, max_word_len)
+
+
+def get_lexicon(name, lang, merge=None):
+  """ the cached Lexicon of word list name ("stopwords", "flagged_words" or "banned_words") for lang. merge defaults to lexicon_merges. """
+  if merge is None: merge = lexicon_merges.get(name, ())
+  key = (name, lang, tuple(merge))
+  lexicon = _lexicons.get(key)
+  if lexicon is None:
+    lexicon = _lexicons[key] = Lexicon(name, lang, merge)
+  return lexicon
+
+
+class MaxWordLens(Mapping):
+    """ lang -> max_word_len of the lexicons of a word list, e.g., filtering.lang_2_max_stopword_len. Computed on first use. """
+    def __init__(self, name):
+        self.name = name
+
+    def __getitem__(self, lang):
+        if not word_lists[self.name].get(lang): raise KeyError(lang)
+        return get_lexicon(self.name, lang).max_word_len
+
+    def __iter__(self):
+        lists = word_lists[self.name]
+        if hasattr(lists, "num_words"):
+          return (lang for lang in lists if lists.num_words(lang))
+        return (lang for lang, words in lists.items() if words)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class WordLangIndex:
+    """
+    An inverted index of the lexicons of every lang of word list name: token (char for CJK langs) -> the ids of the langs
+    whose words start with it, and the ids of the langs whose words contain it. From one pass over the tokens of a text,
+    upper_bounds gives a bound on the match ratio of count_word_matches for every lang, without matching each lang.
+    langs: the langs of the word list, in the order of the word list. is_cjk, is_empty: masks of the langs.
+    """
+    __slots__ = ("name", "langs", "is_cjk", "is_empty", "index")
+
+    def __init__(self, name):
+        self.name = name
+        self.langs = list(word_lists[name])
+        self.is_cjk = np.array([lang_is_cjk(lang) for lang in self.langs], dtype=bool)
+        self.is_empty = np.zeros(len(self.langs), dtype=bool)
+        first_index, any_index = {}, {}
+        for i, lang in enumerate(self.langs):
+          lexicon = get_lexicon(name, lang)
+          self.is_empty[i] = not lexicon.words
+          for word in lexicon.words:
+            tokens = word if lexicon.is_cjk else word.split(" ")
+            if not tokens: continue
+            first_index.setdefault(tokens[0], set()).add(i)
+            for token in tokens:
+              any_index.setdefault(token, set()).add(i)
+        # token -> (lang ids of the words that start with it, lang ids of the words that contain it)
+        self.index = {token: (np.array(sorted(first_index.get(token, ())), dtype=np.int64), np.array(sorted(ids), dtype=np.int64)) \
+                      for token, ids in any_index.items()}
+
+    def upper_bounds(self, s_arr, cjk_s_arr):
+        """
+        for each lang, an upper bound of match_cnt/total_cnt of count_word_matches over s_arr (the tokens of a text), or
+        over cjk_s_arr (its chars) for a CJK lang. A match starts at a token that starts a word, and every token in no word
+        of the lang is counted but not matched, so with v tokens that start a word and u tokens in no word, the ratio is at most v/(v+u).
+        """
+        bounds = np.zeros(len(self.langs), dtype=np.float64)
+        get = self.index.get
+        for is_cjk, tokens in ((False, s_arr), (True, cjk_s_arr)):
+          if not len(tokens): continue
+          token_counts = Counter(tokens)
+          found = [(entry, cnt) for entry, cnt in zip(map(get, token_counts), token_counts.values()) if entry is not None]
+          if not found: continue
+          firsts, anys, counts = [entry[0] for entry, _ in found], [entry[1] for entry, _ in found], [cnt for _, cnt in found]
+          starts = np.bincount(np.concatenate(firsts), weights=np.repeat(counts, [len(ids) for ids in firsts]), minlength=len(self.langs))
+          known = np.bincount(np.concatenate(anys), weights=np.repeat(counts, [len(ids) for ids in anys]), minlength=len(self.langs))
+          unknown = len(tokens) - known
+          with np.errstate(divide="ignore", invalid="ignore"):
+            lang_bounds = np.where(starts > 0, starts/(starts+unknown), 0.0)
+          mask = self.is_cjk if is_cjk else ~self.is_cjk
+          bounds[mask] = lang_bounds[mask]
+        return bounds
+
+
+def get_word_lang_index(name):
+  """ the cached WordLangIndex of word list name. """
+  key = ("word_lang_index", name)
+  index = _lexicons.get(key)
+  if index is None:
+    index = _lexicons[key] = WordLangIndex(name)
+  return index
+
+
+def warmup_lexicons(names=None, langs=None, freeze=True):
+  """
+  build the lexicons of word lists names (default all) for langs (default every lang of the list), e.g., before forking workers.
+  freeze: move everything allocated so far into the permanent gc generation (gc.freeze), so the collector in the workers
+    doesn't write to the pages of the lexicons and un-share them.
+  """
+  for name in (word_lists if names is None else names):
+    for lang in (word_lists[name] if langs is None else langs):
+      get_lexicon(name, lang)
+  #lang_id guesses the lang of low confidence documents from the stopword index
+  if langs is None and "stopwords" in (word_lists if names is None else names):
+    get_word_lang_index("stopwords")
+  if freeze: gc.freeze()
@@ -0,0 +1,165 @@
+#@title Lexicon Store Code
+"""
+Copyright, 2021-2022 Ontocord, LLC, All rights reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# A compact binary form of the word lists in stopwords.py, flagged_words.py and banned_words.py.
+# Importing those modules parses a ~600KB python literal into hundreds of sets, in every process and every spawned worker,
+# even though a process usually only scores a few langs. compile_lexicons() writes all the word lists into one file:
+#   the magic, the length of a json index of word list -> lang -> [first, end) string ids, the json index,
+#   the byte offsets of the strings (uint64, 8 byte aligned), and the utf8 strings, each followed by "\n".
+# The strings of each lang are sorted, so a word can be looked up by binary search without building the set.
+# load_word_list() mmaps the file and returns a LazyWordLists, which has the same lang -> set of words API as the
+# dicts, but only builds the set of a lang on first access. The file is rebuilt when a word list module is newer than it.
+
+import os, json, mmap, struct
+import importlib
+from collections.abc import Mapping
+
+LEXICON_MAGIC = b"RBLEX001"
+default_lexicon_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lexicons.bin")
+
+# word list name -> (module, variable) of its source
+word_list_sources = {"stopwords": ("stopwords", "all_stopwords"), "flagged_words": ("flagged_words", "flagged_words"), \
+                     "banned_words": ("banned_words", "banned_words")}
+
+_stores = {}
+
+
+def _source_word_lists(name):
+  module, var = word_list_sources[name]
+  return getattr(importlib.import_module(f".{module}", __package__), var)
+
+
+def _source_path(name):
+  return os.path.join(os.path.dirname(os.path.abspath(__file__)), word_list_sources[name][0]+".py")
+
+
+def compile_lexicons(path=None, names=None):
+  """ write the word lists names (default all of word_list_sources) into the binary lexicon file at path. """
+  if path is None: path = default_lexicon_path
+  index, words = {}, []
+  for name in (word_list_sources if names is None else names):
+    index[name] = {}
+    for lang, lang_words in _source_word_lists(name).items():
+      lang_words = sorted(set(lang_words))
+      assert not any("\n" in word for word in lang_words), f"{name} {lang} has a word with a newline"
+      index[name][lang] = [len(words), len(words)+len(lang_words)]
+      words.extend(lang_words)
+  index = json.dumps(index).encode("utf8")
+  index += b" " * (-(len(LEXICON_MAGIC)+8+len(index)) % 8)
+  offsets, pos = [], 0
+  for word in words:
+    offsets.append(pos)
+    pos += len(word.encode("utf8"))+1
+  offsets.append(pos)
+  # write to a temp file and rename it, so other processes never mmap a partial file
+  tmp_path = f"{path}.{os.getpid()}.tmp"
+  with open(tmp_path, "wb") as f:
+    f.write(LEXICON_MAGIC)
+    f.write(struct.pack("<Q", len(index)))
+    f.write(index)
+    f.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+    f.write("".join(word+"\n" for word in words).encode("utf8"))
+  os.replace(tmp_path, path)
+
+
+def _open_store(path):
+  """ the (mmap, index, offsets, start of the strings) of the lexicon file at path, opened once per process. """
+  store = _stores.get(path)
+  if store is None:
+    with open(path, "rb") as f:
+      mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm[:len(LEXICON_MAGIC)] != LEXICON_MAGIC: raise ValueError(f"{path} is not a lexicon file")
+    index_len, = struct.unpack_from("<Q", mm, len(LEXICON_MAGIC))
+    index_start = len(LEXICON_MAGIC)+8
+    index = json.loads(mm[index_start:index_start+index_len])
+    num_words = max((end for langs in index.values() for _, end in langs.values()), default=0)
+    offsets_start = index_start+index_len
+    offsets = memoryview(mm)[offsets_start:offsets_start+8*(num_words+1)].cast("Q")
+    store = _stores[path] = (mm, index, offsets, offsets_start+8*(num_words+1))
+  return store
+
+
+class LazyWordLists(Mapping):
+    """
+    lang -> set of words of one word list of a binary lexicon file, with the same API as the all_stopwords or flagged_words
+    dicts. The set of a lang is built from the file on first access and cached.
+    """
+    def __init__(self, name, path=None):
+        self.name = name
+        self.path = default_lexicon_path if path is None else path
+        self._mm, index, self._offsets, self._strings_start = _open_store(self.path)
+        self._ranges = index[name]
+        self._sets = {}
+
+    def __getitem__(self, lang):
+        words = self._sets.get(lang)
+        if words is None:
+            first, end = self._ranges[lang]
+            start, stop = self._offsets[first], self._offsets[end]
+            segment = self._mm[self._strings_start+start:self._strings_start+stop].decode("utf8")
+            words = self._sets[lang] = set(segment.split("\n")[:-1])
+        return words
+
+    def __contains__(self, lang):
+        return lang in self._ranges
+
+    def __iter__(self):
+        return iter(self._ranges)
+
+    def __len__(self):
+        return len(self._ranges)
+
+    def num_words(self, lang):
+        """ the number of words of lang, without building its set. """
+        first, end = self._ranges.get(lang, (0, 0))
+        return end-first
+
+    def _word(self, i):
+        start = self._strings_start+self._offsets[i]
+        return self._mm[start:self._strings_start+self._offsets[i+1]-1].decode("utf8")
+
+    def has_word(self, lang, word):
+        """ whether word is a word of lang, by binary search of the file, without building the set of lang. """
+        if lang in self._sets: return word in self._sets[lang]
+        first, end = self._ranges.get(lang, (0, 0))
+        while first < end:
+          mid = (first+end)//2
+          if self._word(mid) < word:
+            first = mid+1
+          else:
+            end = mid
+        return first < self._ranges.get(lang, (0, 0))[1] and self._word(first) == word
+
+    def materialize(self, langs=None):
+        """ build the sets of langs (default all), e.g., before forking workers. """
+        for lang in (self._ranges if langs is None else langs):
+          self[lang]
+
+
+def load_word_list(name, path=None):
+  """
+  the word list name as a LazyWordLists of the binary lexicon file at path (default lexicons.bin next to this module).
+  The file is compiled first if it is missing or older than the word list modules. If it can't be written,
+  e.g., on a read only install, this falls back to the dict of the word list module.
+  """
+  if path is None: path = default_lexicon_path
+  if path not in _stores:
+    try:
+      mtime = os.path.getmtime(path) if os.path.exists(path) else None
+      if mtime is None or any(os.path.exists(_source_path(name2)) and os.path.getmtime(_source_path(name2)) > mtime \
+                              for name2 in word_list_sources):
+        compile_lexicons(path)
+    except OSError:
+      return _source_word_lists(name)
+  return LazyWordLists(name, path)
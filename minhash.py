@@ -0,0 +1,233 @@
+#@title MinHash LSH Code
+"""
+Copyright, 2021-2022 Ontocord, LLC, All rights reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# MinHash + LSH banding near duplicate detection, as an alternative to the simhash codes in simhash.py.
+# The permutations are the usual (a*x + b) mod p universal hashes (see datasketch), over the same shingles as simhash.hashing.
+# A document's signature is num_perm uint32 minimums. Documents whose signatures agree on all the rows of any band
+# become candidates, and candidates are kept if their estimated jaccard similarity is at least threshold.
+
+import hashlib
+import random
+import time
+import numpy as np
+from .simhash import shingle_hashes, hashing_batch, find_all, find_clusters_union_find, clusters_to_dicts, _sorted_unique
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+def get_permutations(num_perm=128, seed=1):
+  """ the (a, b) coefficients of num_perm hash functions. The same seed must be used for signatures that are compared. """
+  gen = np.random.RandomState(seed)
+  a = gen.randint(1, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+  b = gen.randint(0, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+  return a, b
+
+_default_permutations = {}
+
+def minhash(
+    document: str,
+    num_perm: int = 128,
+    tokenization: str = "character",
+    window_size: int = 5,
+    ignore_punctuation: bool = True,
+    lowercase: bool = True,
+    seed: int = 1,
+    max_shingles_per_chunk: int = 4096
+):
+    """
+    MinHash signature of a document as a uint32 array of size num_perm.
+    tokenization, window_size, ignore_punctuation, lowercase: same as simhash.hashing.
+    """
+    if (num_perm, seed) not in _default_permutations:
+      _default_permutations[(num_perm, seed)] = get_permutations(num_perm, seed)
+    a, b = _default_permutations[(num_perm, seed)]
+    hv = _sorted_unique(shingle_hashes(document, tokenization=tokenization, window_size=window_size, \
+                                       ignore_punctuation=ignore_punctuation, lowercase=lowercase) & _MAX_HASH)
+    signature = np.full(num_perm, _MAX_HASH, dtype=np.uint64)
+    for rng in range(0, len(hv), max_shingles_per_chunk):
+      # (shingles x num_perm) permuted values. a*x overflows uint64 the same way datasketch does.
+      phv = ((np.outer(hv[rng:rng+max_shingles_per_chunk], a) + b) % _MERSENNE_PRIME) & _MAX_HASH
+      signature = np.minimum(signature, phv.min(axis=0))
+    return signature.astype(np.uint32)
+
+
+def minhash_batch(documents, num_perm=128, tokenization="character", window_size=5, ignore_punctuation=True, lowercase=True, seed=1):
+  """ (len(documents), num_perm) array of minhash signatures. """
+  if not documents: return np.zeros((0, num_perm), dtype=np.uint32)
+  return np.vstack([minhash(document, num_perm=num_perm, tokenization=tokenization, window_size=window_size, \
+                            ignore_punctuation=ignore_punctuation, lowercase=lowercase, seed=seed) for document in documents])
+
+
+def minhash_codes(signatures):
+  """ a 64 bit int id for each signature, the equivalent of the simhash code, e.g., for hash2cluster and cluster2hash. """
+  signatures = np.ascontiguousarray(np.atleast_2d(signatures), dtype=np.uint32)
+  return np.array([int.from_bytes(hashlib.md5(row.tobytes()).digest()[:8], "big") for row in signatures], dtype=np.uint64)
+
+
+class MinHashLSH:
+    """
+    An incremental LSH index over minhash signatures.
+    num_bands * rows_per_band must be num_perm. More bands finds pairs with lower similarity, at the cost of more candidates.
+    The probability two documents with jaccard similarity s become candidates is 1 - (1 - s^rows_per_band)^num_bands.
+    threshold: min estimated jaccard similarity (fraction of equal signature values) for a candidate to be a match.
+    Signatures are numbered by insertion order. They are kept in a buffer that doubles when full, so inserting one at a time
+    is amortized O(1) copying.
+    """
+    def __init__(self, num_perm=128, num_bands=32, threshold=0.5):
+        assert num_perm % num_bands == 0, "num_perm must be a multiple of num_bands"
+        self.num_perm = num_perm
+        self.num_bands = num_bands
+        self.rows_per_band = num_perm // num_bands
+        self.threshold = threshold
+        self.buckets = [{} for _ in range(num_bands)]
+        self._signatures = np.zeros((0, num_perm), dtype=np.uint32)
+        self.num_signatures = 0
+
+    def __len__(self):
+        return self.num_signatures
+
+    @property
+    def signatures(self):
+        """ the (len, num_perm) indexed signatures, by id. """
+        return self._signatures[:self.num_signatures]
+
+    def _append(self, signatures):
+        end = self.num_signatures + len(signatures)
+        if end > len(self._signatures):
+          grown = np.zeros((max(end, 2*len(self._signatures), 16), self.num_perm), dtype=np.uint32)
+          grown[:self.num_signatures] = self.signatures
+          self._signatures = grown
+        self._signatures[self.num_signatures:end] = signatures
+        self.num_signatures = end
+
+    def band_keys(self, signatures):
+        """ (n, num_bands) uint64 key of the rows of each band. """
+        bands = np.asarray(signatures, dtype=np.uint64).reshape(-1, self.num_bands, self.rows_per_band)
+        keys = np.zeros(bands.shape[:2], dtype=np.uint64)
+        for r in range(self.rows_per_band):
+          keys = keys * np.uint64(0x100000001B3) + bands[:, :, r]
+        return keys
+
+    def _verify(self, qsignatures, qidx, ids, threshold):
+        similarity = (qsignatures[qidx] == self.signatures[ids]).mean(axis=1)
+        keep = similarity >= threshold
+        return qidx[keep], ids[keep], similarity[keep]
+
+    def query(self, signatures, threshold=None):
+        """ returns (query_idx, ids, similarity) for every indexed signature that matches a query. """
+        if threshold is None: threshold = self.threshold
+        signatures = np.atleast_2d(np.asarray(signatures, dtype=np.uint32))
+        qidx, ids = [], []
+        for i, keys in enumerate(self.band_keys(signatures).tolist()):
+          candidates = set()
+          for bucket, key in zip(self.buckets, keys):
+            candidates.update(bucket.get(key, ()))
+          qidx.extend([i]*len(candidates))
+          ids.extend(candidates)
+        return self._verify(signatures, np.array(qidx, dtype=np.int64), np.array(ids, dtype=np.int64), threshold)
+
+    def insert(self, signatures, threshold=None):
+        """
+        add signatures to the index. returns (new_ids, pairs) where pairs is an (n, 2) array of
+        (new id, earlier id) matches, including matches among the new signatures.
+        """
+        if threshold is None: threshold = self.threshold
+        signatures = np.atleast_2d(np.asarray(signatures, dtype=np.uint32))
+        start = len(self)
+        self._append(signatures)
+        qidx, ids = [], []
+        for i, keys in enumerate(self.band_keys(signatures).tolist()):
+          candidates = set()
+          for bucket, key in zip(self.buckets, keys):
+            items = bucket.get(key)
+            if items is None:
+              bucket[key] = [start+i]
+            else:
+              candidates.update(items)
+              items.append(start+i)
+          qidx.extend([i]*len(candidates))
+          ids.extend(candidates)
+        new_ids = np.arange(start, start+len(signatures), dtype=np.int64)
+        qidx, ids, _ = self._verify(signatures, np.array(qidx, dtype=np.int64), np.array(ids, dtype=np.int64), threshold)
+        return new_ids, np.stack([new_ids[qidx], ids], axis=1)
+
+
+def index_clusters_minhash(signatures, num_bands=32, threshold=0.5, lsh=None):
+  """
+  Find clusters of near duplicate minhash signatures. Returns hash2cluster and cluster2hash dicts like index_clusters_python,
+  where the ids are the minhash_codes of the signatures.
+  Pass an lsh (MinHashLSH) to cluster incrementally against earlier signatures. Its signatures are included in the result.
+  """
+  signatures = np.atleast_2d(np.asarray(signatures, dtype=np.uint32))
+  if lsh is None: lsh = MinHashLSH(signatures.shape[1], num_bands, threshold)
+  _, pairs = lsh.insert(signatures)
+  codes = minhash_codes(lsh.signatures)
+  return clusters_to_dicts(*find_clusters_union_find(codes, codes[pairs.ravel()].reshape(-1, 2)))
+
+
+def _pair_precision_recall(labels, pred_clusters):
+  """ pairwise precision and recall of predicted clusters (lists of doc indexes) against the true group label of each doc. """
+  true_pairs = set()
+  groups = {}
+  for i, label in enumerate(labels): groups.setdefault(label, []).append(i)
+  for docs in groups.values():
+    true_pairs.update((a, b) for a in docs for b in docs if a < b)
+  pred_pairs = set()
+  for docs in pred_clusters:
+    pred_pairs.update((a, b) for a in docs for b in docs if a < b)
+  tp = len(true_pairs & pred_pairs)
+  return tp/max(1, len(pred_pairs)), tp/max(1, len(true_pairs))
+
+
+def benchmark_minhash_vs_simhash(num_base_docs=500, dups_per_doc=2, doc_len=300, edit_rate=0.05, \
+                                 window_size=24, num_blocks=6, hamming_distance=3, \
+                                 minhash_window_size=5, num_perm=128, num_bands=32, threshold=0.5):
+  """
+  Compare simhash and minhash dedup on a synthetic corpus of random documents, each with dups_per_doc copies
+  where edit_rate of the words were replaced. Prints and returns the pairwise precision, recall and docs/sec of each.
+  """
+  words = ["".join(random.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(random.randint(2, 9))) for _ in range(20000)]
+  docs, labels = [], []
+  for label in range(num_base_docs):
+    base = [random.choice(words) for _ in range(doc_len)]
+    docs.append(" ".join(base))
+    labels.append(label)
+    for _ in range(dups_per_doc):
+      docs.append(" ".join(w if random.random() > edit_rate else random.choice(words) for w in base))
+      labels.append(label)
+  ret = {}
+
+  st = time.time()
+  codes = np.array(hashing_batch(docs, window_size=window_size), dtype=np.uint64)
+  nodes, node2cluster, _, _, _ = find_clusters_union_find(codes, find_all(codes, num_blocks, hamming_distance, engine="numpy"))
+  simhash_time = time.time() - st
+  doc2cluster = node2cluster[np.searchsorted(nodes, codes)]
+  clusters = {}
+  for i, cluster in enumerate(doc2cluster.tolist()):
+    if cluster >= 0: clusters.setdefault(cluster, []).append(i)
+  precision, recall = _pair_precision_recall(labels, clusters.values())
+  ret["simhash"] = {"precision": precision, "recall": recall, "docs_per_sec": len(docs)/simhash_time}
+
+  st = time.time()
+  signatures = minhash_batch(docs, num_perm=num_perm, window_size=minhash_window_size)
+  _, pairs = MinHashLSH(num_perm, num_bands, threshold).insert(signatures)
+  nodes, node2cluster, _, _, _ = find_clusters_union_find(np.arange(len(docs)), pairs)
+  minhash_time = time.time() - st
+  clusters = {}
+  for i, cluster in zip(nodes.tolist(), node2cluster.tolist()):
+    if cluster >= 0: clusters.setdefault(cluster, []).append(i)
+  precision, recall = _pair_precision_recall(labels, clusters.values())
+  ret["minhash"] = {"precision": precision, "recall": recall, "docs_per_sec": len(docs)/minhash_time}
+  print (ret)
+  return ret
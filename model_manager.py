@@ -0,0 +1,118 @@
+#@title Model Manager Code
+"""
+Copyright, 2021-2022 Ontocord, LLC, All rights reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# A registry of the models used by the managers (the fasttext lang id model, the mt5 tokenizer, the easyocr readers),
+# so that importing a manager doesn't load its models. Each manager registers a loader with register_model, and the
+# model is loaded on the first get_model. A parent process that forks workers can call preload() first, so that the
+# workers share the loaded models copy-on-write instead of each loading their own. With freeze=True, preload also
+# moves everything into the permanent gc generation (gc.freeze), so the collector in the workers doesn't write to
+# the pages of the models and un-share them.
+# benchmark_import_time measures the time and peak rss of importing each manager in a fresh interpreter.
+
+import gc, os, sys, json, subprocess, threading, time
+
+_model_loaders = {}
+_models = {}
+_lock = threading.RLock()
+
+
+def _reset_lock():
+  # a fork while another thread holds the lock would leave it held forever in the child
+  global _lock
+  _lock = threading.RLock()
+
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child=_reset_lock)
+
+
+def register_model(name, loader):
+  """ register loader, a function with no args that returns the model, as the loader of model name. """
+  _model_loaders[name] = loader
+
+
+def registered_models():
+  return list(_model_loaders)
+
+
+def is_loaded(name):
+  return name in _models
+
+
+def get_model(name):
+  """ the model name, which is loaded by its registered loader on first use, and cached for the life of the process. """
+  model = _models.get(name)
+  if model is None:
+    with _lock:
+      model = _models.get(name)
+      if model is None:
+        if name not in _model_loaders: raise KeyError(f"no model registered as {name}")
+        model = _models[name] = _model_loaders[name]()
+  return model
+
+
+def unload_model(name):
+  """ drop the cached model name, e.g., to free its memory. It is loaded again on the next get_model. """
+  with _lock:
+    _models.pop(name, None)
+
+
+def preload(names=None, freeze=True):
+  """
+  load the models names (default every registered model), e.g., in the parent process before forking workers.
+  freeze: gc.freeze() after loading, so the workers share the pages of the models copy-on-write.
+  """
+  for name in (registered_models() if names is None else names):
+    get_model(name)
+  if freeze: gc.freeze()
+
+
+def benchmark_import_time(modules=("filtering", "langid_manager", "kenlm_manager", "pdf_and_ocr"), package=None, preload_models=False):
+  """
+  the secs and peak rss (MB) of importing each of modules of package (default this package) in a fresh interpreter,
+  and of also loading their models if preload_models. Modules that fail to import, e.g., for a missing dependency, have their error instead.
+  """
+  if package is None: package = __package__
+  parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  code = "import os, sys, time, json, importlib\n" \
+         "try:\n  import resource\nexcept ImportError:\n  resource = None\n" \
+         "st = time.time()\n" \
+         "module = importlib.import_module(sys.argv[1])\n" \
+         "import_secs = time.time() - st\n" \
+         "ret = {'import_secs': import_secs}\n" \
+         "if sys.argv[2] == '1':\n" \
+         "  model_manager = importlib.import_module(sys.argv[3])\n" \
+         "  st = time.time()\n" \
+         "  model_manager.preload(freeze=False)\n" \
+         "  ret['preload_secs'] = time.time() - st\n" \
+         "if os.path.exists('/proc/self/status'):\n" \
+         "  # ru_maxrss on linux includes the rss of the parent before the exec, so read the peak of this process\n" \
+         "  hwm = [line for line in open('/proc/self/status') if line.startswith('VmHWM:')]\n" \
+         "  if hwm: ret['peak_rss_mb'] = int(hwm[0].split()[1]) / 1024\n" \
+         "elif resource is not None:\n" \
+         "  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n" \
+         "  ret['peak_rss_mb'] = rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024\n" \
+         "print(json.dumps(ret))\n"
+  env = dict(os.environ)
+  env["PYTHONPATH"] = parent + (os.pathsep + env["PYTHONPATH"] if env.get("PYTHONPATH") else "")
+  ret = {}
+  for module in modules:
+    st = time.time()
+    proc = subprocess.run([sys.executable, "-c", code, f"{package}.{module}", "1" if preload_models else "0", f"{package}.model_manager"], \
+                          capture_output=True, text=True, env=env)
+    if proc.returncode == 0:
+      ret[module] = json.loads(proc.stdout.strip().splitlines()[-1])
+    else:
+      ret[module] = {"error": proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"exit code {proc.returncode}"}
+    ret[module]["wall_secs"] = time.time() - st
+  return ret
@@ -1,4 +1,4 @@
-import easyocr, math
+import math
 import tempfile, os
 import string
 import pdfplumber
@@ -8,6 +8,7 @@ from pdfminer.image import ImageWriter
 from pdfminer.pdfdocument import PDFDocument
 from pdfminer.pdfparser import PDFParser
 from PIL import Image
+from .model_manager import register_model, get_model
 
 punc_and_space = string.punctuation + "¿？,،、º。゜ "
 lst1 = ['en', 'af', 'az', 'bs', 'cs', 'cy', 'da', 'de', 'es', 'et', 'fr', 'ga', 'hr', 'hu', 'id', 'is', 'it', 'ku', 'la', 'lt', 'lv', 'mi', 'ms', 'mt', 'nl', 'no', 'oc', 'pi', 'pl', 'pt', 'ro', 'rs_latin', 'sk', 'sl', 'sq', 'sv', 'sw', 'tl', 'tr', 'uz', 'vi', ]
@@ -24,19 +25,43 @@ lst11 = ['en', 'ta', ]
 lst12 = ['en', 'te', ]
 lst13 = ['en', 'kn']
 #not working: #'sa', 'bgc', 'mni', 
+ocr_lang_lists = [lst1, lst2, lst3, lst4, lst5, lst6, lst7, lst8, lst9, lst10, lst11, lst12, lst13]
 try:
-  if ocr_lang2reader is not None: pass
+  if most_recently_used_model is not None: pass
 except:
   most_recently_used_model = None
   most_recently_used_langs =  None
-  ocr_lang2reader = {}
+
+def _load_ocr_readers():
+  import easyocr
   all_ocr_readers = []
-  for lst in [lst1, lst2, lst3, lst4, lst5, lst6, lst7, lst8, lst9, lst10, lst11, lst12, lst13]:
+  for lst in ocr_lang_lists:
     ocr_reader = easyocr.Reader(lst) 
     all_ocr_readers.append([ocr_reader, [lst]])
+  return all_ocr_readers
+
+#the 13 easyocr readers are loaded on first use. see model_manager.preload to load them before forking workers.
+register_model("easyocr_readers", _load_ocr_readers)
+
+def _load_ocr_lang2reader():
+  ocr_lang2reader = {}
+  for ocr_reader, (lst,) in get_model("easyocr_readers"):
     for lang in lst:
       if lang not in ocr_lang2reader:
         ocr_lang2reader[lang] = ocr_reader
+  return ocr_lang2reader
+
+#derived from the easyocr readers, so it is built once after they load and cached with them.
+register_model("ocr_lang2reader", _load_ocr_lang2reader)
+
+def get_ocr_lang2reader():
+  return get_model("ocr_lang2reader")
+
+#served lazily, so these are not exported by "from .pdf_and_ocr import *". use get_model or pdf_and_ocr.<name>.
+def __getattr__(name):
+  if name == "all_ocr_readers": return get_model("easyocr_readers")
+  if name == "ocr_lang2reader": return get_model("ocr_lang2reader")
+  raise AttributeError(f"module {__name__} has no attribute {name}")
 
 trannum = str.maketrans("0123456789", "1111111111")
 
@@ -60,6 +85,7 @@ def do_ocr_imgs(all_images, ocr_threshold=0.70, ocr_threshold2 = None, min_len=2
     best_text2 = None
     best_ret = None
     best_score = 0.0
+    all_ocr_readers = get_model("easyocr_readers")
     for reader, langs in [(most_recently_used_model, most_recently_used_langs)]+ [a for a in all_ocr_readers if a[0] != most_recently_used_model]:
       if reader is None: 
         continue
@@ -11,7 +11,13 @@ from typing import Dict, Set
 import tqdm 
 import random
 import itertools
-import faiss
+import hashlib
+import time
+import bisect
+from .hamming_index import HammingIndex, find_all_numpy, prefix_group_pairs, unique_pairs
+import multiprocessing
+from .dedup_manager import cleanup_dup_store, increment_dup_store
+from .suffix_array_dedup import suffix_array
 
 PUNCTUATION_REGEX = re.compile(r"\p{P}")
 DIGIT_REGEX = re.compile(r"\d")
@@ -82,49 +88,317 @@ def hashing(
     return int(simhash.compute(map(simhash.unsigned_hash, tokens)))
 
 
-def index_clusters_batch_python(visited, hash2cluster, cluster2hash, hashes, num_blocks, hamming_distance):
+def _window_byte_spans(document, tokenization, window_size):
+  """
+  Returns the utf8 bytes of the (normalized) document and the (start, end) byte offsets of every token window that 
+  hashing() would have encoded, so that each window is a slice of one encoded buffer instead of a new str + encode.
+  """
+  if tokenization == "character":
+    document = " ".join(document.split())
+    data = str.encode(document)
+    num_windows = len(document) - window_size
+    if num_windows <= 0:
+      return data, np.zeros(1, dtype=np.int64), np.array([len(data)], dtype=np.int64)
+    if len(data) == len(document):
+      offsets = np.arange(len(document)+1, dtype=np.int64)
+    else:
+      # utf8 width of each codepoint
+      cps = np.frombuffer(document.encode("utf-32-le"), dtype=np.uint32)
+      offsets = np.zeros(len(cps)+1, dtype=np.int64)
+      np.cumsum(1 + (cps >= 0x80) + (cps >= 0x800) + (cps >= 0x10000), out=offsets[1:])
+    return data, offsets[:num_windows], offsets[window_size:window_size+num_windows]
+  if tokenization == "punctuation":
+    tokens0 = PUNCTUATION_REGEX.split(document)
+  elif tokenization == "space":
+    tokens0 = document.split(" ")
+  else:
+    raise Exception(f"Unrecognized tokenization spanmeter {tokenization}")
+  # the windows are " ".join(tokens0[i : i + window_size]), which are just slices of " ".join(tokens0)
+  data = str.encode(" ".join(tokens0))
+  lens = np.fromiter((len(str.encode(t)) for t in tokens0), dtype=np.int64, count=len(tokens0))
+  starts = np.zeros(len(tokens0), dtype=np.int64)
+  np.cumsum(lens[:-1]+1, out=starts[1:])
+  num_windows = len(tokens0) - window_size
+  if num_windows <= 0:
+    return data, starts, starts+lens
+  return data, starts[:num_windows], starts[window_size-1:window_size-1+num_windows] + lens[window_size-1:window_size-1+num_windows]
+
+
+def hashing_batch(
+    documents,
+    tokenization: str = "character",
+    window_size: int = 20,
+    ignore_punctuation: bool = True,
+    lowercase: bool = True,
+    max_windows_per_chunk: int = 1<<16
+):
+    """Hashing a list of documents with SimHash. 
+    Returns the same codes as [hashing(doc, ...) for doc in documents], bit for bit, 
+    so fingerprints created with either function can be mixed.
+    spanmeters
+    ----------
+    documents : list of str
+        The texts to hash
+    tokenization, window_size, ignore_punctuation, lowercase : 
+        Same as hashing()
+    max_windows_per_chunk : int, optional
+        Number of token windows whose bits are accumulated at once. The (windows x 64) uint8 bit matrix and the
+        int32 counts are about 64 and 256 bytes per window, so the default is about 20MB, also for a single long document.
+    Returns
+    -------
+    list of int: The hash codes
+    """
+    md5 = hashlib.md5
+    ret = []
+    digests, doc_starts, num_windows = [], [], 0
+    def flush():
+      # the first 8 bytes of the md5 digest is simhash.unsigned_hash. 
+      # unpackbits orders the bits msb first, which is the order simhash.compute stores its counts in.
+      hashes = np.frombuffer(b"".join(digests), dtype=np.uint8).reshape(-1, 16)[:, :8]
+      starts = np.array(doc_starts, dtype=np.int64)
+      ones = np.zeros((len(starts), 64), dtype=np.int32)
+      # count the set bits of max_windows_per_chunk rows at a time, so a long document doesn't need one big matrix
+      for r0 in range(0, num_windows, max_windows_per_chunk):
+        r1 = min(num_windows, r0 + max_windows_per_chunk)
+        bits = np.unpackbits(hashes[r0:r1], axis=1)
+        # the documents with windows in [r0, r1): the one r0 falls in, up to the last starting before r1
+        first = int(np.searchsorted(starts, r0, side="right")) - 1
+        last = int(np.searchsorted(starts, r1, side="left"))
+        ones[first:last] += np.add.reduceat(bits, np.maximum(starts[first:last], r0) - r0, axis=0, dtype=np.int32)
+      totals = np.diff(np.append(starts, num_windows))
+      # a bit is set only if more tokens have it set than not, same as simhash.compute
+      codes = np.packbits(2*ones > totals[:, None], axis=1).view(">u8").ravel()
+      ret.extend(int(code) for code in codes)
+    for document in documents:
+      if lowercase:
+          document = document.lower()
+      if ignore_punctuation:
+          document = PUNCTUATION_REGEX.sub("", document)
+      data, starts, ends = _window_byte_spans(document, tokenization, window_size)
+      doc_starts.append(num_windows)
+      num_windows += len(starts)
+      digests.extend(md5(data[a:b]).digest() for a, b in zip(starts.tolist(), ends.tolist()))
+      if num_windows >= max_windows_per_chunk:
+        flush()
+        digests, doc_starts, num_windows = [], [], 0
+    if doc_starts: flush()
+    return ret
+
+
+def shingle_hashes(
+    document: str,
+    tokenization: str = "character",
+    window_size: int = 20,
+    ignore_punctuation: bool = True,
+    lowercase: bool = True
+):
+    """ The uint64 simhash.unsigned_hash of every token window hashing() would use for the document, as a NumPy array. 
+    Used by other fingerprints (e.g., minhash.py) so they see the same shingles as simhash. """
+    if lowercase:
+        document = document.lower()
+    if ignore_punctuation:
+        document = PUNCTUATION_REGEX.sub("", document)
+    data, starts, ends = _window_byte_spans(document, tokenization, window_size)
+    md5 = hashlib.md5
+    digests = b"".join(md5(data[a:b]).digest() for a, b in zip(starts.tolist(), ends.tolist()))
+    return np.frombuffer(digests, dtype=">u8")[::2].astype(np.uint64)
+
+
+class UnionFind:
+    """
+    Union-find over node ids 0..n-1 kept in a NumPy int array, for merging match pairs in bulk.
+    union() hooks the larger root onto the smaller root for all pairs at once, and then does full path compression 
+    by pointer jumping (parent = parent[parent]) until every node points at its root. 
+    Hooking by the smaller id (instead of by rank) keeps the bulk hooking free of cycles and makes the root of 
+    each set its smallest id, so results don't depend on the order of the pairs.
+    """
+    def __init__(self, n):
+        self.parent = np.arange(n, dtype=np.int64)
+
+    def compress(self):
+        parent = self.parent
+        while True:
+          grand_parent = parent[parent]
+          if np.array_equal(grand_parent, parent): break
+          parent = grand_parent
+        self.parent = parent
+
+    def find(self, x):
+        self.compress()
+        return self.parent[x]
+
+    def union(self, a, b):
+        a = np.asarray(a, dtype=np.int64)
+        b = np.asarray(b, dtype=np.int64)
+        while len(a):
+          self.compress()
+          ra, rb = self.parent[a], self.parent[b]
+          diff = ra != rb
+          if not diff.any(): break
+          a, b, ra, rb = a[diff], b[diff], ra[diff], rb[diff]
+          np.minimum.at(self.parent, np.maximum(ra, rb), np.minimum(ra, rb))
+        self.compress()
+
+
+def _sorted_unique(arr):
+  # np.unique is much slower than a sort for tens of millions of uint64
+  arr = np.sort(arr)
+  if len(arr): arr = arr[np.concatenate([[True], arr[1:] != arr[:-1]])]
+  return arr
+
+
+def find_clusters_union_find(hashes, matches):
+  """
+  Cluster hashes given the (hash, hash) match pairs, e.g., from simhash.find_all, with a UnionFind.
+  Returns the clusters in CSR form:
+    nodes: sorted unique uint64 hashes
+    node2cluster: for each node, the index of its cluster in cluster_ids, or -1 if it matched nothing
+    cluster_ids: uint64 id of each cluster, which is the smallest hash in the cluster
+    indptr, members: the hashes of cluster i are members[indptr[i]:indptr[i+1]]
+  """
+  if isinstance(matches, np.ndarray):
+    pairs = matches.astype(np.uint64).reshape(-1, 2)
+  else:
+    pairs = np.fromiter(itertools.chain.from_iterable(matches), dtype=np.uint64).reshape(-1, 2)
+  nodes = _sorted_unique(np.concatenate([np.asarray(hashes, dtype=np.uint64), pairs.ravel()]))
+  uf = UnionFind(len(nodes))
+  uf.union(np.searchsorted(nodes, pairs[:, 0]), np.searchsorted(nodes, pairs[:, 1]))
+  roots = uf.parent
+  sizes = np.bincount(roots, minlength=len(nodes))
+  clustered = np.flatnonzero(sizes[roots] > 1)
+  order = clustered[np.argsort(roots[clustered], kind="stable")]
+  sorted_roots = roots[order]
+  starts = np.flatnonzero(np.concatenate([[True], sorted_roots[1:] != sorted_roots[:-1]])) if len(order) else np.zeros(0, dtype=np.int64)
+  cluster_ids = nodes[sorted_roots[starts]]
+  indptr = np.append(starts, len(order)).astype(np.int64)
+  members = nodes[order]
+  node2cluster = np.full(len(nodes), -1, dtype=np.int64)
+  node2cluster[order] = np.repeat(np.arange(len(starts)), np.diff(indptr))
+  return nodes, node2cluster, cluster_ids, indptr, members
+
+
+def clusters_to_dicts(nodes, node2cluster, cluster_ids, indptr, members):
+  """ the hash2cluster and cluster2hash dicts of index_clusters_python from the CSR form of find_clusters_union_find. """
+  cluster_ids = cluster_ids.tolist()
+  hash2cluster = dict(zip(nodes.tolist(), [cluster_ids[c] if c >= 0 else -1 for c in node2cluster.tolist()]))
+  cluster2hash = {cluster_id: members[indptr[i]:indptr[i+1]].tolist() for i, cluster_id in enumerate(cluster_ids)}
+  return hash2cluster, cluster2hash
+
+
+def index_clusters_batch_python(visited, hash2cluster, cluster2hash, hashes, num_blocks, hamming_distance, engine="simhash"):
     """
     Create clusters within hamming distance. 
     Collapses a->b, b->c to all be in the same cluster.
     NOTE: this isn't always true that a and c are within hamming_distance. 
-    NOTE: The cluster_id is the hashcode of the first item in the cluster and thus can be used to do further clustering and hamming distance matching.
+    NOTE: The cluster_id is the smallest hashcode in the cluster and thus can be used to do further clustering and hamming distance matching.
+    Hashes that were clustered in an earlier batch are linked to their cluster, so clusters grow and merge across batches.
+    engine: see find_all.
     """
-    matches = simhash.find_all(hashes, num_blocks, hamming_distance)
-    graph = defaultdict(dict)
-    for x, y in matches:
-      graph[x][y] = True
-      graph[y][x] = True
-    hashes = set(hashes)
-    
-    while hashes:
-        hash = hashes.pop()
-        if hash in visited:
-            continue
-
-        # BFS to find the cluster
-        if hash not in graph:
-            hash2cluster[hash] = -1
-            continue
-
-        q = deque([hash])
+    matches = find_all(hashes, num_blocks, hamming_distance, engine=engine)
+    matches = matches.tolist() if isinstance(matches, np.ndarray) else list(matches)
+    # link to the clusters found in earlier batches
+    matches.extend((hash, hash2cluster[hash]) for hash in hashes if hash2cluster.get(hash, -1) != -1)
+    nodes, node2cluster, cluster_ids, indptr, members = find_clusters_union_find(hashes, matches)
+    for cluster_idx, cluster_id in enumerate(cluster_ids.tolist()):
+      cluster_hashes = members[indptr[cluster_idx]:indptr[cluster_idx+1]].tolist()
+      old_ids = set(hash2cluster.get(hash, -1) for hash in cluster_hashes)
+      old_ids.discard(-1)
+      # an old cluster's id is its smallest hash, so this is the smallest hash of the merged cluster
+      if old_ids: cluster_id = min(cluster_hashes + list(old_ids))
+      cluster = cluster2hash.setdefault(cluster_id, [])
+      for old_id in old_ids:
+        if old_id == cluster_id: continue
+        for hash in cluster2hash.pop(old_id, []):
+          hash2cluster[hash] = cluster_id
+          cluster.append(hash)
+      for hash in cluster_hashes:
+        if hash2cluster.get(hash, -1) != cluster_id:
+          hash2cluster[hash] = cluster_id
+          cluster.append(hash)
         visited.add(hash)
-        cluster_id = hash
-        hash2cluster[hash] = cluster_id
-        cluster2hash[cluster_id] = cluster2hash.get(cluster_id, []) + [hash]
-
-        while q:
-            node = q.popleft()
-            for neighbor in graph[node]:
-                if neighbor in visited:
-                    continue
-                visited.add(neighbor)
-                q.append(neighbor)
-                hash2cluster[neighbor] = cluster_id
-                cluster2hash[cluster_id] = cluster2hash.get(cluster_id, []) + [neighbor]
+    for hash in hashes:
+      if hash not in hash2cluster:
+        hash2cluster[hash] = -1
 
     return visited, hash2cluster, cluster2hash,
 
-def index_clusters_python(hashes, num_blocks, hamming_distance, do_sort=True, batch_size=900000, verbose=False):
+def index_clusters_union_find(hashes, num_blocks, hamming_distance, engine="simhash"):
+  """ Find all clusters of int64 bit hashes within hamming_distance in one pass, returning the CSR form of find_clusters_union_find. 
+  Unlike index_clusters_python, no batching or resampling is done, so every match is found. """
+  return find_clusters_union_find(hashes, find_all(hashes, num_blocks, hamming_distance, engine=engine))
+
+def _prefix_range_bounds(prefixes, num_shards):
+  """ split sorted prefixes into up to num_shards contiguous (start, end) ranges of about the same size,
+  without splitting a run of equal prefixes. """
+  n = len(prefixes)
+  cuts = np.linspace(0, n, num_shards + 1).astype(np.int64)[1:-1]
+  cuts = np.searchsorted(prefixes, prefixes[np.minimum(cuts, n - 1)], side="left") if n else cuts[:0]
+  bounds = np.unique(np.concatenate([[0], cuts, [n]]))
+  return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+def _shard_matches(args):
+  """ the matches among a contiguous prefix range of the sorted permuted keys of one table. """
+  keys, codes, prefix_mask, hamming_distance = args
+  return unique_pairs(prefix_group_pairs(keys, codes, prefix_mask, hamming_distance))
+
+def index_clusters_sharded(hashes, num_blocks, hamming_distance, num_process=None, num_shards=None, verbose=False):
+  """
+  Find all clusters of int64 bit hashes within hamming_distance using a process pool.
+  For each of the permuted tables of a HammingIndex, the permuted hashes are sorted once and split into num_shards
+  contiguous ranges, cut only between different table prefixes. Two hashes within hamming_distance share the prefix of
+  at least one table, so they always land in the same range for that table.
+  Each (table, range) is matched in a worker, which is only sent its range, and the union of all the matches is
+  clustered with find_clusters_union_find.
+  So unlike index_clusters_python, the result is deterministic and has every match within hamming_distance.
+  Returns the CSR form of find_clusters_union_find.
+  """
+  if num_process is None: num_process = multiprocessing.cpu_count()
+  if num_shards is None: num_shards = num_process
+  codes = np.asarray(hashes, dtype=np.uint64)
+  index = HammingIndex(num_blocks, hamming_distance)
+  num_tables = len(index.permutations)
+  matches = []
+  with multiprocessing.Pool(num_process) as pool:
+    a_iter = range(num_tables)
+    if verbose: a_iter = tqdm.tqdm(a_iter)
+    # one table at a time, so the parent only holds the sorted keys of one table
+    for table in a_iter:
+      keys = index.permute(codes, table)
+      order = np.argsort(keys, kind="stable")
+      keys, table_codes = keys[order], codes[order]
+      del order
+      prefix_mask = index.prefix_masks[table]
+      work = [(keys[start:end], table_codes[start:end], prefix_mask, hamming_distance) \
+              for start, end in _prefix_range_bounds(keys & prefix_mask, num_shards)]
+      matches.extend(pool.imap_unordered(_shard_matches, work))
+  return find_clusters_union_find(codes, unique_pairs(np.concatenate(matches) if matches else np.zeros((0, 2), dtype=np.uint64)))
+
+def _cluster_partition(args):
+  key, codes, num_blocks, hamming_distance = args
+  return key, find_clusters_union_find(codes, find_all_numpy(codes, num_blocks, hamming_distance))
+
+def index_clusters_by_partition(hashes, partitions, num_blocks, hamming_distance, num_process=None):
+  """
+  Cluster int64 bit hashes separately within each partition, e.g., with the language of each document as its partition,
+  so codes of different languages are never matched. The partitions are clustered in parallel with a process pool.
+  hashes can also be a dict of partition -> hashes (e.g., from hamming_index.PartitionedHammingIndex.get_codes), with partitions None.
+  Returns a dict of partition -> the CSR form of find_clusters_union_find.
+  """
+  if partitions is None:
+    work = [(key, np.asarray(codes, dtype=np.uint64), num_blocks, hamming_distance) for key, codes in hashes.items()]
+  else:
+    codes = np.asarray(hashes, dtype=np.uint64)
+    keys, inverse = np.unique(np.asarray(partitions), return_inverse=True)
+    work = [(key, codes[inverse == i], num_blocks, hamming_distance) for i, key in enumerate(keys.tolist())]
+  if num_process is None: num_process = min(len(work), multiprocessing.cpu_count())
+  if num_process <= 1:
+    return dict(_cluster_partition(args) for args in work)
+  # the largest partitions go first, so they don't end up last on a single worker
+  work.sort(key=lambda args: -len(args[1]))
+  with multiprocessing.Pool(num_process) as pool:
+    return dict(pool.imap_unordered(_cluster_partition, work))
+
+def index_clusters_python(hashes, num_blocks, hamming_distance, do_sort=True, batch_size=900000, verbose=False, engine="simhash"):
   """ Incrementally find clusters of int64 bit hashes of *around* the same hamming distance from each other. 
   Returns hash2cluster and cluster2hash dicts, where the ids are all int64 bit hashes.
   """
@@ -136,7 +410,7 @@ def index_clusters_python(hashes, num_blocks, hamming_distance, do_sort=True, ba
   hash2cluster = {}
   visited: Set[int] = set()
   if len(hashes) <= batch_size:
-    visited, hash2cluster, cluster2hash = find_clusters_batch(visited, hash2cluster, cluster2hash, hashes, num_blocks, hamming_distance)
+    visited, hash2cluster, cluster2hash = index_clusters_batch_python(visited, hash2cluster, cluster2hash, hashes, num_blocks, hamming_distance, engine=engine)
     return hash2cluster, cluster2hash
   batch_size2 = int(batch_size/2)
   if verbose:
@@ -151,79 +425,173 @@ def index_clusters_python(hashes, num_blocks, hamming_distance, do_sort=True, ba
       iterms_per_clusters = int(max(1, batch_size2/len(cluster2hash)))
       hashes3 = list(itertools.chain(*[val[:iterms_per_clusters] for val in cluster2hash.values()]))
       if len(hashes3) > int(batch_size2/2):
-        hashes3 = random.sample(hashes3, batch_size2)
+        hashes3 = random.sample(hashes3, min(batch_size2, len(hashes3)))
     if rng > 0 and len(hashes3) < batch_size2:
         hashes3 = list(set(hashes3+random.sample(hashes[:rng], batch_size2-len(hashes3))))
     #print (len(hashes3))
     hashes2.extend(hashes3)
     #print (len(hashes2))
-    visited, hash2cluster, cluster2hash = index_clusters_batch_python(visited, hash2cluster, cluster2hash, hashes2, num_blocks, hamming_distance)
+    visited, hash2cluster, cluster2hash = index_clusters_batch_python(visited, hash2cluster, cluster2hash, hashes2, num_blocks, hamming_distance, engine=engine)
   return hash2cluster, cluster2hash
 
-def search_python_only(queries, num_blocks, hamming_distance):
+def search_python_only(queries, num_blocks, hamming_distance, engine="simhash"):
     """
     Create clusters within hamming distance. 
     Collapses a->b, b->c to all be in the same cluster.
     NOTE: this isn't always true that a and c are within hamming_distance. 
     NOTE: The cluster_id is the hashcode of the first item in the cluster and thus can be used to do further clustering and hamming distance matching.
     """
-    return simhash.find_all(queries, num_blocks, hamming_distance)
-    
+    return find_all(queries, num_blocks, hamming_distance, engine=engine)
+
+
+def find_all(hashes, num_blocks, hamming_distance, engine="simhash"):
+  """ all pairs of hashes within hamming_distance. 
+  engine is "simhash" for the simhash.find_all C++ extension, or "numpy" for hamming_index.find_all_numpy which needs nothing but numpy. """
+  if engine == "simhash":
+    return simhash.find_all(hashes, num_blocks, hamming_distance)
+  elif engine == "numpy":
+    return find_all_numpy(hashes, num_blocks, hamming_distance)
+  raise Exception(f"Unrecognized engine {engine}")
     
-def index_faiss(hashes, d=16):
+
+def index_hamming(hashes, num_blocks=6, hamming_distance=3):
     """ 
     hashes: the array of ints representing the simhash
-    d: Dimension of the ints.
-    
+    Returns a HammingIndex over the hashes. See hamming_index.py.
     """
-    sqrt_size = int(math.sqrt(len(hashes)))
-    
-    # Vectors to train the quantizer.
-    training = [hashes[i] for i in random.sample(range(len(hashes)), 2*sqrt_size)]
-
+    return HammingIndex(num_blocks, hamming_distance).build(hashes)
 
-    # Initializing the quantizer.
-    quantizer = faiss.IndexBinaryFlat(d)
 
-    sqrt_size = int(math.sqrt(len(hashes)))
+def search_hamming(queries, qindices, hamming_distance, index=None, num_blocks=6):
+    """
+    Returns the (qindex, index id) pairs of every indexed hash within hamming_distance of a query.
+    If no index is given, the queries are searched against themselves.
+    """
+    if index is None:
+        index = index_hamming(queries, num_blocks=num_blocks, hamming_distance=hamming_distance)
+    qindices = np.asarray(qindices)
+    qidx, ids, _ = index.query(queries, max_distance=hamming_distance)
+    return list(zip(qindices[qidx].tolist(), ids.tolist()))
     
-    # Number of clusters.
-    nlist = sqrt_size
+def _suffix_array(text):
+  """ suffix array of a str. Suffixes are ordered by code point, like str comparison. """
+  return suffix_array(np.frombuffer(text.encode("utf-32-le", errors="surrogatepass"), dtype=np.uint32))
+
 
-    # Initializing index.
-    index = faiss.IndexBinaryIVF(quantizer, d, nlist)
-    index.nprobe = 4 # Number of nearest clusters to be searched per query. 
+class _TextEditor:
+    """ edits a text in place with str.find and str.replace. Each edit is O(len(text)). """
+    def __init__(self, text, replace_text):
+        self.text = text
+        self.replace_text = replace_text
 
-    # Training the quantizer.
-    index.train(training)
+    def find(self, pattern):
+        return self.text.find(pattern)
 
-    # Adding the database vectors.
-    index.add(hashes)
+    def advance(self, position, length):
+        return position + length
 
-    return index
+    def replace_from(self, pattern, start):
+        text2 = self.text[start:]
+        if pattern not in text2: return False
+        self.text = self.text[:start] + text2.replace(pattern, self.replace_text)
+        return True
 
+    def result(self):
+        return self.text
 
-def search_faiss(queries, qindices, hamming_distance, k=500, index=None):
+
+class _SpanTextEditor:
     """
-    k: Number of nearest neighbors to retrieve per query vector.
+    Does the same edits as _TextEditor, but marks the replaced spans of the original text and builds the text once in result().
+    Positions are offsets into the original text. As long as the replace text has a char no pattern has, a match in the edited 
+    text is a match in the original text that does not overlap a replaced span. So we find the matches of each pattern once with 
+    a suffix array, and each match is looked at most once per pattern, no matter how many times the pattern is replaced.
     """
-    if index is None:
-        index = index_faiss(queries)
-    ret = []
-    # Querying the index.
-    D, I = index.search(queries, k)
-    for i, matches, indices in zip(qindices, D, I):
-        for score, j in zip(matches, indices):
-            if score <= hamming_distance:
-                ret.append((i, j))
-    return ret
-    
-def incremental_span_and_document_neardedup( dup_span, dup_doc, unformatted_text, formatted_text=None, shingle_size = 5, cleanup_dup_span_limit=1000000, cleanup_dup_doc_limit=1000000, normalize_text=True, keep_first_dup_in_unformatted_text=False, keep_first_dup_in_formatted_text=True, replace_char='*'):
+    def __init__(self, text, replace_text):
+        self.text = text
+        self.replace_text = replace_text
+        self.removed = bytearray(len(text))
+        self.starts = bytearray(len(text))
+        self.ends = {}
+        self.sa = None
+        self.matches = {}
+        self.first_match = {}
+        self.replaced_from = {}
+
+    def _matches(self, pattern):
+        """ sorted offsets of every (possibly overlapping) match of pattern in the original text. """
+        ret = self.matches.get(pattern)
+        if ret is not None: return ret
+        if self.sa is None: self.sa = _suffix_array(self.text).tolist()
+        text, sa, plen = self.text, self.sa, len(pattern)
+        lo, hi = 0, len(sa)
+        while lo < hi:
+          mid = (lo + hi) // 2
+          if text[sa[mid]:sa[mid]+plen] < pattern: lo = mid + 1
+          else: hi = mid
+        first, hi = lo, len(sa)
+        while lo < hi:
+          mid = (lo + hi) // 2
+          if text[sa[mid]:sa[mid]+plen] <= pattern: lo = mid + 1
+          else: hi = mid
+        ret = self.matches[pattern] = sorted(sa[first:lo])
+        return ret
+
+    def find(self, pattern):
+        matches, plen, removed = self._matches(pattern), len(pattern), self.removed
+        # replaced spans are never restored, so the first match that is left only moves forward
+        i = self.first_match.get(pattern, 0)
+        while i < len(matches) and removed.find(1, matches[i], matches[i]+plen) >= 0:
+          i += 1
+        self.first_match[pattern] = i
+        return matches[i] if i < len(matches) else -1
+
+    def advance(self, position, length):
+        """ the offset after moving length chars forward in the edited text from an offset that was not replaced. """
+        starts, rlen = self.starts, len(self.replace_text)
+        while True:
+          s = starts.find(1, position, position+length+1)
+          if s < 0: return position + length
+          length -= s - position
+          if length < rlen: return self.ends[s]
+          length -= rlen
+          position = self.ends[s]
+
+    def replace_from(self, pattern, start):
+        # after replacing from start, every match at or after start overlaps a replaced span, so we only look before that
+        replaced_from = self.replaced_from.get(pattern, len(self.text)+1)
+        if start >= replaced_from: return False
+        matches, plen, removed = self._matches(pattern), len(pattern), self.removed
+        found = False
+        for o in matches[bisect.bisect_left(matches, start):bisect.bisect_left(matches, replaced_from)]:
+          if removed.find(1, o, o+plen) >= 0: continue
+          removed[o:o+plen] = b"\x01" * plen
+          self.starts[o] = 1
+          self.ends[o] = o + plen
+          found = True
+        self.replaced_from[pattern] = start
+        return found
+
+    def result(self):
+        text, ends, ret, prev = self.text, self.ends, [], 0
+        for s in sorted(ends):
+          ret.append(text[prev:s])
+          ret.append(self.replace_text)
+          prev = ends[s]
+        ret.append(text[prev:])
+        return "".join(ret)
+
+
+def incremental_span_and_document_neardedup( dup_span, dup_doc, unformatted_text, formatted_text=None, shingle_size = 5, cleanup_dup_span_limit=1000000, cleanup_dup_doc_limit=1000000, normalize_text=True, keep_first_dup_in_unformatted_text=False, keep_first_dup_in_formatted_text=True, replace_char='*', linear_time=True):
     """
     Given a document text and a dict representing any near duplicate spans and duplicate docs, remove duplicate spans of shingle size from the text.
+    dup_span and dup_doc map hashcodes to counts. They can be plain dicts or a store from dedup_manager.get_dup_store.
     The text can be in the form of clean unformatted text, e.g., removed formatting and any extraneous tags, and the corresponding formatted text, 
     Assumes that double spaces denote sentence break in the text, and formatted_text.
     normalize_text will add double spaces between common punctuations and quotes. 
+    linear_time: mark the duplicate spans and build the texts once at the end, instead of a str.replace over the rest of the text
+      for every duplicate span, which is quadratic on long repetitive pages. The output is the same. 
+      If the text already has the replace_char, we use str.replace.
     Return:
     
       doc_is_dup, deduped unformatted_text, deduped formatted_text
@@ -255,9 +623,12 @@ def incremental_span_and_document_neardedup( dup_span, dup_doc, unformatted_text
           chunks.append(sent)
     
     replace_text = " "+replace_char+" "
-    shingles = [" ".join(chunks[i : i + shingle_size]) for i in range(len(chunks) - shingle_size)]
     is_dup_within_doc = {}
     unformatted_text = " ".join(unformatted_text.split())
+    if linear_time and replace_char.strip() and replace_char not in unformatted_text and replace_char not in formatted_text:
+      unformatted_editor, formatted_editor = _SpanTextEditor(unformatted_text, replace_text), _SpanTextEditor(formatted_text, replace_text)
+    else:
+      unformatted_editor, formatted_editor = _TextEditor(unformatted_text, replace_text), _TextEditor(formatted_text, replace_text)
     
     #dedup spans other than the first matching span using shingle_size of sentences (e.g., a span) 
     for ch_idx in range(len(chunks) - shingle_size):
@@ -268,55 +639,39 @@ def incremental_span_and_document_neardedup( dup_span, dup_doc, unformatted_text
       if hashcode in is_dup_within_doc:
         prev_ch_idx = is_dup_within_doc[hashcode][0]
         prev_chunk = chunks[prev_ch_idx]
-        clean_position = unformatted_text.find(prev_chunk)
-        formatted_text_position = formatted_text.find(prev_chunk)
+        clean_position = unformatted_editor.find(prev_chunk)
+        formatted_text_position = formatted_editor.find(prev_chunk)
         if clean_position >= 0 and formatted_text_position >= 0:
-          clean_position += len(shingle)
-          formatted_text_position += len(shingle)
-          unformatted_text2 = unformatted_text[clean_position+1:]
-          formatted_text2 = formatted_text[formatted_text_position+1:]
-          if shingle in unformatted_text2:
-            unformatted_text2 = unformatted_text2.replace(shingle, replace_text)
-          else:
-            for chunk in chunks[ch_idx : ch_idx + shingle_size]:
-              if len(chunk) > 3: unformatted_text2 = unformatted_text2.replace(chunk, replace_text)
-          if shingle in formatted_text2:
-            formatted_text2 = formatted_text2.replace(shingle, replace_text)
-          else:
-            for chunk in chunks[ch_idx : ch_idx + shingle_size]:
-              if len(chunk) > 3: formatted_text2 = formatted_text2.replace(chunk, replace_text)
-          unformatted_text = unformatted_text[:clean_position+1] + unformatted_text2
-          formatted_text = formatted_text[:formatted_text_position+1] + formatted_text2
+          #replace the later copies of the shingle, after the end of the first one
+          for editor, position in ((unformatted_editor, clean_position), (formatted_editor, formatted_text_position)):
+            position = editor.advance(position, len(shingle)+1)
+            if not editor.replace_from(shingle, position):
+              for chunk in chunks[ch_idx : ch_idx + shingle_size]:
+                if len(chunk) > 3: editor.replace_from(chunk, position)
       
-      is_dup_within_doc[hashcode] = is_dup_within_doc.get(hashcode, []) + [ch_idx]
+      is_dup_within_doc.setdefault(hashcode, []).append(ch_idx)
         
-      if hashcode in dup_span:
-        dup_span[hashcode] += 1
-      else:
-        dup_span[hashcode] = 1
+      increment_dup_store(dup_span, hashcode)
         
     if not keep_first_dup_in_formatted_text:      
       for hashcode, ch_idx in is_dup_within_doc.items():  
         if hashcode in dup_span and dup_span.get(hashcode, len(ch_idx)) > len(ch_idx): #this item is a duplicate across documents
           ch_idx = ch_idx[0]
           shingle= " ".join(chunks[ch_idx : ch_idx + shingle_size])
-          if shingle in formatted_text: 
-            formatted_text = formatted_text.replace(shingle, replace_text)
-          else:
+          if not formatted_editor.replace_from(shingle, 0):
             for chunk in chunks[ch_idx : ch_idx + shingle_size]:
-                formatted_text = formatted_text.replace(chunk, replace_text)
+                formatted_editor.replace_from(chunk, 0)
     
     if not keep_first_dup_in_unformatted_text:      
       for hashcode, ch_idx in is_dup_within_doc.items():  
         if hashcode in dup_span and dup_span.get(hashcode,0) > len(ch_idx): #this item is a duplicate across documents
           ch_idx = ch_idx[0]
           shingle= " ".join(chunks[ch_idx : ch_idx + shingle_size])
-          if shingle in unformatted_text: 
-            unformatted_text = unformatted_text.replace(shingle, replace_text)
-          else:
+          if not unformatted_editor.replace_from(shingle, 0):
             for chunk in chunks[ch_idx : ch_idx + shingle_size]:
-                unformatted_text = unformatted_text.replace(chunk, replace_text)
+                unformatted_editor.replace_from(chunk, 0)
     
+    unformatted_text, formatted_text = unformatted_editor.result(), formatted_editor.result()
     unformatted_text = unformatted_text.replace(replace_char+" .", replace_text).\
         replace(replace_char+" !", replace_text).\
         replace(replace_char+" ?", replace_text).\
@@ -346,14 +701,9 @@ def incremental_span_and_document_neardedup( dup_span, dup_doc, unformatted_text
     formatted_text = " ".join(formatted_text.split())
 
 
-    #TODO: improve this so we cleaup by value until we reach the limit
-    if len(dup_span) > cleanup_dup_span_limit:
-      for key, val in list(dup_span.items()):
-        if val <= 1: del dup_span[key]
-          
-    if len(dup_doc) > cleanup_dup_doc_limit:
-      for key, val in list(dup_doc.items()):
-        if val <= 1: del dup_doc[key]
+    #dup_span and dup_doc can be dicts or any of the stores in dedup_manager, which evict by value until they are under the limit
+    cleanup_dup_store(dup_span, cleanup_dup_span_limit)
+    cleanup_dup_store(dup_doc, cleanup_dup_doc_limit)
           
     doc_is_dup = 0
     if any([a for h, a in is_dup_within_doc.items() if len(a) > 1 or len(a) < dup_span.get(h,len(a))]):
@@ -361,12 +711,8 @@ def incremental_span_and_document_neardedup( dup_span, dup_doc, unformatted_text
       hashcode = hashcode.strip(' '+replace_char).lower()
       hashcode = DIGIT_REGEX.sub('1', hashcode)
       hashcode = hashing(hashcode)
-      if hashcode in dup_doc:
-        dup_doc[hashcode] += 1
-        doc_is_dup=2
-      else:
-        dup_doc[hashcode] = 1
-        doc_is_dup=1
+      #one atomic update, so two processes sharing dup_doc can't both see the document as new
+      doc_is_dup = 2 if increment_dup_store(dup_doc, hashcode) > 1 else 1
         
     return doc_is_dup, unformatted_text, formatted_text
 
@@ -378,4 +724,56 @@ def test_simhash(): # test clustering on a medium size dataset
   arr = np.random.randint( sys.maxsize, size=num, dtype=np.int64)
   arr.sort()
   arr = arr.tolist()
-  find_clusters(arr, 5, 4, do_sort=False, verbose=True)
+  index_clusters_union_find(arr, 5, 4)
+
+
+def benchmark_hashing_batch(num_docs=2000, doc_len=5000, window_size=24, tokenization="character", batch_size=500):
+  """ compare documents/sec of hashing() against hashing_batch() on random CommonCrawl sized documents, and check they agree. """
+  words = ["".join(random.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(random.randint(1, 10))) for _ in range(5000)] + ["für", "日本語", "ĉi", "é."]
+  docs = []
+  for _ in range(num_docs):
+    doc = []
+    doc_size = 0
+    while doc_size < doc_len:
+      doc.append(random.choice(words))
+      doc_size += len(doc[-1])+1
+    docs.append(" ".join(doc))
+  st = time.time()
+  codes = [hashing(doc, tokenization=tokenization, window_size=window_size) for doc in docs]
+  scalar_time = time.time()-st
+  st = time.time()
+  codes2 = []
+  for rng in range(0, len(docs), batch_size):
+    codes2.extend(hashing_batch(docs[rng:rng+batch_size], tokenization=tokenization, window_size=window_size))
+  batch_time = time.time()-st
+  assert codes == codes2
+  print (f"hashing: {num_docs/scalar_time:.1f} docs/sec, hashing_batch: {num_docs/batch_time:.1f} docs/sec")
+  return num_docs/scalar_time, num_docs/batch_time
+
+
+def benchmark_span_dedup(sizes=(1000, 2000, 4000, 8000, 16000), block_size=20, check=True):
+  """ 
+  time incremental_span_and_document_neardedup on forum like pages of num sentences, where blocks of block_size sentences 
+  are repeated with a few new sentences in between. With linear_time, the time per sentence should stay about the same 
+  as the pages get longer. With check, also runs linear_time=False and checks the outputs are the same.
+  """
+  words = ["".join(random.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(random.randint(1, 10))) for _ in range(5000)]
+  ret = {}
+  for num in sizes:
+    blocks = [[" ".join(random.choice(words) for _ in range(random.randint(3, 15)))+"." for _ in range(block_size)] for _ in range(max(1, num//(4*block_size)))]
+    sents = []
+    while len(sents) < num:
+      sents.extend(random.choice(blocks))
+      sents.extend(" ".join(random.choice(words) for _ in range(random.randint(3, 15)))+"." for _ in range(random.randint(0, 3)))
+    text = " ".join(sents[:num])
+    st = time.time()
+    out = incremental_span_and_document_neardedup({}, {}, text)
+    ret[num] = {"linear_time_secs": time.time() - st, "chars": len(text)}
+    ret[num]["linear_time_usecs_per_char"] = 1e6 * ret[num]["linear_time_secs"] / len(text)
+    if check:
+      st = time.time()
+      out2 = incremental_span_and_document_neardedup({}, {}, text, linear_time=False)
+      ret[num]["str_replace_secs"] = time.time() - st
+      assert out == out2, "linear_time output differs"
+    print (num, ret[num])
+  return ret
@@ -0,0 +1,388 @@
+#@title Suffix Array Dedup Code
+"""
+Copyright, 2021-2022 Ontocord, LLC, All rights reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Offline exact substring dedup of the JSONL records written by the LAION pipeline, in the spirit of
+# Lee et al., Deduplicating Training Data Makes Language Models Better, 2021 (ExactSubstr).
+# The text field of every record is written to one uint8 buffer on disk, with a 0xff byte (never in utf8) after each record.
+# The buffer is split into shards that fit the memory budget, and each shard is processed in a worker against a memory mapped
+# view of the buffer. Within a shard, we sort the suffixes by their first min_length bytes with prefix doubling, which groups
+# every position with the other positions that start the same min_length bytes. Positions drop out of the sort as soon as
+# their prefix is unique, so most of the work is on the repeated text. Every copy but the first of a repeated
+# substring of min_length or more bytes is then dropped. The result is a list of byte ranges to drop for each record.
+# As many shards run at once as the memory budget allows. Repeats across shards are found by
+# a second pass: the first pass also writes the sorted rolling hashes of the min_length windows of each shard to disk, and
+# the second looks up the windows of each shard in the hashes of the earlier shards (checking the bytes of each match),
+# and drops every copy of a window that is already in an earlier shard.
+
+import os, json, time
+import multiprocessing
+import numpy as np
+import tqdm
+
+RECORD_SEPARATOR = b"\xff"
+CORPUS_RECORD = np.dtype([("start", "<i8"), ("end", "<i8"), ("file", "<i4"), ("line", "<i8")])
+# about how many bytes of memory it takes to process each byte of a shard
+BYTES_PER_SHARD_BYTE = 64
+# the base of the polynomial rolling hash of the windows, and its inverse mod 2**64. Any odd base is invertible.
+HASH_BASE = 0x100000001B3
+HASH_BASE_INV = pow(HASH_BASE, -1, 1 << 64)
+
+
+def _dense_ranks(codes):
+  """ rank of each value among the distinct values, starting at 1 so 0 can mean past the end. """
+  if codes.dtype.kind in "ub" or (codes.dtype.kind == "i" and codes.min() >= 0):
+    max_code = int(codes.max())
+    if max_code < (1 << 22):
+      present = np.zeros(max_code + 1, dtype=np.int64)
+      present[codes] = 1
+      return np.cumsum(present)[codes]
+  return np.unique(codes, return_inverse=True)[1].reshape(-1).astype(np.int64) + 1
+
+
+def suffix_array(codes):
+  """ suffix array of an int array (e.g., bytes or code points) by prefix doubling with NumPy sorts. Shorter suffixes sort first. """
+  codes = np.asarray(codes)
+  n = len(codes)
+  if not n: return np.zeros(0, dtype=np.int64)
+  rank = _dense_ranks(codes)
+  bits = n.bit_length()
+  positions = np.arange(n, dtype=np.int64)
+  k = 1
+  while True:
+    # rank of the suffix starting k positions later
+    rank2 = np.zeros(n, dtype=np.int64)
+    if k < n: rank2[:n-k] = rank[k:]
+    key = rank << bits | rank2
+    if 3 * bits <= 63:
+      # sorting the keys with the positions packed in the low bits is much faster than an argsort
+      packed = np.sort(key << bits | positions)
+      sa, skey = packed & ((1 << bits) - 1), packed >> bits
+    else:
+      sa = np.argsort(key)
+      skey = key[sa]
+    rank = np.empty(n, dtype=np.int64)
+    rank[sa] = np.cumsum(np.concatenate([[1], skey[1:] != skey[:-1]]))
+    if rank[sa[-1]] == n: return sa
+    k *= 2
+
+
+def repeated_windows(codes, window):
+  """
+  The positions whose window values starting there also start at another position, with a key per position such that two 
+  positions have the same key iff their windows are the same. Returns (positions, keys), sorted by key, then position.
+  This is prefix doubling like suffix_array, stopped once the prefixes are window long. Once a prefix is unique its position 
+  is not sorted again, so the work after the first few rounds is about the number of positions in repeated text.
+  """
+  codes = np.asarray(codes)
+  n = len(codes)
+  empty = np.zeros(0, dtype=np.int64)
+  if n < window: return empty, empty
+  rank = _dense_ranks(codes)
+  next_id = int(rank.max()) + 1
+  # every position takes part, so the ranks of the positions a window runs into are always up to date
+  active = np.arange(n, dtype=np.int64)
+  k = 1
+  while len(active):
+    # on the last round, compare the windows by their first k and last k values
+    step = min(k, window - k)
+    if step <= 0: break
+    later = active + step
+    in_range = later < n
+    key = np.zeros(len(active), dtype=np.int64)
+    key[in_range] = rank[later[in_range]]
+    del later, in_range
+    key |= rank[active] << next_id.bit_length()
+    order = np.argsort(key)
+    active, key = active[order], key[order]
+    del order
+    group = np.cumsum(np.concatenate([[True], key[1:] != key[:-1]])) - 1
+    del key
+    # new ids never reuse an old one, so ranks of positions that dropped out stay unique
+    rank[active] = next_id + group
+    next_id += int(group[-1]) + 1
+    group_size = np.bincount(group)
+    repeated = group_size[group] > 1
+    active = active[repeated]
+    if step < k: break
+    k *= 2
+  active = active[active <= n - window]
+  if not len(active): return empty, empty
+  keys = rank[active]
+  order = np.lexsort((active, keys))
+  active, keys = active[order], keys[order]
+  same_as_next = keys[1:] == keys[:-1]
+  repeated = np.concatenate([[False], same_as_next]) | np.concatenate([same_as_next, [False]])
+  return active[repeated], keys[repeated]
+
+
+def window_hashes(codes, window):
+  """
+  The polynomial hash mod 2**64 of the window values starting at each position 0..len(codes)-window. The same window has
+  the same hash wherever it starts, also in another array, so the hashes of two shards can be compared.
+  Different windows can share a hash, so check the values of a match.
+  """
+  codes = np.asarray(codes).astype(np.uint64)
+  n = len(codes)
+  if n < window: return np.zeros(0, dtype=np.uint64)
+  # uint64 products and sums wrap, which is the mod 2**64
+  powers = np.full(n, HASH_BASE, dtype=np.uint64)
+  powers[0] = 1
+  powers = np.cumprod(powers)
+  prefix = np.zeros(n + 1, dtype=np.uint64)
+  np.cumsum(codes * powers, out=prefix[1:])
+  del powers, codes
+  # prefix[p+window]-prefix[p] is the hash of the window at p times HASH_BASE**p
+  unshift = np.full(n - window + 1, HASH_BASE_INV, dtype=np.uint64)
+  unshift[0] = 1
+  unshift = np.cumprod(unshift)
+  return (prefix[window:] - prefix[:n-window+1]) * unshift
+
+
+def build_corpus_buffer(jsonl_paths, buffer_path, field="text_no_bild", verbose=False):
+  """
+  Write the utf8 bytes of the field of every record in the JSONL files to buffer_path, each followed by RECORD_SEPARATOR.
+  Returns an array of CORPUS_RECORD with the [start, end) bytes of each record in the buffer, and its file index and line number.
+  Records without the field are skipped.
+  """
+  if os.path.dirname(buffer_path): os.makedirs(os.path.dirname(buffer_path), exist_ok=True)
+  records = []
+  pos = 0
+  with open(buffer_path, "wb") as out:
+    a_iter = enumerate(jsonl_paths)
+    if verbose: a_iter = tqdm.tqdm(a_iter, total=len(jsonl_paths))
+    for file_idx, path in a_iter:
+      with open(path, "rb") as f:
+        for line_no, line in enumerate(f):
+          line = line.strip()
+          if not line: continue
+          try:
+            text = json.loads(line).get(field)
+          except:
+            continue
+          if not text: continue
+          text = text.encode("utf8", errors="ignore")
+          out.write(text)
+          out.write(RECORD_SEPARATOR)
+          records.append((pos, pos+len(text), file_idx, line_no))
+          pos += len(text) + len(RECORD_SEPARATOR)
+  return np.array(records, dtype=CORPUS_RECORD)
+
+
+def shard_records(records, shard_bytes):
+  """ split the records into contiguous (first, last+1) record ranges of at most about shard_bytes bytes. """
+  shards = []
+  first = 0
+  while first < len(records):
+    start = records["start"][first]
+    last = int(np.searchsorted(records["end"], start + shard_bytes, side="right"))
+    last = max(last, first + 1)
+    shards.append((first, last))
+    first = last
+  return shards
+
+
+def find_repeated_ranges(buf, records, min_length=100):
+  """
+  Byte ranges to drop so that every substring of at least min_length bytes that is repeated in buf is only kept the first time.
+  buf: uint8 array (e.g., a memmap) of the records.
+  records: CORPUS_RECORD array of the records in buf, with start and end relative to buf.
+  Returns (starts, ends) arrays of the merged [start, end) ranges, relative to buf. Ranges never cross a record boundary.
+  """
+  valid = _valid_windows(len(buf), records, min_length)
+  if not valid.any(): return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+  positions, keys = repeated_windows(np.asarray(buf), min_length)
+  positions, keys = positions[valid[positions]], keys[valid[positions]]
+  if not len(positions): return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+  # within each key the positions are ascending, so all but the first are later copies
+  later_copy = np.concatenate([[False], keys[1:] == keys[:-1]])
+  return _windows_to_ranges(np.sort(positions[later_copy]), min_length)
+
+
+def _valid_windows(n, records, min_length):
+  """ whether the min_length window at each of the n positions of a buffer fits inside one of records. """
+  valid = np.zeros(n, dtype=bool)
+  if not n or not len(records): return valid
+  long_enough = (records["end"] - records["start"]) >= min_length
+  starts, last = records["start"][long_enough], records["end"][long_enough] - min_length + 1
+  if not len(starts): return valid
+  inside = np.zeros(n + 1, dtype=np.int32)
+  np.add.at(inside, starts, 1)
+  np.add.at(inside, last, -1)
+  return np.cumsum(inside[:n]) > 0
+
+
+def _windows_to_ranges(dups, min_length):
+  """ merge the [dup, dup+min_length) windows of the sorted positions dups into (starts, ends) ranges. """
+  if not len(dups): return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+  new_range = np.concatenate([[True], dups[1:] > dups[:-1] + min_length])
+  range_starts = dups[new_range]
+  range_ends = dups[np.concatenate([new_range[1:], [True]])] + min_length
+  return range_starts, range_ends
+
+
+def _merge_ranges(starts, ends):
+  """ merge the overlapping or touching [start, end) ranges into sorted disjoint (starts, ends). """
+  if not len(starts): return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+  order = np.argsort(starts, kind="stable")
+  starts, ends = starts[order], np.maximum.accumulate(ends[order])
+  new_range = np.concatenate([[True], starts[1:] > ends[:-1]])
+  return starts[new_range], ends[np.concatenate([new_range[1:], [True]])]
+
+
+def _same_windows(buf, positions, other_positions, window, chunk=1 << 16):
+  """ whether the window of buf at each of positions has the same bytes as the window at the matching other_positions. """
+  ret = np.zeros(len(positions), dtype=bool)
+  offsets = np.arange(window, dtype=np.int64)
+  for i in range(0, len(positions), chunk):
+    a, b = positions[i:i+chunk], other_positions[i:i+chunk]
+    ret[i:i+chunk] = (buf[a[:, None] + offsets] == buf[b[:, None] + offsets]).all(axis=1)
+  return ret
+
+
+def _open_shard(buffer_path, records, min_length):
+  """ the memmap of the bytes of a shard, its start in the buffer, and the positions (relative to the start) and
+  hashes of its windows that fit inside a record. """
+  start, end = int(records["start"][0]), int(records["end"][-1])
+  buf = np.memmap(buffer_path, dtype=np.uint8, mode="r", offset=start, shape=(end - start,))
+  shard_records = records.copy()
+  shard_records["start"] -= start
+  shard_records["end"] -= start
+  positions = np.flatnonzero(_valid_windows(len(buf), shard_records, min_length))
+  hashes = window_hashes(buf, min_length)[positions] if len(positions) else np.zeros(0, dtype=np.uint64)
+  return buf, start, shard_records, positions, hashes
+
+
+def _find_repeated_ranges_in_shard(args):
+  """ the ranges repeated within a shard. Also writes the sorted hashes of the first copy of each window of the shard,
+  and the buffer position of that copy, to hashes_path+".hashes.npy" and hashes_path+".positions.npy". """
+  buffer_path, records, min_length, hashes_path = args
+  buf, start, shard_records, positions, hashes = _open_shard(buffer_path, records, min_length)
+  # np.unique returns the first index of each hash, which is the first copy since positions are ascending
+  hashes, first = np.unique(hashes, return_index=True)
+  np.save(hashes_path+".hashes.npy", hashes)
+  np.save(hashes_path+".positions.npy", positions[first] + start)
+  del hashes, first, positions
+  range_starts, range_ends = find_repeated_ranges(buf, shard_records, min_length)
+  return range_starts + start, range_ends + start
+
+
+def _find_cross_shard_ranges(args):
+  """ the ranges of a shard whose windows are already in one of the earlier shards written by _find_repeated_ranges_in_shard. """
+  buffer_path, records, min_length, earlier_hashes_paths = args
+  _, start, _, positions, hashes = _open_shard(buffer_path, records, min_length)
+  corpus = np.memmap(buffer_path, dtype=np.uint8, mode="r")
+  dups = []
+  for hashes_path in earlier_hashes_paths:
+    if not len(positions): break
+    earlier_hashes = np.load(hashes_path+".hashes.npy", mmap_mode="r")
+    if not len(earlier_hashes): continue
+    idx = np.minimum(np.searchsorted(earlier_hashes, hashes), len(earlier_hashes) - 1)
+    match = np.flatnonzero(earlier_hashes[idx] == hashes)
+    if not len(match): continue
+    earlier_positions = np.load(hashes_path+".positions.npy", mmap_mode="r")[idx[match]]
+    match = match[_same_windows(corpus, positions[match] + start, earlier_positions, min_length)]
+    dups.append(positions[match] + start)
+    # a window only needs to be found in one earlier shard
+    keep = np.ones(len(positions), dtype=bool)
+    keep[match] = False
+    positions, hashes = positions[keep], hashes[keep]
+  dups = np.sort(np.concatenate(dups)) if dups else np.zeros(0, dtype=np.int64)
+  return _windows_to_ranges(dups, min_length)
+
+
+def exact_substring_dedup(jsonl_paths, output_path, work_dir="./exact_substr_dedup", field="text_no_bild", min_length=100, \
+                          memory_budget=4*1024**3, num_process=None, keep_buffer=False, verbose=False):
+  """
+  Find the byte ranges of the field of each record in jsonl_paths that repeat an earlier substring of at least min_length bytes.
+  The ranges are written to output_path as JSONL of {"file": path, "line": line number, "ranges": [[start, end], ...]},
+  one line per record with at least one range, where start and end are offsets into the utf8 bytes of the field.
+  Use remove_drop_ranges to apply them.
+  memory_budget: total bytes for all the workers. Shards are about memory_budget/BYTES_PER_SHARD_BYTE bytes, and up to
+    num_process shards are processed at once, as many as fit the budget.
+  Returns a dict of stats.
+  """
+  st = time.time()
+  if num_process is None: num_process = multiprocessing.cpu_count()
+  os.makedirs(work_dir, exist_ok=True)
+  buffer_path = os.path.join(work_dir, "corpus.bin")
+  records = build_corpus_buffer(jsonl_paths, buffer_path, field=field, verbose=verbose)
+  shard_bytes = max(min_length, memory_budget // BYTES_PER_SHARD_BYTE)
+  shards = shard_records(records, shard_bytes)
+  hashes_paths = [os.path.join(work_dir, f"shard_{i}") for i in range(len(shards))]
+  ranges_starts, ranges_ends, cross_starts, cross_ends = [], [], [], []
+  if shards:
+    largest_shard = max(int(records["end"][last-1] - records["start"][first]) for first, last in shards)
+    num_workers = max(1, min(num_process, len(shards), memory_budget // (BYTES_PER_SHARD_BYTE * max(1, largest_shard))))
+    work = [(buffer_path, records[first:last], min_length, hashes_path) for (first, last), hashes_path in zip(shards, hashes_paths)]
+    cross_work = [(buffer_path, records[first:last], min_length, hashes_paths[:i]) for i, (first, last) in enumerate(shards) if i]
+    with multiprocessing.Pool(num_workers) as pool:
+      a_iter = pool.imap(_find_repeated_ranges_in_shard, work)
+      if verbose: a_iter = tqdm.tqdm(a_iter, total=len(work))
+      for range_starts, range_ends in a_iter:
+        ranges_starts.append(range_starts)
+        ranges_ends.append(range_ends)
+      a_iter = pool.imap(_find_cross_shard_ranges, cross_work)
+      if verbose: a_iter = tqdm.tqdm(a_iter, total=len(cross_work))
+      for range_starts, range_ends in a_iter:
+        cross_starts.append(range_starts)
+        cross_ends.append(range_ends)
+    for hashes_path in hashes_paths:
+      for suffix in (".hashes.npy", ".positions.npy"):
+        if os.path.exists(hashes_path+suffix): os.unlink(hashes_path+suffix)
+  cross_dropped_bytes = int(sum((ends - starts).sum() for starts, ends in zip(cross_starts, cross_ends)))
+  # a window can be a later copy both within its shard and of an earlier shard, so merge the overlapping ranges
+  range_starts, range_ends = _merge_ranges(np.concatenate(ranges_starts + cross_starts + [np.zeros(0, dtype=np.int64)]), \
+                                           np.concatenate(ranges_ends + cross_ends + [np.zeros(0, dtype=np.int64)]))
+  # the record of each range, and the range relative to the record
+  record_idx = np.searchsorted(records["start"], range_starts, side="right") - 1
+  range_starts = range_starts - records["start"][record_idx]
+  range_ends = range_ends - records["start"][record_idx]
+  if os.path.dirname(output_path): os.makedirs(os.path.dirname(output_path), exist_ok=True)
+  num_records = 0
+  with open(output_path, "w", encoding="utf8") as out:
+    breaks = np.flatnonzero(np.diff(record_idx)) + 1
+    for idxs in np.split(np.arange(len(record_idx)), breaks):
+      if not len(idxs): continue
+      record = records[record_idx[idxs[0]]]
+      out.write(json.dumps({"file": jsonl_paths[record["file"]], "line": int(record["line"]), \
+                            "ranges": np.stack([range_starts[idxs], range_ends[idxs]], axis=1).tolist()})+"\n")
+      num_records += 1
+  if not keep_buffer: os.unlink(buffer_path)
+  total_bytes = int((records["end"] - records["start"]).sum()) if len(records) else 0
+  dropped_bytes = int((range_ends - range_starts).sum())
+  return {"records": len(records), "records_with_dups": num_records, "bytes": total_bytes, "dropped_bytes": dropped_bytes, \
+          "cross_shard_dropped_bytes": cross_dropped_bytes, "shards": len(shards), "secs": time.time() - st}
+
+
+def load_drop_ranges(ranges_path):
+  """ {(file, line): ranges} from the output of exact_substring_dedup. """
+  ret = {}
+  with open(ranges_path, encoding="utf8") as f:
+    for line in f:
+      item = json.loads(line)
+      ret[(item["file"], item["line"])] = item["ranges"]
+  return ret
+
+
+def remove_drop_ranges(text, ranges, replace_text=" * "):
+  """ replace each [start, end) utf8 byte range of text with replace_text. Chars cut by a range are dropped. """
+  text = text.encode("utf8", errors="ignore")
+  ret = []
+  prev = 0
+  for start, end in sorted(ranges):
+    ret.append(text[prev:start].decode("utf8", errors="ignore"))
+    ret.append(replace_text)
+    prev = end
+  ret.append(text[prev:].decode("utf8", errors="ignore"))
+  return "".join(ret)
@@ -0,0 +1,97 @@
+#@title URL Fingerprint Code
+"""
+Copyright, 2021-2022 Ontocord, LLC, All rights reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Exact fingerprints of the URLs of bild elements (images, videos, audio, iframes, links).
+# A character window simhash of a URL is slow and says little about near duplicates, so instead we canonicalize the URL
+# (lowercase scheme and host, drop default ports, fragments and tracking params, sort the query) and take a 64 bit
+# xxhash (or mmh3, or blake2b if neither is installed) of it. The same asset on a CDN then gets the same fingerprint on
+# every page, and a dup store (see dedup_manager.get_dup_store) of fingerprint -> count is the seen url index.
+
+import hashlib
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from .simhash import hashing
+
+try:
+  import xxhash
+except:
+  xxhash = None
+try:
+  import mmh3
+except:
+  mmh3 = None
+
+# query params that only track where a click came from, and never change the content
+TRACKING_PARAMS = {"fbclid", "gclid", "dclid", "gclsrc", "msclkid", "yclid", "mc_cid", "mc_eid", "_ga", "_gl", "igshid", \
+                   "ref_src", "ref_url", "wickedid", "oly_anon_id", "oly_enc_id", "vero_id", "_hsenc", "_hsmi", "hsctatracking", "mkt_tok"}
+TRACKING_PARAM_PREFIXES = ("utm_", "pk_", "piwik_", "mtm_", "matomo_", "hmb_", "__hs")
+_DEFAULT_PORTS = {"http": 80, "https": 443, "ftp": 21}
+
+# how each bild element type is fingerprinted by fingerprint_bild_element:
+#   "url": url_fingerprint of the canonical url, "exact": a 64 bit hash of the value as is, "simhash": simhash.hashing of the value.
+# a type that is missing uses "simhash".
+bild_fingerprint_config = {"imgs": "url", "vids": "url", "auds": "url", "iframes": "url", "rights_links": "url"}
+
+
+def is_tracking_param(name):
+  name = name.lower()
+  return name in TRACKING_PARAMS or name.startswith(TRACKING_PARAM_PREFIXES)
+
+
+def canonicalize_url(url):
+  """
+  The canonical form of url: the scheme and host are lowercased, default ports, userinfo, fragments and tracking
+  params are dropped, and the remaining query params are sorted. Values that are not http(s) or ftp urls (e.g., data: uris
+  or relative paths) are only stripped.
+  """
+  url = url.strip()
+  try:
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    if scheme not in _DEFAULT_PORTS or not parts.hostname: return url
+    host = parts.hostname.rstrip(".")
+    if ":" in host: host = f"[{host}]"
+    port = parts.port
+  except ValueError:
+    return url
+  if port is not None and port != _DEFAULT_PORTS[scheme]: host = f"{host}:{port}"
+  query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not is_tracking_param(k))
+  return urlunsplit((scheme, host, parts.path or "/", urlencode(query), ""))
+
+
+def hash64(val):
+  """ a fast 64 bit unsigned hash of a str or bytes. """
+  if isinstance(val, str): val = val.encode("utf8", errors="surrogatepass")
+  if xxhash is not None:
+    return xxhash.xxh64_intdigest(val)
+  if mmh3 is not None:
+    return mmh3.hash64(val, signed=False)[0]
+  return int.from_bytes(hashlib.blake2b(val, digest_size=8).digest(), "big")
+
+
+def url_fingerprint(url):
+  """ a 64 bit fingerprint of the canonical form of url, which is the same for urls that only differ in tracking params, query order, etc. """
+  return hash64(canonicalize_url(url))
+
+
+def fingerprint_bild_element(bild_element_type, val, fingerprint_config=None):
+  """ the fingerprint of the value of a bild element, as configured for its type in fingerprint_config (default bild_fingerprint_config). """
+  mode = (bild_fingerprint_config if fingerprint_config is None else fingerprint_config).get(bild_element_type, "simhash")
+  if mode == "url":
+    return url_fingerprint(val)
+  elif mode == "exact":
+    return hash64(val)
+  elif mode == "simhash":
+    return hashing(val)
+  raise Exception(f"Unrecognized fingerprint mode {mode}")
+